@@ -0,0 +1,81 @@
+###########################################################
+##### Alarm sound kept loaded and ready before it rings #####
+###########################################################
+
+############################
+##### Import Libraries #####
+############################
+from scheduler import monotonic
+
+pygame = None # Imported by arm(), it takes seconds to load on a Pi Zero
+
+MIXER_BUFFER = 1024 # Samples per mixer buffer, smaller starts sooner (pygame's default is 4096)
+
+##########################################
+##### Decoded alarm sound, in memory #####
+##########################################
+class AlarmSound(object):
+    """arm() decodes the whole file into a pygame Sound and sets the volume ahead of time,
+    so play() only has to hand an already decoded buffer to the mixer.
+    mixer is a volume.Volume. With fade_in, play() ramps up from silence over that many seconds."""
+
+    def __init__(self, sound_file, volume, mixer, fade_in=0):
+        self.sound_file = sound_file
+        self.volume = volume
+        self.mixer = mixer
+        self.fade_in = fade_in
+        self.error = None # Why arm() failed, if it did
+        self.latency = None # Seconds from the alarm being due to its first sample playing
+        self._sound = None
+        self._channel = None
+
+    @property
+    def armed(self):
+        return self._sound is not None and pygame.mixer.get_init() is not None
+
+    def arm(self):
+        """Load and check the sound. Returns False (and sets error) if it cannot be played."""
+        global pygame
+        try:
+            import pygame.mixer
+            if pygame.mixer.get_init() is None:
+                pygame.mixer.init(44100, -16, 2, MIXER_BUFFER) # Start pygame.mixer (Audio)
+            sound = pygame.mixer.Sound(self.sound_file) # Decodes the whole file now
+        except ImportError as e: # pygame is still None here, so this has to come first
+            self.error = "pygame is not installed (" + str(e) + ")"
+            self._sound = None
+            return False
+        except pygame.error as e:
+            self.error = str(e)
+            self._sound = None
+            return False
+        if sound.get_length() <= 0:
+            self.error = "empty sound file"
+            self._sound = None
+            return False
+        self.mixer.set(0 if self.fade_in else self.volume) # Set volume level
+        self._sound = sound
+        self.error = None
+        return True
+
+    def play(self, due_at=None):
+        """Start the sound looping. due_at is the monotonic time the alarm was due, for latency."""
+        self._channel = self._sound.play(loops=-1)
+        if self.fade_in:
+            self.mixer.ramp(0, self.volume, self.fade_in)
+        if due_at is not None:
+            frequency = pygame.mixer.get_init()[0]
+            self.latency = monotonic() - due_at + float(MIXER_BUFFER) / frequency # The first buffer still has to drain
+        return self._channel is not None
+
+    def stop(self):
+        """Stop playing, staying armed (for snooze)"""
+        if self._sound is not None:
+            self._sound.stop()
+
+    def disarm(self):
+        self.stop()
+        self._sound = None
+        self._channel = None
+        if pygame is not None and pygame.mixer.get_init() is not None:
+            pygame.mixer.quit()
@@ -0,0 +1,124 @@
+###################################################
+##### Interrupt driven buttons for clock.py #######
+###################################################
+
+############################
+##### Import Libraries #####
+############################
+from collections import deque, namedtuple
+from os import pipe, read, write
+from threading import Lock, Timer
+from select import select
+from time import time
+
+##########################
+##### Button timings #####
+##########################
+DEBOUNCE_TIME = 0.03 # Edges closer together than this are switch bounce (seconds)
+HOLD_TIME = 0.8 # A button held down this long starts sending hold events
+REPEAT_TIME = 0.15 # Time between hold events while the button stays down
+
+# Event kinds
+PRESS = "press"
+HOLD = "hold"
+WAKE = "wake"
+
+ButtonEvent = namedtuple("ButtonEvent", ["kind", "pins", "time"])
+
+#########################################################
+##### Turn GPIO edges into a queue of button events #####
+#########################################################
+class Buttons(object):
+    def __init__(self, gpio, pins):
+        self._gpio = gpio
+        self._lock = Lock()
+        self._events = deque()
+        self._read_fd, self._write_fd = pipe() # Lets wait() block in select() instead of polling
+        self._down = {} # pin -> time it was pressed
+        self._last_edge = {}
+        self._timers = {}
+        self._settling = set()
+        self.pins = tuple(pins)
+        for pin in self.pins:
+            self._last_edge[pin] = 0
+            gpio.setup(pin, gpio.IN)
+            gpio.add_event_detect(pin, gpio.BOTH, callback=self._edge)
+
+    def _put(self, kind, pins, when):
+        self._events.append(ButtonEvent(kind, pins, when))
+        write(self._write_fd, b"e") # One byte per event, wait() reads one back
+
+    # Called from the RPi.GPIO thread on every rising or falling edge
+    def _edge(self, pin):
+        now = time()
+        with self._lock:
+            if now - self._last_edge[pin] < DEBOUNCE_TIME:
+                # Still bouncing, look again once the switch has settled
+                if pin not in self._settling:
+                    self._settling.add(pin)
+                    self._start_timer(DEBOUNCE_TIME, self._settle, pin)
+                return
+
+            pressed = self._gpio.input(pin) == False # Buttons pull the pin low
+            if pressed == (pin in self._down):
+                return # Level did not change
+            self._last_edge[pin] = now
+
+            if pressed:
+                self._down[pin] = now
+                self._put(PRESS, (pin,), now)
+                self._timers[pin] = self._start_timer(HOLD_TIME, self._hold, pin)
+            else:
+                self._release(pin)
+
+    def _settle(self, pin):
+        with self._lock:
+            self._settling.discard(pin)
+            self._last_edge[pin] = 0
+        self._edge(pin)
+
+    def _hold(self, pin):
+        with self._lock:
+            if pin not in self._down:
+                return
+            if self._gpio.input(pin) != False: # Missed the release edge
+                self._release(pin)
+                return
+            self._put(HOLD, (pin,), time())
+            self._timers[pin] = self._start_timer(REPEAT_TIME, self._hold, pin)
+
+    def _release(self, pin):
+        self._down.pop(pin, None)
+        timer = self._timers.pop(pin, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _start_timer(self, delay, function, pin):
+        timer = Timer(delay, function, [pin])
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    #########################
+    ##### Reading input #####
+    #########################
+    def wait(self, timeout=None):
+        """Return the next ButtonEvent, or None if timeout seconds pass first"""
+        if timeout is not None and timeout < 0:
+            timeout = 0
+        readable = select([self._read_fd], [], [], timeout)[0]
+        if not readable:
+            return None
+        read(self._read_fd, 1)
+        return self._events.popleft()
+
+    def wake(self):
+        """Make a waiting wait() return early"""
+        self._put(WAKE, (), time())
+
+    def close(self):
+        for pin in self.pins:
+            self._gpio.remove_event_detect(pin)
+        with self._lock:
+            for pin in list(self._timers):
+                self._release(pin)
@@ -8,9 +8,11 @@
 #######################
 ##### User Config #####
 #######################
-# Alarm File location (Needs to be .wav file)
-alarm_file = "/home/pi/Clock-Pi/Clock/Air_Horn.wav"
+# Alarm File location (Needs to be .wav file, relative to the Clock folder or a full path)
+alarm_file = "Air_Horn.wav"
 alarm_volume_level = 80 # How loud should the alarm be (%)
+alarm_prearm_time = 30 # Seconds before an alarm that the sound is loaded and the speaker turned on
+alarm_fade_in_time = 0 # Seconds the alarm takes to get from silent to alarm_volume_level (0 starts at full volume)
 
 # Pin names (No longer than 6 characters)
 pin_twelve_name = "Pin 12" # Speaker relay pin
@@ -18,82 +20,38 @@ pin_eleven_name = "Pin 11" # This pin can turn off with a timer
 pin_ten_name = "Pin 10"
 pin_nine_name = "Pin 9"
 
+# What Game of Life does once the board starts repeating itself
+gol_on_cycle = "reseed" # "reseed" starts a new random board, "stop" shows a summary and goes back to the clock
+
 ############################
 ##### Import Libraries #####
 ############################
-from os import getuid, listdir, popen, system
-from psutil import cpu_percent, virtual_memory
+from time import time
+STARTED = time() # For the startup timings, before anything slow is imported
+from os import environ, getuid, path, rename, system
+import sys
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "..", "Shared")) # Modules shared with web.py
+from alarm_store import AlarmStore
+from relay_client import RelayClient, RelayError
+from sensors import get_up_stats, pi_sensors
+from metrics import MetricsStore
+import hal # The Pi's hardware, or stand-ins with CLOCK_PI_HAL=virtual
 from datetime import datetime, timedelta
+from scheduler import AlarmScheduler, monotonic
+from buttons import Buttons, PRESS, HOLD
+from menu import MenuMachine, Screen
+from alarm_sound import AlarmSound
+from volume import Volume
+from music_library import MusicLibrary
 from signal import signal, SIGTERM
-from random import choice, randint
-from papirus import Papirus
-from requests import head
 from PIL import ImageDraw
-from PIL import ImageFont
-import RPi.GPIO as GPIO
-from smbus import SMBus
-from time import sleep
+from glyph_cache import GlyphCache, LazyFont
 from PIL import Image
-import pygame.mixer
-
-#################################################
-##### Define class to get Raspberry Pi temp #####
-#################################################
-def get_cpu_temp():
-    with open("/sys/class/thermal/thermal_zone0/temp", "r") as tempfile:
-        cpu_temp = int(tempfile.read()) / 1000
-    cpu_temp = (cpu_temp * (9.0/5.0)) + 32.0
-    return str(cpu_temp)
-
-def get_gpu_temp():
-    with popen("/opt/vc/bin/vcgencmd measure_temp") as tempfile:
-        gpu_temp = int(tempfile.read().replace("temp=", "").split(".")[0])
-    gpu_temp = (gpu_temp * (9.0/5.0)) + 32.0
-    return str(gpu_temp)
-
-#########################################
-##### Define class to get LM75 temp #####
-#########################################
-LM75_ADDRESS = 0x48
-LM75_TEMP_REGISTER = 0
-LM75_CONF_REGISTER = 1
-LM75_THYST_REGISTER = 2
-LM75_TOS_REGISTER = 3
-LM75_CONF_SHUTDOWN = 0
-LM75_CONF_OS_COMP_INT = 1
-LM75_CONF_OS_POL = 2
-LM75_CONF_OS_F_QUE = 3
-
-class LM75(object):
-	def __init__(self, mode=LM75_CONF_OS_COMP_INT, address=LM75_ADDRESS, busnum=1):
-		self._mode = mode
-		self._address = address
-		self._bus = SMBus(busnum)
-
-	def regdata2float (self, regdata):
-		return (regdata / 32.0) / 8.0
-	def toFah(self, temp):
-		return (temp * (9.0/5.0)) + 32.0
-
-	def getTemp(self):
-		raw = self._bus.read_word_data(self._address, LM75_TEMP_REGISTER) & 0xFFFF
-		raw = ((raw << 8) & 0xFF00) + (raw >> 8)
-		return self.toFah(self.regdata2float(raw))
-
-	def getTempC(self):
-		raw = self._bus.read_word_data(self._address, LM75_TEMP_REGISTER) & 0xFFFF
-		raw = ((raw << 8) & 0xFF00) + (raw >> 8)
-		return self.regdata2float(raw)
-
-######################################
-##### Define class to get uptime #####
-######################################
-def get_up_stats():
-    with open('/proc/uptime', 'r') as f:
-        uptime_seconds = float(f.readline().split()[0])
-        uptime_string = str(timedelta(seconds = uptime_seconds))
-        uptime_string = uptime_string.split(".")[0]
-    return uptime_string
+# numpy (renderer.py, life.py), pygame (alarm_sound.py and the music screen) and psutil (sensors.py)
+# are imported the first time they are needed, so the panel shows a clock as soon as possible
+
+CLOCK_FOLDER = path.dirname(path.abspath(__file__))
+GPIO = hal.gpio() # RPi.GPIO
 
 ########################
 ##### Main program #####
@@ -103,31 +61,37 @@ def main():
     ######################################
     #### Check if we are run as root #####
     ######################################
-    if getuid() != 0:
+    if getuid() != 0 and not hal.VIRTUAL:
         raise Exception("Please run script as root")
 
+    #################################################
+    ##### Show the last clock while we start up #####
+    #################################################
+    panel = hal.papirus() # Connect to Papirus E-Ink Dislay
+    boot_frame = show_boot_frame(panel)
+    startup_mark("boot frame")
+
     #################################
     ##### Create and read files #####
     #################################
-    with open("/home/pi/Clock-Pi/Clock/alarm_data.csv", "r") as f: # Read alarm file
-        text = f.read()
-        words = text.split(",")
-        alarm_hour = int(words[0])
-        alarm_min = int(words[1])
-        alarm_set = bool(int(words[2]))
+    scheduler = AlarmScheduler() # Keeps track of when alarms and timers go off
+    alarm_store = AlarmStore() # Read alarm file
+    scheduler.set_alarms(alarm_store.alarms)
 
     #######################################
     ##### Start and connect to things #####
     #######################################
+    global relays
+    relays = RelayClient() # Connect to arduino_server.py, which owns the Arduino's serial port
     global papirus
-    papirus = Papirus() # Connect to Papirus E-Ink Dislay
-    sensor = LM75() # Connect to LM75 Temperature sensor
-    papirus.clear() # Clear Papirus E-Ink Display
+    from renderer import DirtyRenderer # numpy, which takes a while on a Pi Zero
+    papirus = DirtyRenderer(panel, shown=boot_frame) # Only push the parts of frames that changed from what is on the panel
+    sensors = pi_sensors() # Read the LM75 Temperature sensor, CPU and GPU in the background
+    metrics = MetricsStore() # History of the sensors, for the web page
 
     ###################################
     ##### Define button GPIO pins #####
     ###################################
-    global SW4
     SW1 = 16
     SW2 = 26
     SW3 = 20
@@ -137,10 +101,33 @@ def main():
     ##### Set GPIO #####
     ####################
     GPIO.setmode(GPIO.BCM)
-    GPIO.setup(SW1, GPIO.IN)
-    GPIO.setup(SW2, GPIO.IN)
-    GPIO.setup(SW3, GPIO.IN)
-    GPIO.setup(SW4, GPIO.IN)
+    buttons = Buttons(GPIO, (SW1, SW2, SW3, SW4)) # Button presses arrive through edge interrupts
+
+    # Load the alarm sound and turn the speaker on alarm_prearm_time seconds before each alarm
+    volume = Volume(level=80) # Set volume level, through ALSA when python-alsaaudio is installed
+    alarm_sound = AlarmSound(path.join(CLOCK_FOLDER, alarm_file), alarm_volume_level, volume, alarm_fade_in_time)
+    def schedule_prearm():
+        next_alarm = scheduler.next_alarm()
+        if next_alarm is None:
+            scheduler.cancel("prearm")
+        else:
+            scheduler.add_timer("prearm", next_alarm - timedelta(seconds=alarm_prearm_time))
+    schedule_prearm()
+
+    # Add the latest sensor readings to the history every few seconds
+    def record_metrics():
+        step = metrics.tiers[0][1]
+        metrics.append(sensors.latest(step * 2))
+        now = time()
+        scheduler.add_timer("metrics", datetime.fromtimestamp(now - now % step + step))
+    record_metrics()
+
+    # Reschedule as soon as the alarm file changes (from the menus or the web page)
+    def alarms_changed():
+        scheduler.set_alarms(alarm_store.alarms)
+        schedule_prearm()
+        buttons.wake() # Work out how long to sleep again
+    alarm_store.watch(alarms_changed)
 
     #######################################
     ##### Setup Papirus E-Ink Display #####
@@ -148,6 +135,8 @@ def main():
     global WHITE
     global BLACK
     global draw
+    global image
+    global glyphs
     global width
     global height
     global clock_font
@@ -158,1069 +147,415 @@ def main():
     image = Image.new("1", papirus.size, WHITE) # Create a blank display
     draw = ImageDraw.Draw(image)
     width, height = image.size
-    FONT_FILE = "/usr/share/fonts/truetype/freefont/FreeMono.ttf" # Define font file location
-    clock_font = ImageFont.truetype(FONT_FILE, 52) # Create fonts
-    menu_font = ImageFont.truetype(FONT_FILE, 15)
-    date_font = ImageFont.truetype(FONT_FILE, 25)
+    FONT_FILE = environ.get("CLOCK_PI_FONT", "/usr/share/fonts/truetype/freefont/FreeMono.ttf") # Define font file location
+    clock_font = LazyFont(FONT_FILE, 52) # Create fonts, only opened if text is not cached
+    menu_font = LazyFont(FONT_FILE, 15)
+    date_font = LazyFont(FONT_FILE, 25)
+    glyphs = GlyphCache(cache_file=path.join(CLOCK_FOLDER, "glyph_cache.bin")) # Rendered text, kept between runs
+    glyphs.load()
 
     ####################################
     ##### Define additional values #####
     ####################################
     lastMin = "00" # Create variable to store previous minute
-    timer = False # Create pin 9 timer variable
+    MUSIC_FOLDER = path.join(CLOCK_FOLDER, "..", "Music")
+    library = MusicLibrary(MUSIC_FOLDER, index_file=path.join(CLOCK_FOLDER, "music_index.json")) # Indexed the first time music is played
+
+    # Values the screens below change (Python 2 closures cannot assign to main()'s variables)
+    state = {
+        "volume": 80,
+        "ringing": False, # The alarm sound is loaded and the speaker is on
+        "due_at": None, # Monotonic time the alarm that is ringing was due
+        "ring_until": 0,
+        "snooze_until": 0,
+        "song": "Loading...",
+    }
+    edit = {} # The alarm being changed in the Set screen
+    game = {} # The Game of Life board while it runs
+
+    ############################
+    ##### Drawing a screen #####
+    ############################
+    def draw_screen(labels, message, partial):
+        display_time()
+        glyphs.text(image, (2, 10), labels, menu_font)
+        if message:
+            glyphs.text(image, (4, 40), message, menu_font)
+        papirus.display(image)
+        papirus.partial_update() # The renderer merges quick redraws and does a full refresh once ghosting builds up
+
+    def alarm_status():
+        alarm = alarm_store.first()
+        if alarm.enabled:
+            return "Alarm set for " + str(alarm.hour) + ":" + str(alarm.minute)
+        return "Alarm not set for " + str(alarm.hour) + ":" + str(alarm.minute)
+
+    def set_volume(menus, level):
+        state["volume"] = volume.set(level) # Written in the background, held buttons are merged into one write
+        menus.message = "Volume: " + str(state["volume"]) + "%"
+
+    #########################
+    ##### Alarm screens #####
+    #########################
+    def toggle_alarm(menus):
+        alarm = alarm_store.first()
+        alarm_store.set_first(alarm.hour, alarm.minute, not alarm.enabled)
+        return ("menu", alarm_status())
+
+    def start_edit(menus):
+        alarm = alarm_store.first()
+        edit.update(hour=alarm.hour, minute=alarm.minute, enabled=alarm.enabled, mode="hour")
+
+    def edit_message(menus):
+        return "(" + edit["mode"] + ") Hour: " + str(edit["hour"]) + " Min: " + str(edit["minute"])
+
+    def edit_select(menus):
+        edit["mode"] = "minute" if edit["mode"] == "hour" else "hour"
+
+    def edit_step(step):
+        def change(menus):
+            if edit["mode"] == "hour":
+                edit["hour"] = (edit["hour"] + step) % 24
+            else:
+                edit["minute"] = (edit["minute"] + step) % 60
+        return change
 
-    system("amixer cset numid=1 80% > /dev/null 2>&1") # Set volume level
-    volume_level = 80
+    def save_alarm(menus):
+        alarm_store.set_first(edit["hour"], edit["minute"], edit["enabled"])
+        return ("alarm", alarm_status())
 
+    def power_off(command, text):
+        def action(menus):
+            draw.rectangle((0, 0, width, height), fill=WHITE, outline=WHITE)
+            glyphs.text(image, (10, 70), text, date_font)
+            papirus.display(image)
+            papirus.update()
+            if hal.VIRTUAL:
+                print "Not running \"" + command + "\" on virtual hardware"
+            else:
+                system(command)
+            raise SystemExit
+        return action
+
+    ####################################
+    ##### Alarm ringing and snooze #####
+    ####################################
+    def ring_start(menus):
+        state["ring_until"] = monotonic() + 600 # Give up after ten minutes
+        if state["ringing"]:
+            alarm_sound.play() # Back from snooze, everything is still set up
+            return
+        if not alarm_sound.armed: # Not pre-armed, for example the test alarm
+            pin_change(12, "on") # Turn speaker on
+            if not alarm_sound.arm():
+                pin_change(12, "off")
+                return ("home", "Incorrect/missing audio file")
+        alarm_sound.play(state["due_at"])
+        pin_change((12, 11, 10, 9), "on") # Turn lights on (and the speaker, if something turned it off)
+        if state["due_at"] is not None:
+            print "Alarm sound started " + str(int(alarm_sound.latency * 1000)) + " ms after the alarm was due"
+            state["due_at"] = None
+        state["ringing"] = True
+
+    def ring_stop():
+        alarm_sound.disarm()
+        pin_change(12, "off")
+        volume.set(state["volume"])
+        state["ringing"] = False
+
+    def ring_tick(menus):
+        if monotonic() >= state["ring_until"]:
+            ring_stop()
+            return "home"
+
+    def ring_off(menus):
+        ring_stop()
+        return ("home", "Alarm turned off")
+
+    def snooze(menus):
+        alarm_sound.stop()
+        state["snooze_until"] = monotonic() + 300 # Five minutes
+        return "snoozed"
+
+    def snooze_tick(menus):
+        if monotonic() >= state["snooze_until"]:
+            return "ringing"
+
+    #########################
+    ##### Stuff screens #####
+    #########################
+    def life_start(start_type):
+        def action(menus):
+            game["life"], game["frames"] = gol_start(start_type)
+            return "life"
+        return action
+
+    def life_tick(menus):
+        summary = gol_step(game["life"], game["frames"])
+        if summary is not None:
+            return ("gol", summary)
+
+    def life_stop(menus):
+        print "Game of Life: " + str(game["life"].generation) + " generations, " + str(round(game["frames"].average_render * 1000, 2)) + " ms per frame to draw"
+
+    def music_start(menus):
+        import pygame.mixer # Loaded the first time music is played
+        pin_change(12, "on") # Turn speaker on
+        pygame.mixer.init() # Start pygame.mixer (Audio)
+        state["song"] = "Loading..."
+
+    def next_song(menus):
+        import pygame.mixer
+        track = library.next()
+        if track is None:
+            return ("stuff", "No music in the Music folder")
+        try:
+            pygame.mixer.music.load(track.path)
+        except pygame.error:
+            return ("stuff", "Incorrect audio file: " + track.name)
+        pygame.mixer.music.play()
+        state["song"] = track.title
+        menus.message = None # Show the song name again
+
+    def music_tick(menus):
+        import pygame.mixer
+        if pygame.mixer.music.get_busy() == False: # If sound stopped, start playing
+            result = next_song(menus)
+            if result is not None:
+                return result
+            menus.render(False)
+
+    def music_stop(menus):
+        import pygame.mixer
+        pygame.mixer.music.stop()
+        if not alarm_sound.armed: # Keep the mixer and speaker for an alarm that is about to go off
+            pygame.mixer.quit()
+            pin_change(12, "off")
+
+    ##########################
+    ##### Lights screens #####
+    ##########################
+    def switch(pins, change, screen, message, cancel_timer=False):
+        def action(menus):
+            if cancel_timer:
+                scheduler.cancel("timer")
+            pin_change(pins, change)
+            return (screen, message)
+        return action
+
+    def pin_eleven_timer(hours):
+        def action(menus):
+            off_at = datetime.now() + timedelta(hours=hours)
+            scheduler.add_timer("timer", off_at) # Turn pin 11 off later
+            pin_change(11, "on")
+            return ("lights_more", pin_eleven_name + " off at: " + off_at.strftime("%-I:%M %p"))
+        return action
+
+    ###################
+    ##### Screens #####
+    ###################
+    screens = {
+        "home": Screen(" Menu   Info   Stuff   Lights", {SW4: "menu", SW3: "info", SW2: "stuff", SW1: "lights"}, timeout=None),
+
+        # Menu
+        "menu": Screen(" Back  Alarm  Power", {SW4: "home", SW3: "alarm", SW2: "power"}),
+        "alarm": Screen(" Back  Toggle  Set  Status", {
+            SW4: "menu",
+            SW3: toggle_alarm,
+            SW2: "set_alarm",
+            SW1: lambda menus: ("menu", alarm_status()),
+        }),
+        "set_alarm": Screen(" Save  Select  Up  Down", {
+            SW4: save_alarm,
+            SW3: edit_select,
+            SW2: edit_step(1),
+            SW1: edit_step(-1),
+        }, message=edit_message, timeout=60, hold=True, enter=start_edit),
+        "power": Screen(" Back   Shutdown   Reboot", {
+            SW4: "menu",
+            SW3: power_off("shutdown -h 1", "Shutting Down!"),
+            SW2: power_off("shutdown -r 1", "Rebooting!"),
+        }),
+
+        # Info
+        "info": Screen(" Back   More   Temp", {SW4: "home", SW3: "info_more", SW2: "temp"}),
+        "info_more": Screen(" Back  CPU  RAM  Uptime", {
+            SW4: "info",
+            SW3: lambda menus: ("info", "CPU Usage: " + str(sensors.get("cpu_percent")) + "%"),
+            SW2: lambda menus: ("info", "RAM Usage: " + str(sensors.get("memory_percent")) + "%"),
+            SW1: lambda menus: ("info", "Uptime: " + get_up_stats()),
+        }),
+        "temp": Screen(" Back  CPU  GPU  LM75", {
+            SW4: "info",
+            SW3: lambda menus: ("info", "CPU Temp: " + sensors.get("cpu_temp") + "F"),
+            SW2: lambda menus: ("info", "GPU Temp: " + sensors.get("gpu_temp") + "F"),
+            SW1: lambda menus: ("info", "LM75 Sensor temp: " + str(sensors.get("lm75_temp")) + "F"),
+        }),
+
+        # Stuff
+        "stuff": Screen(" Back   GOL   Volume   Music", {SW4: "home", SW3: "gol", SW2: "volume", SW1: "music"}),
+        "gol": Screen(" Back   Random   Gosper   R", {
+            SW4: "stuff",
+            SW3: life_start("random"),
+            SW2: life_start("Gosper"), # Gosper Glider Gun
+            SW1: life_start("R-pentomino"),
+        }),
+        "life": Screen("", {SW4: "gol"}, timeout=None, tick=life_tick, tick_time=0, leave=life_stop, clock=False),
+        "volume": Screen(" Back   Test   Up   Down", {
+            SW4: "stuff",
+            SW3: "ringing", # Test alarm
+            SW2: lambda menus: set_volume(menus, state["volume"] + 2),
+            SW1: lambda menus: set_volume(menus, state["volume"] - 2),
+        }, hold=True),
+        "music": Screen(" Off    Skip    Up    Down", {
+            SW4: "stuff",
+            SW3: next_song,
+            SW2: lambda menus: set_volume(menus, state["volume"] + 2),
+            SW1: lambda menus: set_volume(menus, state["volume"] - 2),
+        }, message=lambda menus: "Song: " + state["song"],
+            timeout=None, hold=True, enter=music_start, leave=music_stop, tick=music_tick, tick_time=0.5),
+
+        # Lights
+        "lights": Screen(" Back  More  " + pin_ten_name + "   " + pin_nine_name, {
+            SW4: "home",
+            SW3: "lights_more",
+            SW2: switch(10, "toggle", "home", pin_ten_name + " toggled"),
+            SW1: switch(9, "toggle", "home", pin_nine_name + " toggled"),
+        }),
+        "lights_more": Screen(" Back  " + pin_eleven_name + "  " + pin_twelve_name + "   All", {
+            SW4: "lights",
+            SW3: "pin_eleven",
+            SW2: switch(12, "toggle", "lights", pin_twelve_name + " toggled"),
+            SW1: "all",
+        }),
+        "pin_eleven": Screen(" Back " + pin_eleven_name + " 1-Hour 2-Hours", {
+            SW4: "lights_more",
+            SW3: switch(11, "toggle", "lights_more", pin_eleven_name + " toggled", cancel_timer=True),
+            SW2: pin_eleven_timer(1),
+            SW1: pin_eleven_timer(2),
+        }),
+        "all": Screen(" Back   On   Off   Toggle", {
+            SW4: "lights_more",
+            SW3: switch((12, 11, 10, 9), "on", "lights_more", "All on", cancel_timer=True),
+            SW2: switch((12, 11, 10, 9), "off", "lights_more", " All off"),
+            SW1: switch((12, 11, 10, 9), "toggle", "lights_more", "All toggled"),
+        }),
+
+        # Alarm
+        "ringing": Screen(" Off    Snooze", {SW4: ring_off, SW3: snooze}, message="TURN OFF THE ALARM",
+            timeout=None, enter=ring_start, tick=ring_tick, tick_time=0.5),
+        "snoozed": Screen(" Back", {SW4: "ringing"}, message="Alarm snoozed", timeout=None, tick=snooze_tick),
+    }
+    menus = MenuMachine(screens, "home", draw_screen)
+    menus.refresh() # The clock as it is now, over the boot frame
+    lastMin = datetime.now().strftime("%-M")
+    startup_mark("clock drawn")
+    if boot_frame is None:
+        save_boot_frame()
+    startup_mark("ready")
+    print "Startup: " + ", ".join(name + " " + str(round(seconds, 2)) + " s" for name, seconds in startup_marks)
 
     #####################
     ##### Main loop #####
     #####################
     while True:
-        # Wait one second
-        sleep(1)
-
-        # Get current time
+        # Sleep until a button is pressed, the next minute starts, an alarm or timer is due,
+        # or the open screen has something to do
         now = datetime.now()
-        check_time = now.strftime("%-H%-M")
-        alt_check_time = now.strftime("%H%M")
-        thisMin = now.strftime("%-M")
-
-        ###############################
-        ##### Alarm functionality #####
-        ###############################
-        if alarm_set == True: # Is alarm set
-            if (check_time == str(alarm_hour) + str(alarm_min)) or (alt_check_time == str(alarm_hour) + str(alarm_min)): # Is it time for the alarm to go off
-                lastMin = "00" # Update display
-                ten_mins = 11 # Yes, eleven because we update display and subtract one immediately
-                pin_change(12, "on") # Turn speaker on
-                pin_change(11, "on")
-                pin_change(10, "on") # Turn lights on
-                pin_change(9, "on")
-                try:
-                    pygame.mixer.init() # Start pygame.mixer (Audio)
-                    pygame.mixer.music.load(alarm_file) # Load alarm sound
-                except pygame.error:
-                    alarm_set = False
-                    pin_change(12, "off")
-                    display_time()
-                    draw.text((2, 10), " Menu   Info   Stuff   Lights", fill=BLACK, font=menu_font)
-                    draw.text((4, 40), "Incorrect/missing audio file", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    break
-
-                system("amixer cset numid=1 " + str(alarm_volume_level) + "% > /dev/null 2>&1") # Set volume level
-                while ten_mins != 0:
-                    now = datetime.now()
-                    thisMin = now.strftime("%-M")
-
-                    # Update display
-                    if thisMin != lastMin:
-                        ten_mins -= 1
-                        display_time()
-                        draw.text((2, 10), " Off    Snooze", fill=BLACK, font=menu_font)
-                        draw.text((4, 40), "TURN OFF THE ALARM", fill=BLACK, font=menu_font)
-                        papirus.display(image)
-                        lastMin = thisMin
-                        papirus.update()
-
-                    # If sound stopped, start playing
-                    if pygame.mixer.music.get_busy() == False:
-                        pygame.mixer.music.play()
-
-                    # If alarm turned off, stop playing audio and exit
-                    if GPIO.input(SW4) == False:
-                        alarm_set = False
-                        pygame.mixer.music.stop()
-                        pygame.mixer.quit()
-                        display_time()
-                        draw.text((2, 10), " Menu   Info   Stuff   Lights", fill=BLACK, font=menu_font)
-                        draw.text((4, 40), "Alarm turned off", fill=BLACK, font=menu_font)
-                        papirus.display(image)
-                        papirus.update()
-                        system("amixer cset numid=1 " + str(volume_level) + "% > /dev/null 2>&1")
-                        break
-
-                    # If snoozed, stop playing audio and wait five minutes
-                    if GPIO.input(SW3) == False:
-                        pygame.mixer.music.stop()
-                        ten_mins = 11
-                        five_mins = 5
-                        lastMin = 0
-
-                        while five_mins != 0:
-                            now = datetime.now()
-                            thisMin = now.strftime("%-M")
-
-                            if thisMin != lastMin:
-                                five_mins -= 1
-                                display_time()
-                                draw.text((2, 10), " Back", fill=BLACK, font=menu_font)
-                                draw.text((4, 40), "Alarm snoozed", fill=BLACK, font=menu_font)
-                                papirus.display(image)
-                                lastMin = thisMin
-                                if "0" in thisMin:
-                                    papirus.update()
-                                else:
-                                    papirus.partial_update()
-
-                            # If back pressed, exit snooze
-                            if GPIO.input(SW4) == False:
-                                display_time()
-                                draw.text((2, 10), " Off    Snooze", fill=BLACK, font=menu_font)
-                                draw.text((4, 40), "TURN OFF THE ALARM", fill=BLACK, font=menu_font)
-                                papirus.display(image)
-                                lastMin = thisMin
-                                papirus.update()
-                                break
-
-                            sleep(1)
-
-                        lastMin = 0
-
-                pin_change(12, "off")
-
-
-        ###############################
-        ##### Timer functionality #####
-        ###############################
-        if timer == True:
-            if check_time == turn_off_led:
+        timeout = 60 - now.second - now.microsecond / 1000000.0
+        for next_event in (scheduler.time_until_next(), menus.time_until_tick()):
+            if next_event is not None:
+                timeout = min(timeout, next_event)
+        event = buttons.wait(timeout)
+
+        #############################
+        ##### Alarms and timers #####
+        #############################
+        due = scheduler.pop_due()
+        event_popped = monotonic()
+        for fired in due:
+
+            ###############################
+            ##### Timer functionality #####
+            ###############################
+            if fired.name == "timer":
                 pin_change(11, "off")
-                timer = False
+                continue
+
+            if fired.name == "metrics":
+                record_metrics()
+                continue
+
+            ##########################################
+            ##### Get ready for the coming alarm #####
+            ##########################################
+            if fired.name == "prearm":
+                if not alarm_sound.armed:
+                    pin_change(12, "on") # Turn speaker on, so the relay has settled before the sound starts
+                    if not alarm_sound.arm():
+                        print "Alarm sound could not be loaded: " + alarm_sound.error
+                        if menus.name == "home":
+                            menus.go("home", "Incorrect/missing audio file")
+                continue
+
+            ###############################
+            ##### Alarm functionality #####
+            ###############################
+            if fired.lateness > 1: # The loop was busy when the alarm was due
+                print "Alarm for " + fired.when.strftime("%-I:%M %p") + " went off " + str(int(fired.lateness)) + " seconds late"
+            if not fired.alarm.repeats:
+                alarm_store.disable(fired.alarm) # One-shot alarms turn themselves off
+            if menus.name not in ("ringing", "snoozed"): # Whatever screen is open
+                state["due_at"] = event_popped - fired.lateness
+                menus.go("ringing")
+            schedule_prearm() # For the alarm after this one
+
+        # Give the speaker back if the alarm that was armed for got turned off or moved
+        if alarm_sound.armed and not state["ringing"] and menus.name != "music":
+            next_alarm = scheduler.next_alarm()
+            if next_alarm is None or next_alarm - datetime.now() > timedelta(seconds=alarm_prearm_time + 5):
+                alarm_sound.disarm()
+                pin_change(12, "off")
 
         ##########################
         ##### Update display #####
         ##########################
+        thisMin = datetime.now().strftime("%-M")
         if thisMin != lastMin:
-            display_time()
-            draw.text((2, 10), " Menu   Info   Stuff   Lights", fill=BLACK, font=menu_font)
-            papirus.display(image)
             lastMin = thisMin
-            if "0" in thisMin:
-                papirus.update()
-            else:
-                papirus.partial_update()
-
-            if "30" == thisMin:
-                with open("/home/pi/Clock-Pi/Clock/alarm_data.csv", "r") as f:
-                    text = f.read()
-                    words = text.split(",")
-                    alarm_hour = int(words[0])
-                    alarm_min = int(words[1])
-                    alarm_set = bool(int(words[2]))
-
+            menus.refresh()
+
+            if "0" == thisMin:
+                if glyphs.dirty:
+                    glyphs.save() # Save newly rendered text once an hour
+                if menus.name == "home":
+                    save_boot_frame() # Shown while the clock starts next time
+                stats = menus.stats()
+                print "Menus: " + str(stats["presses"]) + " presses, " + str(int(stats["latency_average"] * 1000)) + " ms average to redraw. Alarms: " + str(scheduler.fired_count) + " went off, " + str(scheduler.missed_count) + " missed"
+                panel = papirus.stats()
+                print "Panel: " + str(panel["full_updates"]) + " full (" + str(panel["budget_updates"]) + " for ghosting), " + str(panel["partial_updates"]) + " partial, " + str(panel["coalesced"]) + " draws merged, " + str(int(panel["push_time"])) + " s updating"
 
         ################################
         ##### Button functionality #####
         ################################
+        if event is not None and (event.kind == PRESS or (event.kind == HOLD and menus.screen.hold)):
+            menus.press(event.pins[0], event.time)
+        menus.tick()
 
-        ########################################################################
-        ##### Menu #####
-        ################
-        if GPIO.input(SW4) == False:
-            display_time()
-            draw.text((2, 10), " Back  Alarm  Power", fill=BLACK, font=menu_font)
-            papirus.display(image)
-            papirus.update()
-            count = 0
-            while (count < 30):
-
-                ################
-                ##### Back #####
-                ################
-                if GPIO.input(SW4) == False:
-                    display_time()
-                    draw.text((2, 10), " Menu   Info   Stuff   Lights", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    break
-
-                #################
-                ##### Alarm #####
-                #################
-                if GPIO.input(SW3) == False:
-                    display_time()
-                    draw.text((2, 10), " Back  Toggle  Set  Status", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    count = 0
-                    while (count < 30):
-
-                        ################
-                        ##### Back #####
-                        ################
-                        if GPIO.input(SW4) == False:
-                            display_time()
-                            draw.text((2, 10), " Back  Alarm  Power", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        ##################
-                        ##### Toggle #####
-                        ##################
-                        if GPIO.input(SW3) == False:
-                            with open("/home/pi/Clock-Pi/Clock/alarm_data.csv", "r") as f:
-                                text = f.read()
-                                words = text.split(",")
-                                alarm_hour = int(words[0])
-                                alarm_min = int(words[1])
-                                alarm_set = bool(int(words[2]))
-                            display_time()
-                            draw.text((2, 10), " Back  Alarm  Power", fill=BLACK, font=menu_font)
-                            if alarm_set == True:
-                                alarm_set = False
-                                with open("/home/pi/Clock-Pi/Clock/alarm_data.csv", "w") as f:
-                                    f.seek(0)
-                                    new_text = str(alarm_hour) + "," + str(alarm_min) + ",0"
-                                    f.write(new_text)
-                                draw.text((4, 40), "Alarm not set for " + str(alarm_hour) + ":" + str(alarm_min), fill=BLACK, font=menu_font)
-                            elif alarm_set == False:
-                                alarm_set = True
-                                with open("/home/pi/Clock-Pi/Clock/alarm_data.csv", "w") as f:
-                                    f.seek(0)
-                                    new_text = str(alarm_hour) + "," + str(alarm_min) + ",1"
-                                    f.write(new_text)
-                                draw.text((4, 40), "Alarm set for " + str(alarm_hour) + ":" + str(alarm_min), fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        #####################
-                        ##### Set alarm #####
-                        #####################
-                        if GPIO.input(SW2) == False:
-                            with open("/home/pi/Clock-Pi/Clock/alarm_data.csv", "r") as f:
-                                text = f.read()
-                                words = text.split(",")
-                                alarm_hour = int(words[0])
-                                alarm_min = int(words[1])
-                                alarm_set = bool(int(words[2]))
-
-                            set_mode = "hour"
-                            display_time()
-                            draw.text((2, 10), " Save  Select  Up  Down", fill=BLACK, font=menu_font)
-                            draw.text((4, 40), "(" + set_mode + ") Hour: " + str(alarm_hour) + " Min: " + str(alarm_min), fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            count = 0
-                            while (count < 600):
-
-                                ################
-                                ##### Save #####
-                                ################
-                                if GPIO.input(SW4) == False:
-
-                                    display_time()
-                                    draw.text((2, 10), " Back  Toggle  Set  Status", fill=BLACK, font=menu_font)
-
-                                    if alarm_set == True:
-                                        with open("/home/pi/Clock-Pi/Clock/alarm_data.csv", "w") as f:
-                                            f.seek(0)
-                                            new_text = str(alarm_hour) + "," + str(alarm_min) + ",1"
-                                            f.write(new_text)
-                                        draw.text((4, 40), "Alarm set for " + str(alarm_hour) + ":" + str(alarm_min), fill=BLACK, font=menu_font)
-                                    elif alarm_set == False:
-                                        with open("/home/pi/Clock-Pi/Clock/alarm_data.csv", "w") as f:
-                                            f.seek(0)
-                                            new_text = str(alarm_hour) + "," + str(alarm_min) + ",0"
-                                            f.write(new_text)
-                                        draw.text((4, 40), "Alarm not set for " + str(alarm_hour) + ":" + str(alarm_min), fill=BLACK, font=menu_font)
-
-                                    papirus.display(image)
-                                    papirus.update()
-                                    break
-
-                                ##################
-                                ##### Select #####
-                                ##################
-                                if GPIO.input(SW3) == False:
-                                    if set_mode == "hour":
-                                        set_mode = "minute"
-                                    elif set_mode == "minute":
-                                        set_mode = "hour"
-
-                                    display_time()
-                                    draw.text((2, 10), " Save  Select  Up  Down", fill=BLACK, font=menu_font)
-                                    draw.text((4, 40), "(" + set_mode + ") Hour: " + str(alarm_hour) + " Min: " + str(alarm_min), fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.partial_update()
-                                    count = 0
-
-                                # Time up
-                                if GPIO.input(SW2) == False:
-                                    display_time()
-                                    draw.text((2, 10), " Save  Select  Up  Down", fill=BLACK, font=menu_font)
-                                    if set_mode == "hour":
-                                        alarm_hour += 1
-                                        if alarm_hour > 24:
-                                            alarm_hour = 1
-                                    elif set_mode == "minute":
-                                        alarm_min += 1
-                                        if alarm_min > 60:
-                                            alarm_min = 00
-
-                                    draw.text((4, 40), "(" + set_mode + ") Hour: " + str(alarm_hour) + " Min: " + str(alarm_min), fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.partial_update()
-                                    count = 0
-
-                                # Time Down
-                                if GPIO.input(SW1) == False:
-                                    display_time()
-                                    draw.text((2, 10), " Save  Select  Up  Down", fill=BLACK, font=menu_font)
-                                    if set_mode == "hour":
-                                        alarm_hour -= 1
-                                        if alarm_hour < 1:
-                                            alarm_hour = 24
-                                    elif set_mode == "minute":
-                                        alarm_min -= 1
-                                        if alarm_min < 0:
-                                            alarm_min = 60
-
-                                    draw.text((4, 40), "(" + set_mode + ") Hour: " + str(alarm_hour) + " Min: " + str(alarm_min), fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.partial_update()
-                                    count = 0
-
-
-                                sleep(0.1)
-                                count = count + 1
-
-
-                        ##################
-                        ##### Status #####
-                        ##################
-                        if GPIO.input(SW1) == False:
-                            with open("/home/pi/Clock-Pi/Clock/alarm_data.csv", "r") as f:
-                                text = f.read()
-                                words = text.split(",")
-                                alarm_hour = int(words[0])
-                                alarm_min = int(words[1])
-                                alarm_set = bool(int(words[2]))
-                            display_time()
-                            draw.text((2, 10), " Back  Alarm  Power", fill=BLACK, font=menu_font)
-                            if alarm_set == True:
-                                draw.text((4, 40), "Alarm set for " + str(alarm_hour) + ":" + str(alarm_min), fill=BLACK, font=menu_font)
-                            elif alarm_set == False:
-                                draw.text((4, 40), "Alarm not set for " + str(alarm_hour) + ":" + str(alarm_min), fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        sleep(1)
-                        count = count + 1
-
-                ###################
-                ###### Power ######
-                ###################
-                if GPIO.input(SW2) == False:
-                    display_time()
-                    draw.text((2, 10), " Back   Shutdown   Reboot", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    count = 0
-                    while (count < 30):
-
-                        ################
-                        ##### Back #####
-                        ################
-                        if GPIO.input(SW4) == False:
-                            display_time()
-                            draw.text((2, 10), " Back  Alarm  Power", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        ####################
-                        ##### Shutdown #####
-                        ####################
-                        if GPIO.input(SW3) == False:
-                            draw.rectangle((0, 0, width, height), fill=WHITE, outline=WHITE)
-                            draw.text((10, 70), "Shutting Down!", fill=BLACK, font=date_font)
-                            papirus.display(image)
-                            papirus.update()
-                            system("shutdown -h 1") # Shutdown
-                            raise SystemExit
-
-                        ##################
-                        ##### Reboot #####
-                        ##################
-                        if GPIO.input(SW2) == False:
-                            draw.rectangle((0, 0, width, height), fill=WHITE, outline=WHITE)
-                            draw.text((10, 70), "Rebooting!", fill=BLACK, font=date_font)
-                            papirus.display(image)
-                            papirus.update()
-                            system("shutdown -r 1") # Reboot
-                            raise SystemExit
-
-                        sleep(1)
-                        count = count + 1
-
-                sleep(1)
-                count = count + 1
-
-        ########################################################################
-        ##### Info #####
-        ################
-        if GPIO.input(SW3) == False:
-            display_time()
-            draw.text((2, 10), " Back   More   Temp", fill=BLACK, font=menu_font)
-            papirus.display(image)
-            papirus.update()
-            count = 0
-            while (count < 30):
-
-                ################
-                ##### Back #####
-                ################
-                if GPIO.input(SW4) == False:
-                    display_time()
-                    draw.text((2, 10), " Menu   Info   Stuff   Lights", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    break
-
-                ################
-                ##### More #####
-                ################
-                if GPIO.input(SW3) == False:
-                    display_time()
-                    draw.text((2, 10), " Back  CPU  RAM  Uptime", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    count = 0
-                    while (count < 30):
-
-                        ################
-                        ##### Back #####
-                        ################
-                        if GPIO.input(SW4) == False:
-                            display_time()
-                            draw.text((2, 10), " Back   More   Temp", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        #####################
-                        ##### CPU Usage #####
-                        #####################
-                        if GPIO.input(SW3) == False:
-                            display_time()
-                            draw.text((2, 10), " Back   More   Temp", fill=BLACK, font=menu_font)
-                            draw.text((4, 40), "CPU Usage: "+ str(cpu_percent()) + "%", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        ############################
-                        ##### RAM/Memory usage #####
-                        ############################
-                        if GPIO.input(SW2) == False:
-                            display_time()
-                            memory = virtual_memory() # Get virtual memory usage
-                            draw.text((2, 10), " Back   More   Temp", fill=BLACK, font=menu_font)
-                            draw.text((4, 40), "RAM Usage: " + str(memory.percent) + "%", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        ##################
-                        ##### Uptime #####
-                        ##################
-                        if GPIO.input(SW1) == False:
-                            display_time()
-                            draw.text((2, 10), " Back   More   Temp", fill=BLACK, font=menu_font)
-                            draw.text((4, 40), "Uptime: " + get_up_stats(), fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        sleep(1)
-                        count = count + 1
-
-                ################
-                ##### Temp #####
-                ################
-                if GPIO.input(SW2) == False:
-                    display_time()
-                    draw.text((2, 10), " Back  CPU  GPU  LM75", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    count = 0
-                    while (count < 30):
-
-                        ################
-                        ##### Back #####
-                        ################
-                        if GPIO.input(SW4) == False:
-                            display_time()
-                            draw.text((2, 10), " Back   More   Temp", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        ####################
-                        ##### CPU Temp #####
-                        ####################
-                        if GPIO.input(SW3) == False:
-                            display_time()
-                            draw.text((2, 10), " Back   More   Temp", fill=BLACK, font=menu_font)
-                            draw.text((4, 40), "CPU Temp: " + get_cpu_temp() + "F", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        ####################
-                        ##### GPU Temp #####
-                        ####################
-                        if GPIO.input(SW2) == False:
-                            display_time()
-                            draw.text((2, 10), " Back   More   Temp", fill=BLACK, font=menu_font)
-                            draw.text((4, 40), "GPU Temp: " + get_gpu_temp() + "F", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        #####################
-                        ##### LM75 Temp #####
-                        #####################
-                        if GPIO.input(SW1) == False:
-                            display_time()
-                            draw.text((2, 10), " Back   More   Temp", fill=BLACK, font=menu_font)
-                            draw.text((4, 40), "LM75 Sensor temp: " + str(sensor.getTemp()) + "F", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        sleep(1)
-                        count = count + 1
-
-                sleep(1)
-                count = count + 1
-
-        ########################################################################
-        ##### Stuff #####
-        #################
-        if GPIO.input(SW2) == False:
-            display_time()
-            draw.text((2, 10), " Back   GOL   Volume   Music", fill=BLACK, font=menu_font)
-            papirus.display(image)
-            papirus.update()
-            count = 0
-            while (count < 30):
-
-                ################
-                ##### Back #####
-                ################
-                if GPIO.input(SW4) == False:
-                    display_time()
-                    draw.text((2, 10), " Menu   Info   Stuff   Lights", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    break
-
-                ########################
-                ##### Game Of Life #####
-                ########################
-                if GPIO.input(SW3) == False:
-                    display_time()
-                    draw.text((2, 10), " Back   Random   Gosper   R", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    count = 0
-                    while (count < 30):
-
-                        ################
-                        ##### Back #####
-                        ################
-                        if GPIO.input(SW4) == False:
-                            display_time()
-                            draw.text((2, 10), " Back   GOL   Volume   Music", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        if GPIO.input(SW3) == False:
-                            papirus_gol("random") # Random
-
-                        if GPIO.input(SW2) == False:
-                            papirus_gol("Gosper") # Gosper Glider Gun
-
-                        if GPIO.input(SW1) == False: # R-Pentomino
-                            papirus_gol("R-pentomino")
-
-                        sleep(1)
-                        count = count + 1
-
-                ##################
-                ##### Volume #####
-                ##################
-                if GPIO.input(SW2) == False:
-                    display_time()
-                    draw.text((2, 10), " Back   Test   Up   Down", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    count = 0
-                    while (count < 60):
-
-                        ################
-                        ##### Back #####
-                        ################
-                        if GPIO.input(SW4) == False:
-                            display_time()
-                            draw.text((2, 10), " Back   GOL   Volume   Music", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        ######################
-                        ##### Test Alarm #####
-                        ######################
-                        if GPIO.input(SW3) == False:
-                            lastMin = "00" # Update display
-                            ten_mins = 11 # Yes, eleven because we update display and subtract one immediately
-                            pin_change(12, "on") # Turn speaker on
-                            pin_change(11, "on")
-                            pin_change(10, "on") # Turn lights on
-                            pin_change(9, "on")
-                            try:
-                                pygame.mixer.init() # Start pygame.mixer (Audio)
-                                pygame.mixer.music.load(alarm_file) # Load alarm sound
-                            except pygame.error:
-                                pin_change(12, "off")
-                                display_time()
-                                draw.text((2, 10), " Menu   Info   Stuff   Lights", fill=BLACK, font=menu_font)
-                                draw.text((4, 40), "Incorrect/missing audio file", fill=BLACK, font=menu_font)
-                                papirus.display(image)
-                                papirus.update()
-                                break
-
-                            system("amixer cset numid=1 " + str(alarm_volume_level) + "% > /dev/null 2>&1") # Set volume level
-                            while ten_mins != 0:
-                                now = datetime.now()
-                                thisMin = now.strftime("%-M")
-
-                                # Update display
-                                if thisMin != lastMin:
-                                    ten_mins -= 1
-                                    display_time()
-                                    draw.text((2, 10), " Off    Snooze", fill=BLACK, font=menu_font)
-                                    draw.text((4, 40), "TURN OFF THE ALARM", fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    lastMin = thisMin
-                                    papirus.update()
-
-                                # If sound stopped, start playing
-                                if pygame.mixer.music.get_busy() == False:
-                                    pygame.mixer.music.play()
-
-                                # If alarm turned off, stop playing audio and exit
-                                if GPIO.input(SW4) == False:
-                                    pygame.mixer.music.stop()
-                                    pygame.mixer.quit()
-                                    display_time()
-                                    draw.text((2, 10), " Menu   Info   Stuff   Lights", fill=BLACK, font=menu_font)
-                                    draw.text((4, 40), "Alarm turned off", fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.update()
-                                    system("amixer cset numid=1 " + str(volume_level) + "% > /dev/null 2>&1")
-                                    break
-
-                                # If snoozed, stop playing audio and wait five minutes
-                                if GPIO.input(SW3) == False:
-                                    pygame.mixer.music.stop()
-                                    ten_mins = 11
-                                    five_mins = 5
-                                    lastMin = 0
-
-                                    while five_mins != 0:
-                                        now = datetime.now()
-                                        thisMin = now.strftime("%-M")
-
-                                        if thisMin != lastMin:
-                                            five_mins -= 1
-                                            display_time()
-                                            draw.text((2, 10), " Back", fill=BLACK, font=menu_font)
-                                            draw.text((4, 40), "Alarm snoozed", fill=BLACK, font=menu_font)
-                                            papirus.display(image)
-                                            lastMin = thisMin
-                                            if "0" in thisMin:
-                                                papirus.update()
-                                            else:
-                                                papirus.partial_update()
-
-                                        # If back pressed, exit snooze
-                                        if GPIO.input(SW4) == False:
-                                            display_time()
-                                            draw.text((2, 10), " Off    Snooze", fill=BLACK, font=menu_font)
-                                            draw.text((4, 40), "TURN OFF THE ALARM", fill=BLACK, font=menu_font)
-                                            papirus.display(image)
-                                            lastMin = thisMin
-                                            papirus.update()
-                                            break
-
-                                        sleep(1)
-
-                                    lastMin = 0
-
-                            pin_change(12, "off")
-
-                        #####################
-                        ##### Volume Up #####
-                        #####################
-                        if GPIO.input(SW2) == False:
-                            count = 0
-                            volume_level +=+ 2
-                            if volume_level > 100:
-                                volume_level = 100
-                            system("amixer cset numid=1 " + str(volume_level) + "% > /dev/null 2>&1")
-                            volume_level_string = "Volume: " + str(volume_level) + "%"
-                            display_time()
-                            draw.text((2, 10), " Back   Test   Up   Down", fill=BLACK, font=menu_font)
-                            draw.text((4, 40), volume_level_string, fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.partial_update()
-
-                        #######################
-                        ##### Volume Down #####
-                        #######################
-                        if GPIO.input(SW1) == False:
-                            count = 0
-                            volume_level -= 2
-                            if volume_level < 0:
-                                volume_level = 0
-                            system("amixer cset numid=1 " + str(volume_level) + "% > /dev/null 2>&1")
-                            volume_level_string = "Volume: " + str(volume_level) + "%"
-                            display_time()
-                            draw.text((2, 10), " Back   Test   Up   Down", fill=BLACK, font=menu_font)
-                            draw.text((4, 40), volume_level_string, fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.partial_update()
-
-                        sleep(0.5)
-                        count = count + 1
-
-                #################
-                ##### Music #####
-                #################
-                if GPIO.input(SW1) == False:
-                    pin_change(12, "on") # Turn speaker on
-                    audio_file = "Loading..."
-                    lastMin = "00" # Update display
-                    pygame.mixer.init() # Start pygame.mixer (Audio)
-                    while True:
-                        now = datetime.now()
-                        thisMin = now.strftime("%-M")
-                        if thisMin != lastMin:
-                            display_time()
-                            draw.text((2, 10), " Off    Skip    Up    Down", fill=BLACK, font=menu_font)
-                            song_name = str(audio_file.split(".wav")[0])
-                            draw.text((4, 40), "Song: " + song_name, fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            lastMin = thisMin
-                            papirus.update()
-                            sleep(0.5)
-
-                        # If sound stopped, start playing
-                        if pygame.mixer.music.get_busy() == False:
-                            sleep(1)
-                            try:
-                                audio_file = choice(listdir("/home/pi/Clock-Pi/Music/"))
-                                random_audio_file = "/home/pi/Clock-Pi/Music/" + audio_file
-                                pygame.mixer.music.load(random_audio_file)
-                            except pygame.error:
-                                pin_change(11, "off")
-                                display_time()
-                                draw.text((2, 10), " Back   GOL   Volume   Music", fill=BLACK, font=menu_font)
-                                draw.text((4, 40), "Incorrect/missing audio file", fill=BLACK, font=menu_font)
-                                papirus.display(image)
-                                papirus.update()
-                                break
-                            pygame.mixer.music.play()
-                            lastMin = "00"
-
-                        # If sound turned off, stop playing audio and exit
-                        if GPIO.input(SW4) == False:
-                            pin_change(11, "off")
-                            pygame.mixer.music.stop()
-                            pygame.mixer.quit()
-                            display_time()
-                            draw.text((2, 10), " Back   GOL   Volume   Music", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        # Skip song
-                        if GPIO.input(SW3) == False:
-                            pygame.mixer.music.stop()
-                            audio_file = choice(listdir("/home/pi/Clock-Pi/Music/"))
-                            random_audio_file = "/home/pi/Clock-Pi/Music/" + audio_file
-                            pygame.mixer.music.load(random_audio_file)
-                            pygame.mixer.music.play()
-                            lastMin = "00"
-
-                        # Volume Up
-                        if GPIO.input(SW2) == False:
-                            volume_level += 2
-                            if volume_level > 100:
-                                volume_level = 100
-                            system("amixer cset numid=1 " + str(volume_level) + "% > /dev/null 2>&1")
-                            volume_level_string = "Volume: " + str(volume_level) + "%"
-                            display_time()
-                            draw.text((2, 10), " Off    Skip    Up    Down", fill=BLACK, font=menu_font)
-                            draw.text((4, 40), volume_level_string, fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.partial_update()
-
-                        # Volume Down
-                        if GPIO.input(SW1) == False:
-                            volume_level -= 2
-                            if volume_level < 0:
-                                volume_level = 0
-                            system("amixer cset numid=1 " + str(volume_level) + "% > /dev/null 2>&1")
-                            volume_level_string = "Volume: " + str(volume_level) + "%"
-                            display_time()
-                            draw.text((2, 10), " Off    Skip    Up    Down", fill=BLACK, font=menu_font)
-                            draw.text((4, 40), volume_level_string, fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.partial_update()
-
-                sleep(1)
-                count = count + 1
-
-        ########################################################################
-        ##### Lights #####
-        ##################
-        if GPIO.input(SW1) == False:
-            display_time()
-            draw.text((2, 10), " Back  More  " + pin_ten_name + "   " +  pin_nine_name, fill=BLACK, font=menu_font)
-            papirus.display(image)
-            papirus.update()
-            count = 0
-            while (count < 30):
-
-                ################
-                ##### Back #####
-                ################
-                if GPIO.input(SW4) == False:
-                    display_time()
-                    draw.text((2, 10), " Menu   Info   Stuff   Lights", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    break
-
-                ################
-                ##### More #####
-                ################
-                if GPIO.input(SW3) == False:
-                    display_time()
-                    draw.text((2, 10), " Back  " + pin_eleven_name + "  " + pin_twelve_name + "   All", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    count = 0
-                    while (count < 30):
-
-                        ################
-                        ##### Back #####
-                        ################
-                        if GPIO.input(SW4) == False:
-                            display_time()
-                            draw.text((2, 10), " Back  More  " + pin_ten_name + "   " +  pin_nine_name, fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            break
-
-                        ######################
-                        ##### Pin Eleven #####
-                        ######################
-                        if GPIO.input(SW3) == False:
-                            display_time()
-                            draw.text((2, 10), " Back " + pin_eleven_name + " 1-Hour 2-Hours", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            count = 0
-                            while (count < 30):
-
-                                ################
-                                ##### Back #####
-                                ################
-                                if GPIO.input(SW4) == False:
-                                    display_time()
-                                    draw.text((2, 10), " Back  " + pin_eleven_name + "  " + pin_twelve_name + "   All", fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.update()
-                                    break
-
-                                #############################
-                                ##### Pin eleven toggle #####
-                                #############################
-                                if GPIO.input(SW3) == False:
-                                    display_time()
-                                    draw.text((2, 10), " Back  " + pin_eleven_name + "  " + pin_twelve_name + "   All", fill=BLACK, font=menu_font)
-                                    draw.text((4, 40), pin_eleven_name + " toggled", fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.update()
-                                    timer = False
-                                    pin_change(11, "toggle")
-                                    break
-
-                                ##########################
-                                ##### One-hour timer #####
-                                ##########################
-                                if GPIO.input(SW2) == False:
-                                    timer = True
-                                    one_hour_from_now = datetime.now() + timedelta(hours=1)
-                                    turn_off_led = one_hour_from_now.strftime("%-H%-M")
-                                    display_time()
-                                    draw.text((2, 10), " Back  " + pin_eleven_name + "  " + pin_twelve_name + "   All", fill=BLACK, font=menu_font)
-                                    draw.text((4, 40), pin_eleven_name + " off at: " + one_hour_from_now.strftime("%-I:%M %p"), fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.update()
-                                    pin_change(11, "on")
-                                    break
-
-                                ##########################
-                                ##### Two-hour timer #####
-                                ##########################
-                                if GPIO.input(SW1) == False:
-                                    timer = True
-                                    two_hours_from_now = datetime.now() + timedelta(hours=2)
-                                    turn_off_led = two_hours_from_now.strftime("%-H%-M")
-                                    display_time()
-                                    draw.text((2, 10), " Back  " + pin_eleven_name + "  " + pin_twelve_name + "   All", fill=BLACK, font=menu_font)
-                                    draw.text((4, 40), pin_eleven_name + " off at: " + two_hours_from_now.strftime("%-I:%M %p"), fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.update()
-                                    pin_change(11, "on")
-                                    break
-
-                                sleep(1)
-                                count = count + 1
-
-                        ######################
-                        ##### Pin Twelve #####
-                        ######################
-                        if GPIO.input(SW2) == False:
-                            display_time()
-                            draw.text((2, 10), " Back  More  " + pin_ten_name + "   " +  pin_nine_name, fill=BLACK, font=menu_font)
-                            draw.text((4, 40), pin_twelve_name + " toggled", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            pin_change(12, "toggle")
-                            break
-
-                        ###############
-                        ##### All #####
-                        ###############
-                        if GPIO.input(SW1) == False:
-                            display_time()
-                            draw.text((2, 10), " Back   On   Off   Toggle", fill=BLACK, font=menu_font)
-                            papirus.display(image)
-                            papirus.update()
-                            count = 0
-                            while (count < 30):
-
-                                ################
-                                ##### Back #####
-                                ################
-                                if GPIO.input(SW4) == False:
-                                    display_time()
-                                    draw.text((2, 10), " Back  " + pin_eleven_name + "  " + pin_twelve_name + "   All", fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.update()
-                                    break
-
-                                ##################
-                                ##### All on #####
-                                ##################
-                                if GPIO.input(SW3) == False:
-                                    display_time()
-                                    draw.text((2, 10), " Back  " + pin_eleven_name + "  " + pin_twelve_name + "   All", fill=BLACK, font=menu_font)
-                                    draw.text((4, 40), "All on", fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.update()
-                                    timer = False
-                                    pin_change(12, "on")
-                                    pin_change(11, "on")
-                                    pin_change(10, "on")
-                                    pin_change(9, "on")
-                                    break
-
-                                ###################
-                                ##### All off #####
-                                ###################
-                                if GPIO.input(SW2) == False:
-                                    display_time()
-                                    draw.text((2, 10), " Back  " + pin_eleven_name + "  " + pin_twelve_name + "   All", fill=BLACK, font=menu_font)
-                                    draw.text((4, 40), " All off", fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.update()
-                                    pin_change(12, "off")
-                                    pin_change(11, "off")
-                                    pin_change(10, "off")
-                                    pin_change(9, "off")
-                                    break
-
-                                ######################
-                                ##### All toggle #####
-                                ######################
-                                if GPIO.input(SW1) == False:
-                                    display_time()
-                                    draw.text((2, 10), " Back  " + pin_eleven_name + "  " + pin_twelve_name + "   All", fill=BLACK, font=menu_font)
-                                    draw.text((4, 40), "All toggled", fill=BLACK, font=menu_font)
-                                    papirus.display(image)
-                                    papirus.update()
-                                    pin_change(12, "toggle")
-                                    pin_change(11, "toggle")
-                                    pin_change(10, "toggle")
-                                    pin_change(9, "toggle")
-                                    break
-
-                                sleep(1)
-                                count = count + 1
-
-                        sleep(1)
-                        count = count + 1
-
-                ##########################
-                ##### Pin ten toggle #####
-                ##########################
-                if GPIO.input(SW2) == False:
-                    display_time()
-                    draw.text((2, 10), " Menu   Info   Stuff   Lights", fill=BLACK, font=menu_font)
-                    draw.text((4, 40), pin_ten_name + " toggled", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    pin_change(10, "toggle")
-                    break
-
-                ##########################
-                ##### Pin nine toggle ####
-                ##########################
-                if GPIO.input(SW1) == False:
-                    display_time()
-                    draw.text((2, 10), " Menu   Info   Stuff   Lights", fill=BLACK, font=menu_font)
-                    draw.text((4, 40), pin_nine_name + " toggled", fill=BLACK, font=menu_font)
-                    papirus.display(image)
-                    papirus.update()
-                    pin_change(9, "toggle")
-                    break
-
-                sleep(1)
-                count = count + 1
-
-################################################################################
+###############################
 ##### End of main program #####
 ###############################
 
 ######################
 ##### Pin change #####
 ######################
-def pin_change(pin, change):
-    head("http://127.0.0.1/api/" + change + "/" + str(pin) + "/")
+def pin_change(pins, change):
+    if isinstance(pins, int):
+        pins = (pins,)
+    try:
+        relays.request(change, *pins) # Returns once the Arduino has the command
+    except RelayError as e:
+        print e # Keep going, the alarm still needs to sound
 
 ########################
 ##### Display Time #####
@@ -1231,180 +566,67 @@ def display_time():
     dateString = now.strftime("%a %b %-d")
     abv_dateString = now.strftime("%-m/%-d/%y")
     draw.rectangle((0, 0, width, height), fill=WHITE, outline=WHITE)
-    draw.text((5, 70), timeString, fill=BLACK, font=clock_font)
-    draw.text((10, 120), dateString, fill=BLACK, font=date_font)
-    draw.text((10, 145), abv_dateString, fill=BLACK, font=date_font)
+    glyphs.text(image, (5, 70), timeString, clock_font, per_char=True)
+    glyphs.text(image, (10, 120), dateString, date_font)
+    glyphs.text(image, (10, 145), abv_dateString, date_font)
+
+##################################
+##### Boot frame and timings #####
+##################################
+BOOT_FRAME = path.join(CLOCK_FOLDER, "boot_frame.png")
+startup_marks = [] # (what, seconds since STARTED)
+
+def startup_mark(name):
+    startup_marks.append((name, time() - STARTED))
+
+def show_boot_frame(panel):
+    """Push the last saved clock to the panel. Returns it, or None (and clears the panel) if there is none."""
+    try:
+        frame = Image.open(BOOT_FRAME).convert("1")
+    except IOError:
+        frame = None
+    if frame is None or frame.size != tuple(panel.size):
+        panel.clear()
+        return None
+    panel.display(frame)
+    panel.update()
+    return frame
+
+def save_boot_frame():
+    temp_file = BOOT_FRAME + ".tmp"
+    image.save(temp_file, "PNG")
+    rename(temp_file, BOOT_FRAME) # A power cut never leaves half a frame
 
 #################################
 ##### Conway's Game Of Life #####
 #################################
-def papirus_gol(start_type="random"):
-    CELLSIZE = 5
-    #Colours the cells green for life and white for no life
-    def colourGrid(draw, item, lifeDict):
-        x = item[0]
-        y = item[1]
-        y = y * CELLSIZE # translates array into grid size
-        x = x * CELLSIZE # translates array into grid size
-        if lifeDict[item] == 0:
-            draw.rectangle(( (x, y), (x + CELLSIZE, y + CELLSIZE) ), fill=WHITE, outline=WHITE)
-        if lifeDict[item] == 1:
-            draw.rectangle(( (x, y), (x + CELLSIZE, y + CELLSIZE) ), fill=BLACK, outline=WHITE)
-        return None
-
-    #Creates an dictionary of all the cells
-    #Sets all cells as dead (0)
-    def generateGrid(height, width):
-        gridDict = {}
-        #creates dictionary for all cells
-        for y in range (height / CELLSIZE):
-            for x in range (width / CELLSIZE):
-                gridDict[x,y] = 0 #Sets cells as dead
-        return gridDict
-
-    #Assigns a 0 or a 1 to all cells
-    def startingGridRandom(lifeDict):
-        for item in lifeDict:
-            lifeDict[item] = randint(0,1)
-        return lifeDict
-
-    def startingRpentomino(lifeDict):
-        #R-pentomino
-        lifeDict[28,12] = 1
-        lifeDict[29,12] = 1
-        lifeDict[27,13] = 1
-        lifeDict[28,13] = 1
-        lifeDict[28,14] = 1
-        return lifeDict
-
-    def startingGosperGliderGun(lifeDict):
-        #Gosper Glider Gun
-        #left square
-        lifeDict[5,5] = 1
-        lifeDict[5,6] = 1
-        lifeDict[6,5] = 1
-        lifeDict[6,6] = 1
-        #left part of gun
-        lifeDict[15,5] = 1
-        lifeDict[15,6] = 1
-        lifeDict[15,7] = 1
-        lifeDict[16,4] = 1
-        lifeDict[16,8] = 1
-        lifeDict[17,3] = 1
-        lifeDict[18,3] = 1
-        lifeDict[17,9] = 1
-        lifeDict[18,9] = 1
-        lifeDict[19,6] = 1
-        lifeDict[20,4] = 1
-        lifeDict[20,8] = 1
-        lifeDict[21,5] = 1
-        lifeDict[21,6] = 1
-        lifeDict[21,7] = 1
-        lifeDict[22,6] = 1
-        #right part of gun
-        lifeDict[25,3] = 1
-        lifeDict[25,4] = 1
-        lifeDict[25,5] = 1
-        lifeDict[26,3] = 1
-        lifeDict[26,4] = 1
-        lifeDict[26,5] = 1
-        lifeDict[27,2] = 1
-        lifeDict[27,6] = 1
-        lifeDict[29,1] = 1
-        lifeDict[29,2] = 1
-        lifeDict[29,6] = 1
-        lifeDict[29,7] = 1
-        #right square
-        lifeDict[39,3] = 1
-        lifeDict[39,4] = 1
-        lifeDict[40,3] = 1
-        lifeDict[40,4] = 1
-        return lifeDict
-
-    #Determines how many alive neighbours there are around each cell
-    def getNeighbours(epd, item,lifeDict):
-        neighbours = 0
-        for x in range (-1,2):
-            for y in range (-1,2):
-                checkCell = (item[0]+x,item[1]+y)
-                if checkCell[0] < (epd.width / CELLSIZE)  and checkCell[0] >=0:
-                    if checkCell[1] < (epd.height / CELLSIZE) and checkCell[1]>= 0:
-                        if lifeDict[checkCell] == 1:
-                            if x == 0 and y == 0: # negate the central cell
-                                neighbours += 0
-                            else:
-                                neighbours += 1
-        return neighbours
-
-    #determines the next generation by running a "tick"
-    def tick(epd, lifeDict):
-        newTick = {}
-        for item in lifeDict:
-            #get number of neighbours for that item
-            numberNeighbours = getNeighbours(epd, item, lifeDict)
-            if lifeDict[item] == 1: # For those cells already alive
-                if numberNeighbours < 2: # kill under-population
-                    newTick[item] = 0
-                elif numberNeighbours > 3: #kill over-population
-                    newTick[item] = 0
-                else:
-                    newTick[item] = 1 # keep status quo (life)
-            elif lifeDict[item] == 0:
-                if numberNeighbours == 3: # cell reproduces
-                    newTick[item] = 1
-                else:
-                    newTick[item] = 0 # keep status quo (death)
-        return newTick
-
-    #main function
+CELLSIZE = 5
 
+def gol_start(start_type="random"):
+    from life import Life, LifeFrames # numpy, only needed once a game starts
     papirus.clear()
-
-    image = Image.new("1", papirus.size, WHITE)
-    draw = ImageDraw.Draw(image)
-
-    lifeDict = generateGrid(papirus.height, papirus.width) # creates library and Populates to match blank grid
-
-    ###Starting options
-    if start_type == "random":
-        lifeDict = startingGridRandom(lifeDict) # Assign random life
-    elif start_type == "R-pentomino":
-        lifeDict = startingRpentomino(lifeDict) # Setup R-pentomino
-    elif start_type == "Gosper":
-        lifeDict = startingGosperGliderGun(lifeDict) # Setup Gosper Glider Gun
+    life = Life(papirus.width // CELLSIZE, papirus.height // CELLSIZE) # Board to match the panel
+    life.seed(start_type) # random, R-pentomino or Gosper
+    frames = LifeFrames(papirus.size, CELLSIZE) # Turns the board into a picture for the panel
+    return life, frames
+
+def gol_step(life, frames):
+    """Show the next generation. Returns a summary if the board repeats and gol_on_cycle is "stop"."""
+    #runs a tick
+    life.step()
+
+    # Stop wearing out the panel once the board only repeats itself
+    if life.period is not None:
+        summary = "Period " + str(life.period) + " at gen " + str(life.generation) + ", " + str(life.population) + " alive"
+        print "Game of Life: " + summary
+        if gol_on_cycle == "stop":
+            return summary
+        life.seed("random")
 
     #Colours the live cells, blanks the dead
-    for item in lifeDict:
-        colourGrid(draw, item, lifeDict)
-
-    while True: #main game loop
-
-        if GPIO.input(SW4) == False:
-            now = datetime.now()
-            timeString = now.strftime("%I:%M %p")
-            dateString = now.strftime("%a %b %-d")
-            abv_dateString = now.strftime("%-m/%-d/%y")
-
-            draw.rectangle((0, 0, width, height), fill=WHITE, outline=WHITE)
-
-            draw.text((5, 70), timeString, fill=BLACK, font=clock_font)
-            draw.text((10, 120), dateString, fill=BLACK, font=date_font)
-            draw.text((10, 145), abv_dateString, fill=BLACK, font=date_font)
-            draw.text((2, 10), " Back   Random   Gosper   R", fill=BLACK, font=menu_font)
-            papirus.display(image)
-            papirus.update()
-            break
-
-        #runs a tick
-        lifeDict = tick(papirus, lifeDict)
-
-        #Colours the live cells, blanks the dead
-        for item in lifeDict:
-            colourGrid(draw, item, lifeDict)
-
-        #print("Rendering Frame")
-        papirus.display(image)
-        papirus.partial_update()
+    papirus.display(frames.render(life.grid))
+    papirus.partial_update()
+    papirus.wait() # One generation per panel update
 
 ###############################################
 ##### Exit cleanly if SIGTERM is received #####
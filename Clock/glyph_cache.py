@@ -0,0 +1,221 @@
+#####################################################
+##### Cache of rendered text for the E-Ink panel #####
+#####################################################
+
+############################
+##### Import Libraries #####
+############################
+from collections import OrderedDict
+from os import close, fsync, open as os_open, path, rename
+from struct import error as struct_error, pack, unpack
+from PIL import Image, ImageDraw, ImageFont
+
+BLACK = 0
+CACHE_MAGIC = b"CPGC1" # Start of a saved cache file
+
+######################################################
+##### A font that is only opened when it is used #####
+######################################################
+class LazyFont(object):
+    def __init__(self, font_file, size):
+        self.path = font_file
+        self.size = size
+        self._font = None
+
+    @property
+    def font(self):
+        if self._font is None:
+            self._font = ImageFont.truetype(self.path, self.size)
+        return self._font
+
+    def getsize(self, text):
+        return self.font.getsize(text)
+
+#################################################
+##### LRU cache of 1-bit text strip bitmaps #####
+#################################################
+class GlyphCache(object):
+    """Keeps rendered text as 1-bit masks keyed by (font file, size, text).
+    Drawing text that is in the cache is a single paste, FreeType is only used on a miss."""
+
+    def __init__(self, max_bytes=512 * 1024, cache_file=None):
+        self.max_bytes = max_bytes
+        self.cache_file = cache_file
+        self._strips = OrderedDict() # key -> (mask, advance), oldest first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+
+    def text(self, image, xy, text, font, per_char=False):
+        """Draw text in black at xy, like ImageDraw.text(xy, text, fill=BLACK, font=font).
+        per_char builds the text from single characters, so a handful of cached
+        digits cover every time of day (only use it with monospaced fonts)."""
+        x, y = xy
+        if not per_char:
+            mask = self.strip(text, font)[0]
+            self._blit(image, x, y, mask)
+            return
+        for char in text:
+            mask, advance = self.strip(char, font)
+            self._blit(image, x, y, mask)
+            x += advance
+
+    def _blit(self, image, x, y, mask):
+        width, height = mask.size
+        if width and height:
+            image.paste(BLACK, (x, y, x + width, y + height), mask)
+
+    def strip(self, text, font):
+        """Return (mask, advance width) for text, rendering it on a miss"""
+        key = (font.path, font.size, text)
+        entry = self._strips.pop(key, None)
+        if entry is not None:
+            self._strips[key] = entry # Move to the newest end
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        if isinstance(font, LazyFont):
+            font = font.font
+        width, height = font.getsize(text)
+        mask = Image.new("1", (width, height), 0)
+        ImageDraw.Draw(mask).text((0, 0), text, fill=1, font=font)
+        entry = (mask, width)
+        self._add(key, entry)
+        self.dirty = True
+        return entry
+
+    def _add(self, key, entry):
+        self._strips[key] = entry
+        self.bytes += _mask_bytes(entry[0])
+        while self.bytes > self.max_bytes and len(self._strips) > 1:
+            old_key, old_entry = self._strips.popitem(last=False) # Evict the least recently used
+            self.bytes -= _mask_bytes(old_entry[0])
+
+    ##############################
+    ##### Save/load the cache #####
+    ##############################
+    def save(self):
+        """Write the cache to cache_file as packed 1-bit data"""
+        if self.cache_file is None:
+            return
+        temp_file = self.cache_file + ".tmp"
+        with open(temp_file, "wb") as f:
+            f.write(CACHE_MAGIC)
+            f.write(pack("<I", len(self._strips)))
+            for (font_file, size, text), (mask, advance) in self._strips.items():
+                font_file = _to_bytes(font_file)
+                text = _to_bytes(text)
+                width, height = mask.size
+                f.write(pack("<HHHHHH", len(font_file), size, len(text), width, height, advance))
+                f.write(font_file)
+                f.write(text)
+                f.write(mask.tobytes())
+            f.flush()
+            fsync(f.fileno())
+        rename(temp_file, self.cache_file) # Replace the old file in one step
+        directory = os_open(path.dirname(path.abspath(self.cache_file)), 0)
+        try:
+            fsync(directory) # Make the rename survive a power cut
+        finally:
+            close(directory)
+        self.dirty = False
+
+    def load(self):
+        """Read strips saved by save(), so a cold start does not need FreeType.
+        A damaged file is thrown away, and the cache fills up again as text is drawn."""
+        if self.cache_file is None or not path.exists(self.cache_file):
+            return 0
+        try:
+            entries = self._read()
+        except (IOError, struct_error, ValueError) as e: # Cut short or corrupted
+            print("Glyph cache is damaged, rebuilding it: " + str(e))
+            self.dirty = True # Overwritten by the next save()
+            return 0
+        for key, entry in entries:
+            self._add(key, entry)
+        return len(entries)
+
+    def _read(self):
+        with open(self.cache_file, "rb") as f:
+            data = f.read()
+        if not data.startswith(CACHE_MAGIC):
+            raise ValueError("not a glyph cache file")
+
+        entries = []
+        offset = len(CACHE_MAGIC)
+        count = unpack("<I", data[offset:offset + 4])[0]
+        offset += 4
+        for entry in range(count):
+            path_length, size, text_length, width, height, advance = unpack("<HHHHHH", data[offset:offset + 12])
+            offset += 12
+            font_file = data[offset:offset + path_length].decode("utf-8")
+            offset += path_length
+            text = data[offset:offset + text_length].decode("utf-8")
+            offset += text_length
+            mask_length = ((width + 7) // 8) * height
+            if offset + mask_length > len(data):
+                raise ValueError("file ends in the middle of a strip")
+            mask = Image.frombytes("1", (width, height), data[offset:offset + mask_length])
+            offset += mask_length
+            entries.append(((_to_str(font_file), size, _to_str(text)), (mask, advance)))
+        return entries
+
+def _mask_bytes(mask):
+    width, height = mask.size
+    return ((width + 7) // 8) * height
+
+def _to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+def _to_str(text):
+    if isinstance(text, str):
+        return text
+    return text.encode("utf-8") # Python 2 keeps keys as byte strings
+
+#######################################
+##### Benchmark display_time() fps #####
+#######################################
+if __name__ == "__main__":
+    from datetime import datetime, timedelta
+    from time import time
+    import sys
+
+    font_file = sys.argv[1] if len(sys.argv) > 1 else "/usr/share/fonts/truetype/freefont/FreeMono.ttf"
+    frames = 1440 # One day of minutes
+    clock_font = ImageFont.truetype(font_file, 52)
+    date_font = ImageFont.truetype(font_file, 25)
+    menu_font = ImageFont.truetype(font_file, 15)
+    image = Image.new("1", (264, 176), 1)
+    draw = ImageDraw.Draw(image)
+    start_day = datetime(2020, 1, 1)
+
+    def frame(now, write):
+        draw.rectangle((0, 0, 264, 176), fill=1, outline=1)
+        write((5, 70), now.strftime("%I:%M %p"), clock_font, True)
+        write((10, 120), now.strftime("%a %b %-d"), date_font, False)
+        write((10, 145), now.strftime("%-m/%-d/%y"), date_font, False)
+        write((2, 10), " Menu   Info   Stuff   Lights", menu_font, False)
+
+    def freetype(xy, text, font, per_char):
+        draw.text(xy, text, fill=BLACK, font=font)
+
+    started = time()
+    for minute in range(frames):
+        frame(start_day + timedelta(minutes=minute), freetype)
+    before = frames / (time() - started)
+
+    cache = GlyphCache()
+    def cached(xy, text, font, per_char):
+        cache.text(image, xy, text, font, per_char)
+
+    started = time()
+    for minute in range(frames):
+        frame(start_day + timedelta(minutes=minute), cached)
+    after = frames / (time() - started)
+
+    print("display_time() with FreeType:    %.0f frames/s" % before)
+    print("display_time() with glyph cache: %.0f frames/s (%d hits, %d misses, %d bytes)" % (after, cache.hits, cache.misses, cache.bytes))
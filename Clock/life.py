@@ -0,0 +1,204 @@
+#################################################
+##### Conway's Game Of Life on a NumPy grid #####
+#################################################
+
+############################
+##### Import Libraries #####
+############################
+from PIL import Image
+from collections import deque
+from hashlib import sha1
+from time import time
+import numpy as np
+
+HISTORY = 64 # Generations remembered when looking for a repeat, so periods up to this long are found
+
+###########################
+##### Starting shapes #####
+###########################
+# (x, y) of each live cell
+R_PENTOMINO = ((28, 12), (29, 12), (27, 13), (28, 13), (28, 14))
+
+GOSPER_GLIDER_GUN = (
+    (5, 5), (5, 6), (6, 5), (6, 6), # Left square
+    (15, 5), (15, 6), (15, 7), (16, 4), (16, 8), (17, 3), (18, 3), (17, 9), (18, 9), # Left part of gun
+    (19, 6), (20, 4), (20, 8), (21, 5), (21, 6), (21, 7), (22, 6),
+    (25, 3), (25, 4), (25, 5), (26, 3), (26, 4), (26, 5), (27, 2), (27, 6), # Right part of gun
+    (29, 1), (29, 2), (29, 6), (29, 7),
+    (39, 3), (39, 4), (40, 3), (40, 4), # Right square
+)
+
+##########################################
+##### Board of cells, 1 alive 0 dead #####
+##########################################
+class Life(object):
+    """The board is a uint8 array indexed [y, x]. Cells past the edge count as dead."""
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+        self.grid = np.zeros((rows, columns), dtype=np.uint8)
+        self._padded = np.zeros((rows + 2, columns + 2), dtype=np.uint8) # Grid with a border of dead cells
+        self.generation = 0
+        self.period = None # Set once the board repeats: 1 for still lifes, 2 for blinkers...
+        self._seen = {} # Digest of a board -> generation it was seen
+        self._history = deque()
+
+    def seed(self, start_type="random"):
+        self.grid[:] = 0
+        self.generation = 0
+        if start_type == "random":
+            self.grid[:] = np.random.randint(0, 2, self.grid.shape) # Assign random life
+        elif start_type == "R-pentomino":
+            self._place(R_PENTOMINO)
+        elif start_type == "Gosper":
+            self._place(GOSPER_GLIDER_GUN)
+        self.period = None
+        self._seen.clear()
+        self._history.clear()
+        self._remember()
+
+    def _place(self, cells):
+        for x, y in cells:
+            if x < self.columns and y < self.rows:
+                self.grid[y, x] = 1
+
+    def step(self):
+        """Work out the next generation from the sum of the eight shifted copies of the board"""
+        padded = self._padded
+        padded[1:-1, 1:-1] = self.grid
+        rows, columns = self.grid.shape
+        neighbours = np.zeros(self.grid.shape, dtype=np.uint8)
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                if dy != 1 or dx != 1: # Skip the cell itself
+                    neighbours += padded[dy:dy + rows, dx:dx + columns]
+        # Born with three neighbours, survives with two or three
+        self.grid = ((neighbours == 3) | ((neighbours == 2) & (self.grid == 1))).astype(np.uint8)
+        self.generation += 1
+        self._remember()
+        return self.grid
+
+    def _remember(self):
+        digest = sha1(self.grid.tobytes()).digest()
+        if digest in self._seen and self.period is None:
+            self.period = self.generation - self._seen[digest]
+        self._seen[digest] = self.generation
+        self._history.append(digest)
+        if len(self._history) > HISTORY:
+            old = self._history.popleft()
+            if self._seen.get(old) <= self.generation - HISTORY:
+                del self._seen[old]
+
+    @property
+    def population(self):
+        return int(self.grid.sum())
+
+###############################################
+##### Turn the board into a 1-bit picture #####
+###############################################
+class LifeFrames(object):
+    """Scales the board up by cellsize straight into packed 1-bit rows, instead of one
+    draw.rectangle() per cell. Each cell keeps the white line along its top and left
+    edges that draw.rectangle(..., outline=WHITE) gave it, so the grid looks the same."""
+
+    def __init__(self, size, cellsize):
+        self.size = size
+        self.cellsize = cellsize
+        width, height = size
+        self.cell = np.ones((cellsize, cellsize), dtype=np.uint8)
+        if cellsize > 1:
+            self.cell[0, :] = 0 # Grid lines stay white
+            self.cell[:, 0] = 0
+        self._white = np.ones((height, width), dtype=np.uint8) # 1 is white, like mode "1"
+        self.frames = 0
+        self.render_time = 0.0 # Seconds spent in render(), all frames
+        self.last_render = 0.0
+
+    def render(self, grid):
+        started = time()
+        rows, columns = grid.shape
+        black = np.kron(grid, self.cell) # Every cell becomes a cellsize square
+        self._white[:rows * self.cellsize, :columns * self.cellsize] = 1 - black
+        image = Image.frombytes("1", self.size, np.packbits(self._white, axis=1).tobytes())
+
+        self.last_render = time() - started
+        self.render_time += self.last_render
+        self.frames += 1
+        return image
+
+    @property
+    def average_render(self):
+        return self.render_time / self.frames if self.frames else 0.0
+
+##################################################
+##### Benchmark against the dict based board #####
+##################################################
+if __name__ == "__main__":
+    from PIL import ImageDraw
+
+    WIDTH = 264 # Papirus 2.7" panel
+    HEIGHT = 176
+
+    # The board papirus_gol() used to keep: {(x, y): 0 or 1} stepped one cell at a time
+    def dict_tick(lifeDict, columns, rows):
+        newTick = {}
+        for item in lifeDict:
+            neighbours = 0
+            for x in range(-1, 2):
+                for y in range(-1, 2):
+                    checkCell = (item[0] + x, item[1] + y)
+                    if 0 <= checkCell[0] < columns and 0 <= checkCell[1] < rows and (x, y) != (0, 0):
+                        neighbours += lifeDict[checkCell]
+            if lifeDict[item] == 1:
+                newTick[item] = 1 if 2 <= neighbours <= 3 else 0
+            else:
+                newTick[item] = 1 if neighbours == 3 else 0
+        return newTick
+
+    def generations_per_second(step, seconds=2):
+        count = 0
+        started = time()
+        while time() - started < seconds:
+            step()
+            count += 1
+        return count / (time() - started)
+
+    for cellsize in (5, 1):
+        columns, rows = WIDTH // cellsize, HEIGHT // cellsize
+        life = Life(columns, rows)
+        life.seed("random")
+        board = {}
+        for y in range(rows):
+            for x in range(columns):
+                board[x, y] = int(life.grid[y, x])
+
+        # Both boards have to agree before the timings mean anything
+        for generation in range(3):
+            board = dict_tick(board, columns, rows)
+            life.step()
+        assert all(board[x, y] == life.grid[y, x] for (x, y) in board)
+
+        state = [board]
+        def step_dict():
+            state[0] = dict_tick(state[0], columns, rows)
+
+        before = generations_per_second(step_dict)
+        after = generations_per_second(life.step)
+        print("CELLSIZE %d (%dx%d cells): dict %.1f gen/s, numpy %.1f gen/s (%.0fx)" % (cellsize, columns, rows, before, after, after / before))
+
+        # Drawing: one rectangle per cell, like papirus_gol() used to, against LifeFrames
+        image = Image.new("1", (WIDTH, HEIGHT), 1)
+        draw = ImageDraw.Draw(image)
+        def draw_cells():
+            for y, x in np.ndindex(life.grid.shape):
+                left, top = x * cellsize, y * cellsize
+                fill = 0 if life.grid[y, x] else 1
+                draw.rectangle(((left, top), (left + cellsize, top + cellsize)), fill=fill, outline=1)
+        frames = LifeFrames((WIDTH, HEIGHT), cellsize)
+        draw_cells()
+        assert cellsize == 1 or frames.render(life.grid).tobytes() == image.tobytes()
+
+        before = generations_per_second(draw_cells)
+        after = generations_per_second(lambda: frames.render(life.grid))
+        print("CELLSIZE %d drawing: rectangles %.2f ms/frame, LifeFrames %.3f ms/frame" % (cellsize, 1000 / before, 1000 / after))
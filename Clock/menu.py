@@ -0,0 +1,216 @@
+##################################################
+##### Table driven menus for the E-Ink clock #####
+##################################################
+
+############################
+##### Import Libraries #####
+############################
+from collections import deque
+from time import time
+from scheduler import monotonic
+
+MENU_TIMEOUT = 30 # Seconds before an untouched menu goes back to the clock
+
+##################
+##### Screen #####
+##################
+class Screen(object):
+    """One screen: the labels over the buttons, what each button does and what runs while it is open.
+
+    buttons maps a pin to a screen name, or to a function(menus) that returns
+    None (stay here and redraw), a screen name, or (screen name, message).
+    message is a string or a function(menus) for text that changes while the screen is open,
+    shown whenever an action has not left a message of its own.
+    tick(menus) runs every tick_time seconds and returns None or somewhere to go, like a button.
+    Screens with clock=False draw themselves, so they are left alone when the minute changes."""
+
+    def __init__(self, labels, buttons, message=None, timeout=MENU_TIMEOUT, hold=False,
+                 enter=None, leave=None, tick=None, tick_time=1, clock=True):
+        self.labels = labels
+        self.buttons = buttons
+        self.message = message
+        self.timeout = timeout # None never times out
+        self.hold = hold # Held buttons repeat, for stepping through numbers
+        self.enter = enter
+        self.leave = leave
+        self.tick = tick
+        self.tick_time = tick_time
+        self.clock = clock
+
+######################################################
+##### Dispatch button presses to the open screen #####
+######################################################
+class MenuMachine(object):
+    """Keeps track of the open screen. The main loop sleeps for time_until_tick() at most,
+    passes presses to press() and calls tick(), so nothing a screen does blocks the loop."""
+
+    def __init__(self, screens, home, draw):
+        self.screens = screens
+        self.home = home
+        self.draw = draw # draw(labels, message, partial) pushes a frame to the panel
+        self.name = home
+        self.message = None
+        self.last_press = monotonic()
+        self._next_tick = None
+
+        # Counters
+        self.presses = 0
+        self.latency = deque(maxlen=200) # Seconds from button edge to the new frame being pushed
+
+    @property
+    def screen(self):
+        return self.screens[self.name]
+
+    def go(self, name, message=None):
+        """Open a screen, running the old screen's leave() and the new one's enter()"""
+        old = self.screen
+        if old.leave is not None:
+            old.leave(self)
+        self.name = name
+        self.message = message
+        self.last_press = monotonic()
+        screen = self.screen
+        self._next_tick = monotonic() + screen.tick_time if screen.tick is not None else None
+        if screen.enter is not None:
+            result = screen.enter(self)
+            if result is not None: # enter() can send us somewhere else, for example if a file is missing
+                self._follow(result)
+                return
+        self.render(False)
+
+    def _follow(self, result):
+        if result is None:
+            self.render(True)
+        elif isinstance(result, tuple):
+            self.go(*result)
+        else:
+            self.go(result)
+
+    def press(self, pin, pressed_at=None):
+        action = self.screen.buttons.get(pin)
+        if action is None:
+            return
+        self.presses += 1
+        self.last_press = monotonic()
+        self._follow(action(self) if callable(action) else action)
+        if pressed_at is not None:
+            self.latency.append(time() - pressed_at)
+
+    def render(self, partial):
+        screen = self.screen
+        if not screen.clock:
+            return
+        labels = screen.labels(self) if callable(screen.labels) else screen.labels
+        message = self.message # Set by the last action, until the minute changes
+        if message is None:
+            message = screen.message(self) if callable(screen.message) else screen.message
+        self.draw(labels, message, partial)
+
+    def refresh(self):
+        """Redraw for a new minute. One-off messages ("Pin 10 toggled") are dropped."""
+        self.message = None
+        self.render(True)
+
+    ################################
+    ##### Timeouts and ticking #####
+    ################################
+    def time_until_tick(self):
+        """Seconds until tick() has something to do, or None"""
+        times = []
+        if self._next_tick is not None:
+            times.append(self._next_tick)
+        if self.screen.timeout is not None:
+            times.append(self.last_press + self.screen.timeout)
+        if not times:
+            return None
+        return max(0, min(times) - monotonic())
+
+    def tick(self):
+        now = monotonic()
+        screen = self.screen
+        if screen.timeout is not None and now - self.last_press >= screen.timeout:
+            self.go(self.home) # Menu timed out
+            return
+        if self._next_tick is not None and now >= self._next_tick:
+            self._next_tick = now + screen.tick_time
+            result = screen.tick(self)
+            if result is not None:
+                self._follow(result)
+
+    def stats(self):
+        latency = sorted(self.latency)
+        return {
+            "screen": self.name,
+            "presses": self.presses,
+            "latency_average": sum(latency) / len(latency) if latency else 0.0,
+            "latency_max": latency[-1] if latency else 0.0,
+        }
+
+###################################################################
+##### Test harness: navigate deep menus while an alarm is due #####
+###################################################################
+if __name__ == "__main__":
+    from datetime import datetime, timedelta
+    from time import sleep
+    import sys
+
+    frame_time = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05 # Pretend panel refresh time
+    SW1, SW2, SW3, SW4 = 16, 26, 20, 21
+    frames = []
+
+    def draw(labels, message, partial):
+        sleep(frame_time)
+        frames.append((labels, message, partial))
+
+    screens = {
+        "home": Screen(" Menu   Info   Stuff   Lights", {SW4: "menu", SW1: "lights"}, timeout=None),
+        "menu": Screen(" Back  Alarm  Power", {SW4: "home", SW3: "alarm"}),
+        "alarm": Screen(" Back  Toggle  Set  Status", {SW4: "menu", SW2: "set"}),
+        "set": Screen(" Save  Select  Up  Down", {SW4: ("alarm", "Saved"), SW2: lambda menus: None}, hold=True),
+        "lights": Screen(" Back  More  Pin 10   Pin 9", {SW4: "home", SW2: ("home", "Pin 10 toggled")}),
+        "ringing": Screen(" Off    Snooze", {SW4: ("home", "Alarm turned off")}, timeout=None),
+    }
+    menus = MenuMachine(screens, "home", draw)
+
+    # A timer stands in for an alarm that comes due while we are four menus deep
+    from scheduler import AlarmScheduler
+    scheduler = AlarmScheduler()
+    scheduler.add_timer("alarm", datetime.now() + timedelta(seconds=0.5))
+
+    script = [SW4, SW3, SW2] + [SW2] * 10 + [SW4, SW4, SW4, SW1, SW2] # Menu > Alarm > Set, hold Up, back out, Lights
+    expected = len(script) + 1 # Every press in the script does something, plus turning the alarm off
+    press_time = 0.03 # Presses come in every 30 ms
+    started = monotonic()
+    next_press = started + press_time
+    interrupted = None
+    fired = []
+    while script or not fired:
+        timeout = max(0, next_press - monotonic())
+        next_event = scheduler.time_until_next()
+        if next_event is not None:
+            timeout = min(timeout, next_event)
+        tick = menus.time_until_tick()
+        if tick is not None:
+            timeout = min(timeout, tick)
+        sleep(timeout)
+
+        for event in scheduler.pop_due():
+            fired.append(event)
+            interrupted = menus.name # The script carries on here once the alarm is off
+            menus.go("ringing")
+        menus.tick()
+        if monotonic() < next_press:
+            continue
+        due = time() - (monotonic() - next_press) # When the press came in, so waiting for the loop counts too
+        next_press += press_time
+        if menus.name == "ringing":
+            menus.press(SW4, due)
+            menus.go(interrupted)
+        else:
+            menus.press(script.pop(0), due)
+
+    stats = menus.stats()
+    assert stats["presses"] == expected, "%d of %d presses did something" % (stats["presses"], expected)
+    assert (menus.name, menus.message) == ("home", "Pin 10 toggled"), "ended on %s (%s)" % (menus.name, menus.message)
+    print("%d presses, ended on %s. Press to new frame: average %.1f ms, max %.1f ms, including %.0f ms of pretend panel per frame" % (stats["presses"], menus.name, stats["latency_average"] * 1000, stats["latency_max"] * 1000, frame_time * 1000))
+    print("Alarm went off %.1f ms late, %d missed, run took %.2f s" % (fired[0].lateness * 1000, scheduler.missed_count, monotonic() - started))
@@ -0,0 +1,234 @@
+###################################################
+##### Index of the Music folder for shuffling #####
+###################################################
+
+############################
+##### Import Libraries #####
+############################
+from os import listdir, path, remove, rename, stat
+from collections import namedtuple
+from random import randint, shuffle
+from struct import unpack
+from threading import Lock
+import json
+import sys
+if path.join(path.dirname(path.abspath(__file__)), "..", "Shared") not in sys.path:
+    sys.path.append(path.join(path.dirname(path.abspath(__file__)), "..", "Shared"))
+from watcher import FileWatcher
+
+PLAYABLE = (".wav", ".ogg", ".mp3") # What pygame.mixer.music can load
+INDEX_VERSION = 1
+
+Track = namedtuple("Track", ["name", "path", "title", "duration"])
+
+##################################
+##### Read a track's details #####
+##################################
+def probe(file_path):
+    """Return (title, duration in seconds or None) without decoding the audio.
+    WAV headers give the length and, if present, the INFO title. Other formats use the file name."""
+    title = path.splitext(path.basename(file_path))[0]
+    duration = None
+    if not file_path.lower().endswith(".wav"):
+        return title, duration
+    try:
+        with open(file_path, "rb") as f:
+            if f.read(12)[8:12] != b"WAVE":
+                return title, duration
+            byte_rate = 0
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                chunk, size = header[:4], unpack("<I", header[4:])[0]
+                if chunk == b"fmt ":
+                    byte_rate = unpack("<I", f.read(16)[8:12])[0]
+                    f.seek(size - 16 + (size & 1), 1)
+                elif chunk == b"data":
+                    if byte_rate:
+                        duration = round(float(size) / byte_rate, 1)
+                    f.seek(size + (size & 1), 1) # Skip the samples
+                elif chunk == b"LIST" and size >= 4:
+                    list_type = f.read(4)
+                    if list_type != b"INFO": # adtl and other lists, skip the rest of the chunk
+                        f.seek(size - 4 + (size & 1), 1)
+                        continue
+                    info = f.read(size - 4)
+                    offset = 0
+                    while offset + 8 <= len(info):
+                        name, length = info[offset:offset + 4], unpack("<I", info[offset + 4:offset + 8])[0]
+                        if name == b"INAM":
+                            title = info[offset + 8:offset + 8 + length].rstrip(b"\0").decode("utf-8", "replace")
+                        offset += 8 + length + (length & 1)
+                    if size & 1:
+                        f.seek(1, 1)
+                else:
+                    f.seek(size + (size & 1), 1)
+    except (IOError, OSError):
+        pass
+    return title, duration
+
+########################################################
+##### Playable files, kept in step with the folder #####
+########################################################
+class MusicLibrary(object):
+    """Loads the folder's index from index_file (probing only files that are new or changed),
+    follows the folder with inotify and deals tracks from a shuffled queue that plays
+    every track once before any track repeats."""
+
+    def __init__(self, folder, index_file=None):
+        self.folder = folder
+        self.index_file = index_file
+        self._tracks = {} # name -> [size, mtime, title, duration]
+        self._queue = []
+        self._last = None
+        self._lock = Lock()
+        self._loaded = False
+        self._dirty = False
+        self._watcher = None
+
+    def __len__(self):
+        self.load()
+        return len(self._tracks)
+
+    def load(self):
+        """Build the index the first time it is needed"""
+        if self._loaded:
+            return
+        saved = {}
+        folder_mtime = None
+        if self.index_file is not None and path.exists(self.index_file):
+            try:
+                with open(self.index_file, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == INDEX_VERSION:
+                    saved = data["tracks"]
+                    folder_mtime = data["folder_mtime"]
+            except (IOError, ValueError, KeyError):
+                saved = {}
+
+        with self._lock:
+            self._tracks = {}
+            if folder_mtime is not None and folder_mtime == stat(self.folder).st_mtime:
+                # Nothing was added, removed or renamed since the index was saved, so skip listing
+                # the folder. A file edited in place does not change the folder, so each one is still checked.
+                for name, known in saved.items():
+                    self._update(name, known)
+            else:
+                for name in listdir(self.folder):
+                    self._update(name, saved.get(name))
+                self._dirty = True
+            self._loaded = True
+        self._watcher = FileWatcher(self.folder, self._changed)
+        self.save()
+
+    def _update(self, name, known=None):
+        """Add, refresh or drop one file. known is its saved entry, reused if the file is unchanged."""
+        if not name.lower().endswith(PLAYABLE) or name.startswith("."):
+            return
+        try:
+            info = stat(path.join(self.folder, name))
+        except OSError:
+            if self._tracks.pop(name, None) is not None:
+                self._dirty = True
+            return
+        if known is not None and known[0] == info.st_size and known[1] == info.st_mtime:
+            self._tracks[name] = known
+            return
+        title, duration = probe(path.join(self.folder, name))
+        new = name not in self._tracks
+        self._tracks[name] = [info.st_size, info.st_mtime, title, duration]
+        self._dirty = True
+        if new and self._queue: # A new track joins the tracks still to come, somewhere random
+            self._queue.insert(randint(0, len(self._queue)), name)
+
+    # Called from the watcher thread
+    def _changed(self, name):
+        with self._lock:
+            self._update(name)
+
+    def save(self):
+        if self.index_file is None or not self._dirty:
+            return
+        with self._lock:
+            data = {"version": INDEX_VERSION, "folder_mtime": stat(self.folder).st_mtime, "tracks": self._tracks}
+            temp_file = self.index_file + ".tmp"
+            with open(temp_file, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            rename(temp_file, self.index_file)
+            self._dirty = False
+
+    ###################################
+    ##### Shuffle without repeats #####
+    ###################################
+    def next(self):
+        """The next Track to play, or None if there is nothing playable"""
+        self.load()
+        with self._lock:
+            while True:
+                if not self._queue:
+                    if not self._tracks:
+                        return None
+                    self._queue = list(self._tracks)
+                    shuffle(self._queue)
+                    if len(self._queue) > 1 and self._queue[-1] == self._last:
+                        self._queue[0], self._queue[-1] = self._queue[-1], self._queue[0] # Do not play the same track twice in a row
+                name = self._queue.pop()
+                entry = self._tracks.get(name)
+                if entry is not None: # Skip tracks deleted since the shuffle
+                    break
+            self._last = name
+        self.save()
+        return Track(name, path.join(self.folder, name), entry[2], entry[3])
+
+    def close(self):
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+#########################################
+##### Benchmark with a large folder #####
+#########################################
+if __name__ == "__main__":
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    from time import time
+    import wave
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    folder = mkdtemp()
+    index_file = folder + ".json" # Outside the folder, like the clock's
+    try:
+        for number in range(count):
+            song = wave.open(path.join(folder, "song%05d.wav" % number), "wb")
+            song.setnchannels(1)
+            song.setsampwidth(2)
+            song.setframerate(8000)
+            song.writeframes(b"\0\0" * 800)
+            song.close()
+        open(path.join(folder, "README.md"), "w").close()
+
+        started = time()
+        library = MusicLibrary(folder, index_file)
+        library.load()
+        print("%d files, first index: %.0f ms" % (len(library), (time() - started) * 1000))
+        library.close()
+
+        started = time()
+        library = MusicLibrary(folder, index_file)
+        library.load()
+        print("Start up from the saved index: %.0f ms" % ((time() - started) * 1000))
+
+        played = set()
+        slowest = 0
+        for number in range(count):
+            started = time()
+            track = library.next()
+            slowest = max(slowest, time() - started)
+            played.add(track.name)
+        print("%d skips, slowest %.2f ms, %d different tracks (%s, %.1f s)" % (count, slowest * 1000, len(played), track.title, track.duration))
+        library.close()
+    finally:
+        rmtree(folder)
+        if path.exists(index_file):
+            remove(index_file)
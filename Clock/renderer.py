@@ -0,0 +1,303 @@
+############################################################
+##### Only push frames that changed to the E-Ink panel #####
+############################################################
+
+############################
+##### Import Libraries #####
+############################
+from PIL import Image, ImageChops
+from threading import Condition, Lock, Thread
+from scheduler import monotonic
+import numpy as np
+
+WHITE = 1
+BAND_HEIGHT = 8 # Rows are checked for changes in bands this tall
+COALESCE_TIME = 0.05 # Seconds to wait for more draws before pushing a frame
+REGION_SIZE = 32 # Ghosting is tracked in squares this size
+GHOST_BUDGET = 4.0 # How much ghosting a region can build up before a full refresh
+PARTIAL_COST = 0.05 # Ghosting every partial update leaves in a region it changes, plus the fraction of the region that changed
+
+#########################################################
+##### Find the boxes that differ between two frames #####
+#########################################################
+def dirty_regions(old, new):
+    """Return (pixels changed, list of changed boxes) between two mode "1" images"""
+    diff = ImageChops.logical_xor(old, new)
+    if diff.getbbox() is None:
+        return 0, []
+
+    width, height = diff.size
+    regions = []
+    band_top = None
+    for top in range(0, height, BAND_HEIGHT):
+        bottom = min(top + BAND_HEIGHT, height)
+        changed = diff.crop((0, top, width, bottom)).getbbox() is not None
+        if changed and band_top is None:
+            band_top = top
+        elif not changed and band_top is not None:
+            regions.append(_band_box(diff, band_top, top))
+            band_top = None
+    if band_top is not None:
+        regions.append(_band_box(diff, band_top, height))
+
+    changed_pixels = diff.histogram()[255]
+    return changed_pixels, regions
+
+def _band_box(diff, top, bottom):
+    left, box_top, right, box_bottom = diff.crop((0, top, diff.size[0], bottom)).getbbox()
+    return (left, top + box_top, right, top + box_bottom)
+
+def region_pixels(diff, size=REGION_SIZE):
+    """Changed pixels in each size x size square of a mode "1" diff, as a 2D array"""
+    width, height = diff.size
+    packed = np.frombuffer(diff.tobytes(), dtype=np.uint8).reshape(height, -1)
+    bits = np.unpackbits(packed, axis=1)[:, :width]
+    rows = -(-height // size)
+    columns = -(-width // size)
+    padded = np.zeros((rows * size, columns * size), dtype=np.uint16)
+    padded[:height, :width] = bits
+    return padded.reshape(rows, size, columns, size).sum(axis=(1, 3))
+
+######################################################################
+##### Papirus wrapper that skips, merges and schedules refreshes #####
+######################################################################
+class DirtyRenderer(object):
+    """Stands in for a Papirus object. display() stages a frame. partial_update() hands it to
+    a background thread that waits COALESCE_TIME for more frames, then pushes the latest one,
+    if it differs from what the panel shows. update() forces a full refresh and waits for it.
+
+    Partial updates leave ghosting behind. Each one adds PARTIAL_COST plus the fraction of
+    pixels that changed to every region it touched, and once any region passes GHOST_BUDGET
+    the frame goes out as a full refresh instead, which clears the ghosting."""
+
+    def __init__(self, papirus, coalesce=COALESCE_TIME, budget=GHOST_BUDGET, shown=None):
+        self._papirus = papirus
+        self.size = papirus.size
+        self.width = papirus.width
+        self.height = papirus.height
+        self.supports_partial = hasattr(papirus, "partial_update")
+        self.coalesce = coalesce
+        self.budget = budget
+        self._shown = shown if shown is not None else Image.new("1", self.size, WHITE) # What the panel is showing
+        self._staged = self._shown
+        self._ghost = np.zeros((-(-self.height // REGION_SIZE), -(-self.width // REGION_SIZE)))
+        self._requested_at = None # When the first draw waiting to be pushed came in
+        self._full = False
+        self._flush = False # Someone is waiting, push without waiting for more draws
+        self._busy = False
+        self.failed = None # Why the panel last failed, after which every call raises it
+        self._condition = Condition()
+        self._panel = Lock()
+
+        # Counters
+        self.requests = 0 # partial_update() and update() calls
+        self.coalesced = 0 # Requests merged into a frame that was already waiting
+        self.frames_pushed = 0
+        self.frames_skipped = 0
+        self.full_updates = 0
+        self.budget_updates = 0 # Full refreshes because the ghosting budget ran out
+        self.partial_updates = 0
+        self.pixels_pushed = 0 # Pixels that changed colour
+        self.bytes_pushed = 0 # Packed size of the changed regions
+        self.bytes_written = 0 # Bytes written to the driver, which always takes a whole frame
+        self.push_time = 0.0 # Seconds spent waiting for the panel
+        self.last_pixels = 0
+        self.last_bytes = 0
+        self.last_regions = []
+
+        self._thread = Thread(target=self._writer, name="renderer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def clear(self):
+        self.wait()
+        with self._panel:
+            self._papirus.clear()
+            self._shown = Image.new("1", self.size, WHITE)
+            self._staged = self._shown
+            self._ghost[:] = 0
+
+    def display(self, image):
+        with self._condition:
+            self._staged = image.copy()
+
+    def update(self):
+        """Full refresh, returning once the panel has finished"""
+        self._request(True)
+        self.wait()
+
+    def partial_update(self):
+        """Push the staged frame soon, as a full refresh if the ghosting budget has run out"""
+        self._request(False)
+
+    def wait(self):
+        """Block until every frame asked for has reached the panel"""
+        with self._condition:
+            if self._requested_at is not None:
+                self._flush = True
+                self._condition.notify_all()
+            while (self._requested_at is not None or self._busy) and self.failed is None:
+                self._condition.wait()
+            if self.failed is not None:
+                raise self.failed
+
+    @property
+    def ghosting(self):
+        """The worst region's ghosting, as a fraction of the budget"""
+        return float(self._ghost.max()) / self.budget
+
+    def _request(self, full):
+        with self._condition:
+            if self.failed is not None: # Let the clock crash, so systemd restarts it
+                raise self.failed
+            self.requests += 1
+            if self._requested_at is None:
+                self._requested_at = monotonic()
+            else:
+                self.coalesced += 1
+            self._full = self._full or full
+            self._condition.notify_all()
+
+    def _writer(self):
+        while True:
+            with self._condition:
+                while self._requested_at is None:
+                    self._condition.wait()
+                # Give the caller a moment to draw anything else, the panel only shows the last frame
+                while not self._full and not self._flush and monotonic() < self._requested_at + self.coalesce:
+                    self._condition.wait(self._requested_at + self.coalesce - monotonic())
+                staged, full = self._staged, self._full
+                self._requested_at = None
+                self._full = False
+                self._flush = False
+                self._busy = True
+            try:
+                with self._panel:
+                    self._push(staged, full)
+            except Exception as e: # SPI or EPD error, the frame never reached the panel
+                print("Could not update the panel: " + str(e))
+                with self._condition:
+                    self.failed = e
+                    self._requested_at = None
+                    self._busy = False
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+
+    def _push(self, staged, full):
+        diff = ImageChops.logical_xor(self._shown, staged)
+        pixels, regions = dirty_regions(self._shown, staged)
+        self.last_pixels = pixels
+        self.last_regions = regions
+        self.last_bytes = sum(((right - left + 7) // 8) * (bottom - top) for left, top, right, bottom in regions)
+        if not regions and not full:
+            self.frames_skipped += 1
+            return
+
+        partial = self.supports_partial and not full
+        if partial:
+            changed = region_pixels(diff)
+            ghost = self._ghost + np.where(changed > 0, PARTIAL_COST + changed / float(REGION_SIZE * REGION_SIZE), 0)
+            if ghost.max() > self.budget:
+                partial = False
+                self.budget_updates += 1
+            else:
+                self._ghost = ghost
+
+        started = monotonic()
+        self._papirus.display(staged)
+        if partial:
+            self._papirus.partial_update() # The panel only redrives pixels that changed
+            self.partial_updates += 1
+        else:
+            self._papirus.update()
+            self.full_updates += 1
+            self._ghost[:] = 0
+        self.push_time += monotonic() - started
+        self._shown = staged
+
+        self.frames_pushed += 1
+        self.pixels_pushed += pixels
+        self.bytes_pushed += self.last_bytes
+        self.bytes_written += ((self.width + 7) // 8) * self.height
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "frames_pushed": self.frames_pushed,
+            "frames_skipped": self.frames_skipped,
+            "full_updates": self.full_updates,
+            "budget_updates": self.budget_updates,
+            "partial_updates": self.partial_updates,
+            "ghosting": round(self.ghosting, 2),
+            "push_time": self.push_time,
+            "pixels_pushed": self.pixels_pushed,
+            "bytes_pushed": self.bytes_pushed,
+            "bytes_written": self.bytes_written,
+            "last_pixels": self.last_pixels,
+            "last_bytes": self.last_bytes,
+            "last_regions": self.last_regions,
+        }
+
+########################################################################
+##### Benchmark: a day of minutes and menu presses on a fake panel #####
+########################################################################
+if __name__ == "__main__":
+    from datetime import datetime, timedelta
+    from PIL import ImageDraw, ImageFont
+    import sys
+
+    font_file = sys.argv[1] if len(sys.argv) > 1 else "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf"
+    clock_font = ImageFont.truetype(font_file, 50)
+    small_font = ImageFont.truetype(font_file, 15)
+
+    class FakePapirus(object):
+        size = (264, 176)
+        width, height = size
+        def __init__(self):
+            self.full = 0
+            self.partial = 0
+        def clear(self):
+            pass
+        def display(self, image):
+            pass
+        def update(self):
+            self.full += 1
+        def partial_update(self):
+            self.partial += 1
+
+    def frame(now, message):
+        image = Image.new("1", FakePapirus.size, WHITE)
+        draw = ImageDraw.Draw(image)
+        draw.text((5, 70), now.strftime("%I:%M %p"), font=clock_font, fill=0)
+        draw.text((10, 145), now.strftime("%-m/%-d/%y"), font=small_font, fill=0)
+        if message:
+            draw.text((2, 10), " Back  More  Pin 10   Pin 9", font=small_font, fill=0)
+            draw.text((4, 40), message, font=small_font, fill=0)
+        return image
+
+    panel = FakePapirus()
+    renderer = DirtyRenderer(panel, coalesce=0.005)
+    old_full = old_partial = 0
+    start = datetime(2020, 1, 1)
+    for minute in range(24 * 60):
+        now = start + timedelta(minutes=minute)
+        renderer.display(frame(now, None))
+        renderer.partial_update()
+        renderer.wait()
+        if "0" in now.strftime("%-M"): # What the clock used to do
+            old_full += 1
+        else:
+            old_partial += 1
+        if minute % 60 == 30: # Open a menu and press through three screens every hour
+            for press in range(3):
+                renderer.display(frame(now, "Screen " + str(press)))
+                renderer.partial_update()
+                old_full += 1 # Every screen change used to be a full refresh
+            renderer.wait()
+    stats = renderer.stats()
+    print("Before: %d full, %d partial refreshes" % (old_full, old_partial))
+    print("Now: %d full (%d from the ghosting budget), %d partial, %d skipped, %d of %d draws merged" % (panel.full, stats["budget_updates"], panel.partial, stats["frames_skipped"], stats["coalesced"], stats["requests"]))
@@ -0,0 +1,157 @@
+########################################################
+##### Alarm scheduler for more-than-an-alarm-clock #####
+########################################################
+
+############################
+##### Import Libraries #####
+############################
+from collections import deque, namedtuple
+from datetime import datetime
+from heapq import heapify, heappop, heappush
+from threading import Lock
+from time import time
+
+CATCH_UP_TIME = 600 # Alarms this many seconds late still go off, later ones are missed
+CLOCK_JUMP = 2 # Seconds the wall clock can move against monotonic time before rescheduling
+
+##########################
+##### Monotonic time #####
+##########################
+try:
+    from time import monotonic
+except ImportError: # Python 2
+    import ctypes
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    _clock_gettime = ctypes.CDLL("librt.so.1", use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        now = _timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(now)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return now.tv_sec + now.tv_nsec * 1e-9
+
+def _alarm_key(alarm):
+    return (alarm.hour, alarm.minute, alarm.days)
+
+# What pop_due() returns for each event that came due
+Fired = namedtuple("Fired", ["name", "alarm", "when", "lateness", "missed"])
+
+###########################################
+##### Min-heap of upcoming fire times #####
+###########################################
+class AlarmScheduler(object):
+    """Keeps alarms and one-shot timers in a heap ordered by monotonic fire time.
+    The main loop sleeps for time_until_next() and then calls pop_due()."""
+
+    def __init__(self, catch_up=CATCH_UP_TIME):
+        self.catch_up = catch_up
+        self.alarms = []
+        self.history = deque(maxlen=50) # Recent Fired events, with how late they were
+        self.fired_count = 0
+        self.missed_count = 0
+        self._heap = [] # [due (monotonic), sequence, name, alarm, when (datetime)]
+        self._sequence = 0
+        self._lock = Lock()
+        self._offset = time() - monotonic()
+
+    def set_alarms(self, alarms):
+        """Replace every alarm, keeping timers. Alarms that did not change keep
+        their place in the heap, so reloading right on an alarm's minute cannot skip it."""
+        with self._lock:
+            self.alarms = list(alarms)
+            scheduled = {}
+            for entry in self._heap:
+                if entry[3] is not None:
+                    scheduled.setdefault(_alarm_key(entry[3]), []).append(entry)
+            self._heap = [entry for entry in self._heap if entry[3] is None]
+
+            now = datetime.now()
+            for alarm in self.alarms:
+                if not alarm.enabled:
+                    continue
+                same = scheduled.get(_alarm_key(alarm))
+                if same:
+                    entry = same.pop()
+                    entry[3] = alarm
+                    self._heap.append(entry)
+                else:
+                    self._heap.append(self._entry("alarm", alarm, alarm.next_time(now)))
+            heapify(self._heap)
+
+    def add_timer(self, name, when):
+        """Fire `name` once at the datetime `when`, replacing a timer with the same name"""
+        self.cancel(name)
+        with self._lock:
+            self._push(name, None, when)
+
+    def cancel(self, name):
+        with self._lock:
+            self._heap = [entry for entry in self._heap if entry[2] != name]
+            heapify(self._heap)
+
+    def time_until_next(self):
+        """Seconds until the next event is due (0 if it is overdue), or None if nothing is scheduled"""
+        with self._lock:
+            self._check_clock()
+            if not self._heap:
+                return None
+            return max(0, self._heap[0][0] - monotonic())
+
+    def next_alarm(self):
+        """The datetime of the next alarm, or None"""
+        with self._lock:
+            times = [entry[4] for entry in self._heap if entry[3] is not None]
+            return min(times) if times else None
+
+    def pop_due(self):
+        """Remove and return a Fired for every event that is due, rescheduling repeating alarms"""
+        due = []
+        with self._lock:
+            self._check_clock()
+            now = monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, sequence, name, alarm, when = heappop(self._heap)
+                lateness = now - fire_at
+                missed = lateness > self.catch_up
+                event = Fired(name, alarm, when, lateness, missed)
+                self.history.append(event)
+                if missed:
+                    self.missed_count += 1
+                else:
+                    self.fired_count += 1
+                    due.append(event)
+
+                if alarm is not None:
+                    if alarm.repeats:
+                        self._push(name, alarm, alarm.next_time(when))
+                    else:
+                        alarm.enabled = False # One-shots only go off once
+        return due
+
+    def _push(self, name, alarm, when):
+        heappush(self._heap, self._entry(name, alarm, when))
+
+    def _entry(self, name, alarm, when):
+        seconds = (when - datetime.now()).total_seconds()
+        self._sequence += 1
+        return [monotonic() + seconds, self._sequence, name, alarm, when]
+
+    # The Pi has no RTC, so the wall clock can jump (NTP at boot, DST, manual changes).
+    # If it does, work the monotonic fire times out again from the wall clock.
+    def _check_clock(self):
+        offset = time() - monotonic()
+        if abs(offset - self._offset) <= CLOCK_JUMP:
+            return
+        self._offset = offset
+        now = datetime.now()
+        entries = self._heap
+        self._heap = []
+        for fire_at, sequence, name, alarm, when in entries:
+            if alarm is not None and alarm.repeats:
+                when = alarm.next_time(now)
+            self._push(name, alarm, when)
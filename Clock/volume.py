@@ -0,0 +1,202 @@
+######################################################
+##### Speaker volume, set without running amixer #####
+######################################################
+
+############################
+##### Import Libraries #####
+############################
+from subprocess import call
+from threading import Condition, Thread
+from scheduler import monotonic
+try:
+    import alsaaudio # python-alsaaudio
+except ImportError:
+    alsaaudio = None
+
+MIXER_CONTROL = "PCM" # The Pi's headphone/HDMI output, numid=1 to amixer
+RAMP_STEP_TIME = 0.1 # Seconds between volume changes while ramping
+
+##########################
+##### Mixer backends #####
+##########################
+class AlsaMixer(object):
+    """Talks to the ALSA mixer in-process, one ioctl per write"""
+    name = "alsa"
+
+    def __init__(self, control=MIXER_CONTROL):
+        self._mixer = alsaaudio.Mixer(control)
+
+    def read(self):
+        return int(self._mixer.getvolume()[0])
+
+    def write(self, level):
+        self._mixer.setvolume(level)
+
+class AmixerCommand(object):
+    """Runs amixer, for systems without python-alsaaudio"""
+    name = "amixer"
+
+    def __init__(self, numid=1):
+        self.numid = numid
+
+    def read(self):
+        return None
+
+    def write(self, level):
+        try:
+            with open("/dev/null", "w") as null:
+                call(["amixer", "cset", "numid=" + str(self.numid), str(level) + "%"], stdout=null, stderr=null)
+        except OSError as e: # amixer went away, keep the writer thread alive
+            print("Volume not set: " + str(e))
+
+class StubMixer(object):
+    """Remembers the level, for machines with no sound hardware"""
+    name = "stub"
+
+    def __init__(self):
+        self.level = None
+
+    def read(self):
+        return self.level
+
+    def write(self, level):
+        self.level = level
+
+def open_mixer(control=MIXER_CONTROL):
+    """The best mixer available: ALSA, then amixer, then the stub"""
+    if alsaaudio is not None:
+        try:
+            return AlsaMixer(control)
+        except alsaaudio.ALSAAudioError:
+            pass
+    try:
+        with open("/dev/null", "w") as null:
+            if call(["amixer", "--version"], stdout=null, stderr=null) == 0:
+                return AmixerCommand()
+    except OSError: # No amixer
+        pass
+    return StubMixer()
+
+###################################################
+##### Volume level, written in the background #####
+###################################################
+class Volume(object):
+    """Keeps the level in memory and writes it to the mixer from a background thread.
+    set() returns straight away; steps that arrive while a write is in progress are
+    merged, so holding a button costs one write per write time rather than one per step.
+    ramp() moves the level gradually, for an alarm that fades in."""
+
+    def __init__(self, mixer=None, level=None):
+        self.mixer = mixer if mixer is not None else open_mixer()
+        self.level = level if level is not None else self.mixer.read()
+        if self.level is None:
+            self.level = 80
+        self._written = None
+        self._ramp = None # (from, to, started, seconds)
+        self._closed = False
+        self._condition = Condition()
+
+        # Counters
+        self.requests = 0
+        self.writes = 0
+
+        self._thread = Thread(target=self._writer, name="volume")
+        self._thread.daemon = True
+        self._thread.start()
+        if level is not None:
+            self.set(level)
+
+    def set(self, level):
+        """Change the level (0-100), stopping any ramp. Returns the level that was set."""
+        level = max(0, min(100, int(level)))
+        with self._condition:
+            self.level = level
+            self._ramp = None
+            self.requests += 1
+            self._condition.notify()
+        return level
+
+    def step(self, change):
+        return self.set(self.level + change)
+
+    def ramp(self, start, end, seconds):
+        """Go from start to end over seconds"""
+        with self._condition:
+            self.level = max(0, min(100, int(start)))
+            self._ramp = (self.level, max(0, min(100, int(end))), monotonic(), float(seconds))
+            self.requests += 1
+            self._condition.notify()
+
+    def wait(self, timeout=1):
+        """Block until the mixer has the current level (for tests and benchmarks)"""
+        end = monotonic() + timeout
+        with self._condition:
+            while (self._written != self.level or self._ramp is not None) and monotonic() < end:
+                self._condition.wait(RAMP_STEP_TIME / 10)
+        return self._written == self.level
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join(1)
+
+    def _writer(self):
+        while True:
+            with self._condition:
+                while not self._closed and self._ramp is None and self._written == self.level:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                if self._ramp is not None:
+                    start, end, started, seconds = self._ramp
+                    done = (monotonic() - started) / seconds if seconds > 0 else 1
+                    if done >= 1:
+                        self.level = end
+                        self._ramp = None
+                    else:
+                        self.level = int(round(start + (end - start) * done))
+                level = self.level
+            if level != self._written:
+                self.mixer.write(level) # Outside the lock, amixer takes tens of milliseconds
+                self._written = level
+                self.writes += 1
+            if self._ramp is not None:
+                with self._condition:
+                    self._condition.wait(RAMP_STEP_TIME) # set() or close() cut this short
+
+###################################################
+##### Benchmark: holding the Volume Up button #####
+###################################################
+if __name__ == "__main__":
+    from time import sleep
+    import sys
+
+    backend = sys.argv[1] if len(sys.argv) > 1 else "stub"
+    if backend == "amixer":
+        mixer = AmixerCommand()
+    elif backend == "alsa":
+        mixer = AlsaMixer()
+    else:
+        mixer = StubMixer()
+        slow_write = mixer.write
+        def write(level):
+            sleep(0.02) # About what forking amixer takes on a Pi
+            slow_write(level)
+        mixer.write = write
+
+    volume = Volume(mixer, 50)
+    volume.wait()
+    started = monotonic()
+    for press in range(50):
+        volume.step(1) # A held button repeats every 10 ms here
+        sleep(0.01)
+    volume.wait()
+    print("%s: %d steps became %d writes in %.2f s, level %d" % (mixer.name, volume.requests - 1, volume.writes - 1, monotonic() - started, volume.level))
+
+    writes = volume.writes
+    started = monotonic()
+    volume.ramp(0, 80, 1)
+    volume.wait(2)
+    print("Ramp 0 to 80%% over 1 s: %d writes, took %.2f s" % (volume.writes - writes, monotonic() - started))
+    volume.close()
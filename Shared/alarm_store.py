@@ -0,0 +1,209 @@
+##############################################
+##### Alarm file shared by clock and web #####
+##############################################
+
+############################
+##### Import Libraries #####
+############################
+from os import chown, close, fsync, getpid, open as os_open, path, rename, stat, O_CREAT, O_RDWR
+from datetime import timedelta
+from threading import Lock
+from fcntl import flock, LOCK_EX, LOCK_UN
+from watcher import FileWatcher
+
+ALARM_FILE = path.join(path.dirname(path.abspath(__file__)), "..", "Clock", "alarm_data.csv")
+EVERY_DAY = (0, 1, 2, 3, 4, 5, 6) # Monday is 0
+
+#################
+##### Alarm #####
+#################
+class Alarm(object):
+    def __init__(self, hour, minute, enabled=True, days=EVERY_DAY):
+        self.hour = int(hour) % 24
+        self.minute = min(int(minute), 59)
+        self.enabled = bool(enabled)
+        self.days = tuple(sorted(set(days))) # Weekdays it repeats on, empty for a one-shot
+
+    @property
+    def repeats(self):
+        return len(self.days) > 0
+
+    def next_time(self, after):
+        """Return the first datetime after `after` that the alarm goes off"""
+        when = after.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        if when <= after:
+            when += timedelta(days=1)
+        while self.repeats and when.weekday() not in self.days:
+            when += timedelta(days=1)
+        return when
+
+    def copy(self):
+        return Alarm(self.hour, self.minute, self.enabled, self.days)
+
+    def __eq__(self, other):
+        return isinstance(other, Alarm) and (self.hour, self.minute, self.enabled, self.days) == (other.hour, other.minute, other.enabled, other.days)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Alarm(%d, %d, enabled=%r, days=%r)" % (self.hour, self.minute, self.enabled, self.days)
+
+##################################
+##### Alarm file line format #####
+##################################
+# One alarm per line: hour,minute,set[,days]. days lists the weekdays the alarm
+# repeats on (Monday is 0, so 01234 is weekdays) or is "once" for a one-shot.
+# Without days the alarm goes off every day.
+def parse_alarms(text):
+    alarms = []
+    for line in text.split("\n"):
+        words = line.strip().split(",")
+        if len(words) < 3:
+            continue
+        try:
+            days = EVERY_DAY
+            if len(words) > 3:
+                days = () if words[3] == "once" else [int(day) for day in words[3]]
+            alarms.append(Alarm(words[0], words[1], int(words[2]), days))
+        except ValueError:
+            continue # Skip a damaged line instead of losing every alarm
+    if not alarms:
+        alarms.append(Alarm(7, 0, False))
+    return alarms
+
+def format_alarms(alarms):
+    lines = []
+    for alarm in alarms:
+        line = str(alarm.hour) + "," + str(alarm.minute) + "," + str(int(alarm.enabled))
+        if not alarm.repeats:
+            line += ",once"
+        elif alarm.days != EVERY_DAY:
+            line += "," + "".join(str(day) for day in alarm.days)
+        lines.append(line)
+    return "\n".join(lines)
+
+####################################################
+##### Parsed alarms kept in step with the file #####
+####################################################
+class AlarmStore(object):
+    """Holds the parsed alarm file in memory. Writes replace the file in one step
+    (temp file, fsync, rename) while holding a lock file, so clock.py and web.py
+    never see half a file or overwrite each other. watch() reloads the copy as soon
+    as the other process changes the file."""
+
+    def __init__(self, alarm_file=ALARM_FILE):
+        self.alarm_file = path.abspath(alarm_file)
+        self.lock_file = self.alarm_file + ".lock"
+        self.version = 0 # Goes up every time the alarms change
+        self.reloads = 0
+        self._lock = Lock()
+        self._callbacks = []
+        self._watcher = None
+        self._alarms = self._read()
+
+    @property
+    def alarms(self):
+        """A copy of every alarm, safe to change"""
+        with self._lock:
+            return [alarm.copy() for alarm in self._alarms]
+
+    def first(self):
+        """The alarm the menus and web page control"""
+        with self._lock:
+            return self._alarms[0].copy()
+
+    def _read(self):
+        try:
+            with open(self.alarm_file, "r") as f:
+                return parse_alarms(f.read())
+        except IOError:
+            return parse_alarms("")
+
+    def reload(self):
+        """Read the file again, calling the callbacks if the alarms changed"""
+        alarms = self._read()
+        self._replace(alarms)
+
+    def _replace(self, alarms):
+        with self._lock:
+            if alarms == self._alarms:
+                return
+            self._alarms = alarms
+            self.version += 1
+            self.reloads += 1
+        for callback in self._callbacks:
+            callback()
+
+    ######################
+    ##### Write file #####
+    ######################
+    def modify(self, change):
+        """Call change(alarms) with the alarms read fresh from the file and save what it
+        returns. The lock file is held throughout, so another process cannot write in between."""
+        lock_fd = os_open(self.lock_file, O_RDWR | O_CREAT, 0o644)
+        try:
+            flock(lock_fd, LOCK_EX)
+            alarms = change(self._read())
+            self._write(alarms)
+        finally:
+            flock(lock_fd, LOCK_UN)
+            close(lock_fd)
+        self._replace(alarms)
+        return alarms
+
+    def save(self, alarms):
+        alarms = [alarm.copy() for alarm in alarms]
+        return self.modify(lambda old: alarms)
+
+    def set_first(self, hour, minute, enabled):
+        """Change the first alarm's time and whether it is set, keeping its days and the other alarms"""
+        def change(alarms):
+            alarms[0] = Alarm(hour, minute, enabled, alarms[0].days)
+            return alarms
+        return self.modify(change)
+
+    def disable(self, fired):
+        """Turn off alarms matching the one-shot `fired`, which only go off once"""
+        def change(alarms):
+            for alarm in alarms:
+                if (alarm.hour, alarm.minute, alarm.days) == (fired.hour, fired.minute, fired.days):
+                    alarm.enabled = False
+            return alarms
+        return self.modify(change)
+
+    def _write(self, alarms):
+        temp_file = self.alarm_file + "." + str(getpid()) + ".tmp"
+        with open(temp_file, "w") as f:
+            f.write(format_alarms(alarms))
+            f.flush()
+            fsync(f.fileno())
+        try:
+            old = stat(self.alarm_file)
+            chown(temp_file, old.st_uid, old.st_gid) # Both scripts run as root, keep the file owned by pi
+        except OSError:
+            pass
+        rename(temp_file, self.alarm_file) # Readers see the old file or the new one, never half of it
+        directory = os_open(path.dirname(self.alarm_file), 0)
+        try:
+            fsync(directory) # Make the rename survive a power cut
+        finally:
+            close(directory)
+
+    ###############################
+    ##### Follow file changes #####
+    ###############################
+    def watch(self, callback=None):
+        """Reload whenever the file is replaced. callback() is called from a background
+        thread (or from modify()) every time the alarms change."""
+        if callback is not None:
+            self._callbacks.append(callback)
+        if self._watcher is None:
+            name = path.basename(self.alarm_file)
+            self._watcher = FileWatcher(path.dirname(self.alarm_file), lambda changed: self.reload(), [name])
+            self.reload() # Catch changes made before the watch started
+
+    def close(self):
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
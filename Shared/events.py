@@ -0,0 +1,110 @@
+#############################################################
+##### Changes pushed to web pages as Server-Sent Events #####
+#############################################################
+
+############################
+##### Import Libraries #####
+############################
+from collections import deque, namedtuple
+from threading import Lock
+from time import time
+import json
+try:
+    from Queue import Empty, Full, Queue
+except ImportError: # Python 3
+    from queue import Empty, Full, Queue
+
+HISTORY = 100 # Events kept for clients that reconnect with Last-Event-ID
+QUEUE_SIZE = 50 # Events a client may fall behind before it is dropped (it reconnects and catches up)
+KEEPALIVE_TIME = 15 # Seconds between comments sent to idle clients, so proxies and Safari keep the stream open
+RETRY_TIME = 2000 # Milliseconds browsers wait before reconnecting
+
+# One change: its number, "relays", "sensors" or "alarm", a dict of what changed, and when it was published
+Message = namedtuple("Message", ["id", "name", "data", "time"])
+
+#############################################
+##### Hand every change to every client #####
+#############################################
+class EventBroker(object):
+    """publish() copies an event into the queue of every client streaming from stream(),
+    from whichever thread noticed the change. The last HISTORY events are kept, so a client
+    that reconnects with the id of the last event it saw gets only what it missed.
+
+    Event ids are "epoch-number", the epoch being when the broker was made. Numbers start
+    again after a restart, so an id from an older epoch always gets a snapshot."""
+
+    def __init__(self, history=HISTORY):
+        self._lock = Lock()
+        self._clients = set()
+        self._history = deque(maxlen=history)
+        self.epoch = "%x" % int(time() * 1000)
+        self.last_id = 0
+
+        # Counters
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0 # Clients that fell QUEUE_SIZE events behind
+        self.latency = deque(maxlen=1000) # Seconds from publish() to the event being handed to the server
+
+    def publish(self, name, data):
+        with self._lock:
+            self.last_id += 1
+            message = Message(self.last_id, name, data, time())
+            self._history.append(message)
+            self.published += 1
+            for queue in list(self._clients):
+                try:
+                    queue.put_nowait(message)
+                except Full:
+                    self._clients.discard(queue)
+                    self.dropped += 1
+
+    def stream(self, last_event_id=None, snapshot=None, keepalive=KEEPALIVE_TIME):
+        """text/event-stream chunks for one client, until it goes away. If the events after
+        last_event_id are no longer kept (or it is missing or from another epoch), snapshot() is
+        called for a list of (name, data) that describe everything, and they are sent first."""
+        epoch, dash, number = (last_event_id or "").partition("-")
+        last_id = int(number) if epoch == self.epoch and number.isdigit() else None
+        queue = Queue(QUEUE_SIZE)
+        with self._lock:
+            missed = [message for message in self._history if last_id is not None and message.id > last_id]
+            caught_up = last_id is not None and (last_id == self.last_id or bool(missed) and missed[0].id == last_id + 1)
+            start_id = self.last_id
+            self._clients.add(queue)
+        try:
+            yield "retry: " + str(RETRY_TIME) + "\n\n"
+            if not caught_up and snapshot is not None:
+                for name, data in snapshot():
+                    yield self._format(Message(start_id, name, data, time()))
+                missed = []
+            for message in missed:
+                yield self._format(message)
+            while True:
+                if queue not in self._clients and queue.empty(): # Dropped for falling behind, the browser reconnects
+                    return
+                try:
+                    message = queue.get(timeout=keepalive)
+                except Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                self.latency.append(time() - message.time)
+                self.delivered += 1
+                yield self._format(message)
+        finally:
+            with self._lock:
+                self._clients.discard(queue)
+
+    def _format(self, message):
+        data = dict(message.data, time=round(message.time, 3)) # time lets a client work out how late it is
+        return "id: " + self.epoch + "-" + str(message.id) + "\nevent: " + message.name + "\ndata: " + json.dumps(data) + "\n\n"
+
+    def stats(self):
+        latency = sorted(self.latency)
+        return {
+            "clients": len(self._clients),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "latency_ms": round(latency[len(latency) // 2] * 1000, 2) if latency else 0,
+            "latency_p99_ms": round(latency[int(len(latency) * 0.99)] * 1000, 2) if latency else 0,
+        }
@@ -0,0 +1,74 @@
+###########################################################
+##### Framed messages between the Pi and the Arduino #####
+###########################################################
+# Every frame is: START, length of the payload, sequence number, payload, CRC-8 of the three before it.
+# The first payload byte is the command, the rest are its arguments:
+#   V           ping, replies V and PROTOCOL_VERSION
+#   x           read every pin, replies M and the mask (bit 0 = pin 9 ... bit 4 = pin 13, bit 5 = pin 8)
+#   Y chosen on set the chosen pins from a mask, replies K
+#   T chosen    toggle the chosen pins, replies K
+#   B index     reply K, then switch to BAUD_RATES[index]. The sketch goes back to 9600 if no
+#               good frame arrives at the new rate within 2 seconds.
+# Errors reply E and a code: 1 bad CRC, 2 missing arguments, 3 unknown command.
+# Replies carry the sequence number of their request, so several can be in flight at once.
+# After the first good frame the sketch ignores bytes outside frames, until it is reset.
+
+############################
+##### Import Libraries #####
+############################
+from collections import deque
+
+FRAME_START = 0x7E
+MAX_PAYLOAD = 8
+PROTOCOL_VERSION = 1
+BAUD_RATES = (9600, 57600, 115200)
+ERRORS = {1: "bad CRC", 2: "missing arguments", 3: "unknown command"}
+
+def crc8(data):
+    """CRC-8, polynomial 0x07, the same as crc8() in arduino_program.ino"""
+    crc = 0
+    for byte in bytearray(data):
+        crc ^= byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+def encode(seq, payload):
+    """The bytes of one frame"""
+    body = bytearray([len(payload), seq & 0xFF]) + bytearray(payload)
+    return bytes(bytearray([FRAME_START]) + body + bytearray([crc8(body)]))
+
+##############################################
+##### Split a byte stream back into frames #####
+##############################################
+class FrameReader(object):
+    """Takes bytes as they arrive and hands back whole frames as (seq, payload).
+    Bytes outside a frame and frames with a bad CRC are dropped and counted."""
+
+    def __init__(self):
+        self._frame = None # The frame being read, from its length byte on
+        self.frames = 0
+        self.bad_crc = 0
+        self.dropped = 0 # Bytes that were not part of a frame
+
+    def feed(self, data):
+        frames = deque()
+        for byte in bytearray(data):
+            if self._frame is None:
+                if byte == FRAME_START:
+                    self._frame = bytearray()
+                else:
+                    self.dropped += 1
+                continue
+            self._frame.append(byte)
+            if len(self._frame) == 1 and not 0 < byte <= MAX_PAYLOAD: # Not a length, so that was not a start
+                self.dropped += 2
+                self._frame = None
+            elif len(self._frame) == self._frame[0] + 3:
+                frame, self._frame = self._frame, None
+                if crc8(frame[:-1]) != frame[-1]:
+                    self.bad_crc += 1
+                    continue
+                self.frames += 1
+                frames.append((frame[1], bytes(frame[2:-1])))
+        return frames
@@ -0,0 +1,426 @@
+###############################################################################
+##### Hardware for clock.py, web.py and the Arduino scripts, or stand-ins #####
+###############################################################################
+# Everything starts on the real hardware. Set CLOCK_PI_HAL=virtual to run on any Linux machine:
+#   CLOCK_PI_DIR          Where frames, the relay socket and the button FIFO go (/tmp/clock-pi)
+#   CLOCK_PI_BUTTONS      A button script to play once the clock has started, see VirtualGPIO.run_script()
+#   CLOCK_PI_FRAMES       How many panel frames to keep as PNGs (500, 0 keeps none)
+#   CLOCK_PI_PANEL_TIME   Seconds a full and a partial update take, like "3,0.5" (0,0)
+#   CLOCK_PI_ARDUINO_TIME Seconds the Arduino loop takes per command (0.001)
+#   CLOCK_PI_FONT         clock.py's font, if FreeMono is not installed
+
+############################
+##### Import Libraries #####
+############################
+from collections import deque
+from os import environ, makedirs, mkfifo, path, remove
+from threading import Condition, Lock, Thread
+from math import sin
+from time import sleep, time
+from frames import BAUD_RATES, FRAME_START, MAX_PAYLOAD, PROTOCOL_VERSION, crc8, encode
+
+VIRTUAL = environ.get("CLOCK_PI_HAL", "pi") == "virtual"
+VIRTUAL_DIR = environ.get("CLOCK_PI_DIR", "/tmp/clock-pi")
+
+if VIRTUAL:
+    environ.setdefault("SDL_AUDIODRIVER", "dummy") # pygame plays into nothing
+    if not path.isdir(VIRTUAL_DIR):
+        makedirs(VIRTUAL_DIR)
+
+#####################
+##### Factories #####
+#####################
+def papirus():
+    if VIRTUAL:
+        full_time, partial_time = [float(part) for part in environ.get("CLOCK_PI_PANEL_TIME", "0,0").split(",")]
+        return VirtualPapirus(path.join(VIRTUAL_DIR, "frames"), int(environ.get("CLOCK_PI_FRAMES", 500)), full_time, partial_time)
+    from papirus import Papirus
+    return Papirus()
+
+def gpio():
+    """The RPi.GPIO module, or a VirtualGPIO that stands in for it"""
+    if VIRTUAL:
+        global _gpio
+        if _gpio is None:
+            _gpio = VirtualGPIO()
+            if environ.get("CLOCK_PI_BUTTONS"):
+                with open(environ["CLOCK_PI_BUTTONS"]) as script:
+                    _gpio.run_script(script.read())
+            _gpio.listen(path.join(VIRTUAL_DIR, "buttons"))
+        return _gpio
+    import RPi.GPIO as GPIO
+    return GPIO
+
+_gpio = None
+
+def smbus(busnum=1):
+    if VIRTUAL:
+        return VirtualSMBus(busnum)
+    from smbus import SMBus
+    return SMBus(busnum)
+
+def serial_port(port="/dev/ttyACM0", timeout=2):
+    if VIRTUAL:
+        return FakeArduino(float(environ.get("CLOCK_PI_ARDUINO_TIME", 0.001)), timeout)
+    from serial import Serial
+    board = Serial(port) # Connect to Arduino
+    board.timeout = timeout
+    return board
+
+def simulated_temp(celsius, swing, period=600.0):
+    """A temperature that drifts slowly around celsius, the same in every process"""
+    return celsius + swing * sin(time() / period)
+
+###########################
+##### Virtual Papirus #####
+###########################
+class VirtualPapirus(object):
+    """Keeps the last frame, counts updates and saves the last `keep` frames as numbered PNGs"""
+
+    def __init__(self, folder, keep=500, full_time=0, partial_time=0, size=(264, 176)):
+        self.folder = folder
+        self.keep = keep
+        self.full_time = full_time
+        self.partial_time = partial_time
+        self.size = size
+        self.width, self.height = size
+        self.image = None
+        self.full_updates = 0
+        self.partial_updates = 0
+        self.clears = 0
+        if keep and not path.isdir(folder):
+            makedirs(folder)
+
+    def display(self, image):
+        self.image = image.copy()
+
+    def clear(self):
+        self.clears += 1
+        self.image = None
+
+    def update(self):
+        sleep(self.full_time)
+        self.full_updates += 1
+        self._save("full")
+
+    def partial_update(self):
+        sleep(self.partial_time)
+        self.partial_updates += 1
+        self._save("partial")
+
+    def _save(self, kind):
+        if not self.keep or self.image is None:
+            return
+        number = self.full_updates + self.partial_updates
+        self.image.save(path.join(self.folder, "%06d-%s.png" % (number, kind)))
+        for old_kind in ("full", "partial"):
+            old = path.join(self.folder, "%06d-%s.png" % (number - self.keep, old_kind))
+            if path.exists(old):
+                remove(old)
+
+#############################
+##### Virtual GPIO pins #####
+#############################
+class VirtualGPIO(object):
+    """The parts of RPi.GPIO that buttons.py uses. Inputs idle high, like buttons with pull-ups,
+    and press() pulls one low and calls its edge callback from another thread, as RPi.GPIO does."""
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    HIGH = True
+    LOW = False
+
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}
+        self.presses = 0
+        self._lock = Lock()
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, warnings):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=None, initial=None):
+        self.levels[pin] = True if initial is None else initial
+
+    def input(self, pin):
+        return self.levels.get(pin, True)
+
+    def output(self, pin, level):
+        self.levels[pin] = level
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self):
+        self.callbacks.clear()
+
+    def _set(self, pin, level):
+        with self._lock:
+            self.levels[pin] = level
+            callback = self.callbacks.get(pin)
+        if callback is not None:
+            callback(pin)
+
+    def press(self, pin, held=0.1):
+        """Push a button and let go after held seconds. Blocks until it is released."""
+        self.presses += 1
+        self._set(pin, False)
+        sleep(held)
+        self._set(pin, True)
+
+    def command(self, line):
+        """One script line: "press PIN", "hold PIN SECONDS" or "sleep SECONDS". # starts a comment."""
+        words = line.split("#")[0].split()
+        if not words:
+            return
+        if words[0] == "press":
+            self.press(int(words[1]))
+        elif words[0] == "hold":
+            self.press(int(words[1]), float(words[2]))
+        elif words[0] == "sleep":
+            sleep(float(words[1]))
+        else:
+            raise ValueError("unknown button command: " + line.strip())
+
+    def run_script(self, script):
+        """Play a script (one command per line) in the background"""
+        def run():
+            sleep(1) # Let the program set its pins up
+            for line in script.splitlines():
+                self.command(line)
+        self._start(run)
+
+    def listen(self, fifo):
+        """Take commands written to a FIFO, for example: echo "press 21" > /tmp/clock-pi/buttons"""
+        if not path.exists(fifo):
+            mkfifo(fifo)
+        def run():
+            while True:
+                with open(fifo) as commands: # Blocks until a writer opens it
+                    for line in commands:
+                        try:
+                            self.command(line)
+                        except (ValueError, IndexError) as e:
+                            print(str(e))
+        self._start(run)
+
+    def _start(self, function):
+        thread = Thread(target=function, name="virtual-gpio")
+        thread.daemon = True
+        thread.start()
+
+##############################
+##### Simulated LM75 bus #####
+##############################
+class VirtualSMBus(object):
+    """Answers LM75 temperature reads at 0x48. Anything else is a missing device."""
+    LM75_ADDRESS = 0x48
+
+    def __init__(self, busnum=1):
+        self.busnum = busnum
+        self.reads = 0
+
+    def read_word_data(self, address, register):
+        if address != self.LM75_ADDRESS:
+            raise IOError(121, "Remote I/O error")
+        self.reads += 1
+        if register != 0:
+            return 0
+        raw = int(simulated_temp(21.0, 1.5) * 256) & 0xFF80 # 9 bits, 0.5 C steps
+        return ((raw & 0xFF) << 8) | (raw >> 8) # SMBus words arrive low byte first
+
+########################
+##### Fake Arduino #####
+########################
+# The sketch's command characters: pin and what it does
+ARDUINO_COMMANDS = {}
+for pin, letters in ((13, "QqAa"), (12, "WwSs"), (11, "EeDd"), (10, "RrFf"), (9, "TtGg")):
+    for action, letter in zip(("on", "off", "toggle", "status"), letters):
+        ARDUINO_COMMANDS[letter] = (pin, action)
+MASK_PINS = (9, 10, 11, 12, 13, 8) # Bit 0 first, for the 'x' and 'Y' bulk commands
+
+class FakeArduino(object):
+    """Stands in for the Serial connection to arduino_program.ino. It takes the same single
+    character commands and the frames in frames.py. Each command takes loop_time to be handled,
+    plus the time its bytes take at the baud rate. Set baudrate as with pyserial; bytes sent
+    at a rate the sketch is not using are lost, as they would be on the wire."""
+
+    def __init__(self, loop_time=0.001, timeout=2, baudrate=9600):
+        self.loop_time = loop_time
+        self.timeout = timeout
+        self.baudrate = baudrate # The Pi's end
+        self.pins = dict((pin, False) for pin in (13, 12, 11, 10, 9))
+        self.button = False # Pin 8, the reboot button
+        self.commands = 0
+        self.lost = 0 # Bytes sent at the wrong baud rate
+        self._baud = 9600 # The sketch's end
+        self._baud_check_at = 0 # Back to 9600 then, unless a good frame arrives first
+        self._mask = None # The hex digits of a 'Y' command, while they arrive
+        self._frame = None # The frame being read, from its length byte on
+        self._framed = False # A good frame has arrived, bytes outside frames are ignored
+        self._replies = deque() # (time it has been sent, bytes)
+        self._ready = 0 # When the sketch finishes what it has been sent so far
+        self._sending = 0 # When the sketch finishes sending its replies, the line is full duplex
+        self._condition = Condition()
+
+    @property
+    def in_waiting(self):
+        with self._condition:
+            return sum(len(data) for sent, data in self._replies if sent <= time())
+
+    def write(self, data):
+        with self._condition:
+            if self._baud_check_at and time() > self._baud_check_at:
+                self._baud, self._baud_check_at = 9600, 0
+            if self.baudrate != self._baud:
+                self.lost += len(data)
+                return len(data)
+            for byte in bytearray(data):
+                self._ready = max(self._ready, time()) + 10.0 / self._baud
+                if self._frame is not None:
+                    self._frame.append(byte)
+                    if len(self._frame) == 1 and not 0 < byte <= MAX_PAYLOAD:
+                        self._frame = None
+                    elif len(self._frame) > 1 and len(self._frame) == self._frame[0] + 3:
+                        frame, self._frame = self._frame, None
+                        self._reply(self._run_frame(frame))
+                elif byte == FRAME_START:
+                    self._frame = bytearray()
+                elif not self._framed:
+                    self._reply(self._run(chr(byte)))
+            self._condition.notify_all()
+        return len(data)
+
+    def _reply(self, reply):
+        self._ready += self.loop_time
+        self.commands += 1
+        if reply is not None:
+            self._send(reply)
+
+    def _send(self, reply):
+        self._sending = max(self._sending, self._ready) + len(reply) * 10.0 / self._baud
+        self._replies.append((self._sending, reply))
+
+    def _run(self, character):
+        if self._mask is not None:
+            self._mask += character
+            if len(self._mask) == 4:
+                mask, self._mask = self._mask, None
+                return self._set_mask(mask)
+            return None
+        if character == "Y":
+            self._mask = ""
+            return None
+        if character == "x":
+            return "M%02X\r\n" % self._pin_mask()
+        if character == "h":
+            return str(self.button) + "\r\n"
+        if character not in ARDUINO_COMMANDS:
+            return "'" + character + "' is not a command!\r\n"
+        pin, action = ARDUINO_COMMANDS[character]
+        if action == "status":
+            return str(self.pins[pin]) + "\r\n"
+        self.pins[pin] = action == "on" or (action == "toggle" and not self.pins[pin])
+        return None
+
+    def _pin_mask(self):
+        states = [self.pins[pin] for pin in MASK_PINS[:-1]] + [self.button]
+        return sum(1 << bit for bit, state in enumerate(states) if state)
+
+    def _set_pins(self, chosen, states):
+        for bit, pin in enumerate(MASK_PINS[:-1]):
+            if chosen & (1 << bit):
+                self.pins[pin] = bool(states & (1 << bit))
+
+    def _set_mask(self, mask):
+        try:
+            chosen, states = int(mask[:2], 16), int(mask[2:], 16)
+        except ValueError:
+            return "Bad mask\r\n"
+        self._set_pins(chosen, states)
+        return None
+
+    def _run_frame(self, frame):
+        length, seq, payload = frame[0], frame[1], frame[2:-1]
+        if crc8(frame[:-1]) != frame[-1]:
+            return encode(seq, b"E\x01")
+        self._baud_check_at = 0
+        self._framed = True
+        command = chr(payload[0])
+        if command == "V":
+            return encode(seq, bytearray([ord("V"), PROTOCOL_VERSION]))
+        if command == "x":
+            return encode(seq, bytearray([ord("M"), self._pin_mask()]))
+        if command in "YTB" and length < (3 if command == "Y" else 2):
+            return encode(seq, b"E\x02")
+        if command == "Y":
+            self._set_pins(payload[1], payload[2])
+        elif command == "T":
+            self._set_pins(payload[1], self._pin_mask() ^ payload[1])
+        elif command == "B":
+            if payload[1] >= len(BAUD_RATES):
+                return encode(seq, b"E\x02")
+            self._send(encode(seq, b"K\x00")) # At the old rate
+            self._ready = self._sending # Serial.flush()
+            self._baud = BAUD_RATES[payload[1]]
+            self._baud_check_at = self._ready + 2 if payload[1] else 0
+            return None
+        else:
+            return encode(seq, b"E\x03")
+        return encode(seq, b"K\x00")
+
+    def flush(self):
+        """Wait until everything written has been taken in"""
+        with self._condition:
+            ready = self._ready
+        if ready > time():
+            sleep(ready - time())
+
+    def read(self, size=1):
+        deadline = time() + (self.timeout if self.timeout is not None else 1e9)
+        with self._condition:
+            while True:
+                data = bytearray()
+                while self._replies and self._replies[0][0] <= time() and len(data) < size:
+                    sent, chunk = self._replies.popleft()
+                    wanted = size - len(data)
+                    data += bytearray(chunk[:wanted])
+                    if len(chunk) > wanted: # Keep the rest for the next read
+                        self._replies.appendleft((sent, chunk[wanted:]))
+                if data or time() >= deadline:
+                    return bytes(data)
+                wake = deadline
+                if self._replies:
+                    wake = min(wake, self._replies[0][0])
+                self._condition.wait(max(0, wake - time()))
+
+    def readline(self):
+        deadline = time() + (self.timeout if self.timeout is not None else 1e9)
+        with self._condition:
+            while True:
+                if self._replies and self._replies[0][0] <= time():
+                    return self._replies.popleft()[1]
+                wake = deadline
+                if self._replies:
+                    wake = min(wake, self._replies[0][0])
+                if time() >= deadline:
+                    return ""
+                self._condition.wait(max(0, wake - time()))
+
+    def reset_input_buffer(self):
+        with self._condition:
+            self._replies.clear()
+
+    def close(self):
+        pass
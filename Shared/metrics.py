@@ -0,0 +1,224 @@
+##################################################################
+##### Temperature and load history in a fixed size mmap file #####
+##################################################################
+
+############################
+##### Import Libraries #####
+############################
+from os import close, fsync, getpid, open as os_open, path, rename, write, O_CREAT, O_EXCL, O_RDWR, O_WRONLY
+from fcntl import flock, LOCK_EX, LOCK_UN
+from math import ceil
+from struct import Struct
+from threading import Lock
+from time import time
+import mmap
+
+METRICS_FILE = path.join(path.dirname(path.abspath(__file__)), "..", "Clock", "metrics.bin")
+METRICS = ("lm75_temp", "cpu_temp", "gpu_temp", "cpu_percent", "memory_percent")
+# (name, seconds per record, records kept): 1 day of raw samples, 1 week of minutes, 1 year of hours
+TIERS = (("raw", 10, 8640), ("minute", 60, 10080), ("hour", 3600, 8760))
+MAX_POINTS = 2000
+
+_HEADER = Struct("<4sHH")
+_MAGIC = b"CPMS"
+_VERSION = 1
+_NAN = float("nan")
+
+######################################
+##### Time addressed ring buffer #####
+######################################
+class MetricsStore(object):
+    """Every tier is a ring of fixed size records. A record's slot comes from its time
+    ((time // step) % records), so appending touches one record per tier and reading
+    any range only visits the records inside it, however much history there is.
+
+    Each record holds a count, mean, minimum and maximum per metric. A raw sample is
+    folded into its 10 second, minute and hour records as it arrives, so there is no
+    separate rollup job. The file never grows and only the pages that changed are
+    written back by the kernel, which keeps SD card writes down."""
+
+    def __init__(self, metrics_file=METRICS_FILE, metrics=METRICS, tiers=TIERS):
+        self.metrics_file = metrics_file
+        self.metrics = tuple(metrics)
+        self.tiers = tuple(tiers)
+        count = len(self.metrics)
+        self._record = Struct("<I" + "H" * count + "f" * (3 * count)) # time, counts, then mean, min, max for each metric
+        self._offsets = {}
+        offset = _HEADER.size
+        for name, step, records in self.tiers:
+            self._offsets[name] = offset
+            offset += records * self._record.size
+        self._size = offset
+        self._lock = Lock()
+        self.appends = 0
+
+        # clock.py and web.py start together. Only one may create the file, or the other would
+        # map a file that the second rename has already unlinked.
+        lock_fd = os_open(metrics_file + ".lock", O_RDWR | O_CREAT, 0o644)
+        try:
+            flock(lock_fd, LOCK_EX)
+            if not path.exists(metrics_file) or path.getsize(metrics_file) != self._size or not self._header_ok():
+                self._create()
+            self._file = open(metrics_file, "r+b")
+        finally:
+            flock(lock_fd, LOCK_UN)
+            close(lock_fd)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+
+    def _header_ok(self):
+        with open(self.metrics_file, "rb") as f:
+            magic, version, count = _HEADER.unpack(f.read(_HEADER.size))
+        return magic == _MAGIC and version == _VERSION and count == len(self.metrics)
+
+    def _create(self):
+        """Write an empty file and move it into place, so a reader never sees half of one"""
+        temp_file = self.metrics_file + "." + str(getpid()) + ".tmp"
+        fd = os_open(temp_file, O_WRONLY | O_CREAT | O_EXCL, 0o644)
+        try:
+            write(fd, _HEADER.pack(_MAGIC, _VERSION, len(self.metrics)))
+            chunk = b"\0" * 65536
+            left = self._size - _HEADER.size
+            while left > 0:
+                left -= write(fd, chunk[:min(left, len(chunk))])
+            fsync(fd)
+        finally:
+            close(fd)
+        rename(temp_file, self.metrics_file)
+
+    def _slot(self, tier, bucket):
+        name, step, records = tier
+        return self._offsets[name] + ((bucket // step) % records) * self._record.size
+
+    def _read(self, tier, bucket):
+        """The record for the bucket starting at `bucket`, or None if that slot holds something else"""
+        values = self._record.unpack_from(self._map, self._slot(tier, bucket))
+        if values[0] != bucket:
+            return None
+        return values
+
+    ##################
+    ##### Append #####
+    ##################
+    def append(self, values, when=None):
+        """Record one sample. values maps a metric name to a number (missing or None is skipped)."""
+        when = int(time() if when is None else when)
+        count = len(self.metrics)
+        with self._lock:
+            for tier in self.tiers:
+                step = tier[1]
+                bucket = when - when % step
+                offset = self._slot(tier, bucket)
+                record = list(self._record.unpack_from(self._map, offset))
+                if record[0] != bucket: # The slot still holds an old record, start it again
+                    record = [bucket] + [0] * count + [_NAN] * (3 * count)
+                for index, metric in enumerate(self.metrics):
+                    value = values.get(metric)
+                    if value is None:
+                        continue
+                    value = float(value)
+                    n = record[1 + index]
+                    stats = 1 + count + 3 * index
+                    if n == 0:
+                        record[stats:stats + 3] = [value, value, value]
+                    else:
+                        record[stats] += (value - record[stats]) / (n + 1) # Running mean
+                        record[stats + 1] = min(record[stats + 1], value)
+                        record[stats + 2] = max(record[stats + 2], value)
+                    record[1 + index] = min(n + 1, 0xFFFF)
+                self._record.pack_into(self._map, offset, *record)
+            self.appends += 1
+
+    def flush(self):
+        self._map.flush()
+
+    #################
+    ##### Query #####
+    #################
+    def series(self, start, end=None, max_points=500, metrics=None):
+        """Points between start and end (time() seconds), at most max_points of them.
+
+        Uses the coarsest tier that is still at least as fine as the resolution asked for
+        (and still has data back to start), then merges neighbouring records down to max_points.
+        Returns (tier name, seconds per point, {metric: [[time, mean, min, max], ...]})."""
+        now = time()
+        end = now if end is None else min(end, now)
+        start = max(start, now - max(step * records for name, step, records in self.tiers)) # Nothing older is kept
+        max_points = max(1, min(int(max_points), MAX_POINTS))
+        metrics = self.metrics if metrics is None else [metric for metric in metrics if metric in self.metrics]
+        span = max(1, end - start)
+        wanted = span / float(max_points)
+
+        covering = [tier for tier in self.tiers if now - tier[1] * tier[2] <= start] or [self.tiers[-1]]
+        finer = [tier for tier in covering if tier[1] <= wanted]
+        tier = finer[-1] if finer else covering[0]
+        step = tier[1]
+        group = max(1, int(ceil(wanted / step))) # Records merged into each point
+        point_step = step * group
+        start = max(start, now - step * tier[2]) # The oldest record this tier still has
+
+        count = len(self.metrics)
+        indexes = [self.metrics.index(metric) for metric in metrics]
+        result = dict((metric, []) for metric in metrics)
+        first = int(start) - int(start) % point_step
+        points = max(0, (int(end) - first) // point_step + 1)
+        if points > max_points: # Rounding start down can add a point, drop the oldest ones
+            first += (points - max_points) * point_step
+            points = max_points
+        with self._lock:
+            for point in range(first, first + points * point_step, point_step):
+                merged = [None] * len(indexes)
+                for bucket in range(point, point + point_step, step):
+                    record = self._read(tier, bucket)
+                    if record is None:
+                        continue
+                    for position, index in enumerate(indexes):
+                        n = record[1 + index]
+                        if n == 0:
+                            continue
+                        stats = 1 + count + 3 * index
+                        mean, low, high = record[stats:stats + 3]
+                        if merged[position] is None:
+                            merged[position] = [n, mean, low, high]
+                        else:
+                            total = merged[position]
+                            total[1] = (total[1] * total[0] + mean * n) / (total[0] + n)
+                            total[0] += n
+                            total[2] = min(total[2], low)
+                            total[3] = max(total[3], high)
+                for position, metric in enumerate(metrics):
+                    if merged[position] is not None:
+                        n, mean, low, high = merged[position]
+                        result[metric].append([point, round(mean, 2), round(low, 2), round(high, 2)])
+        return tier[0], point_step, result
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+########################################
+##### Benchmark: a year of history #####
+########################################
+if __name__ == "__main__":
+    from math import sin
+    from tempfile import mkdtemp
+    from shutil import rmtree
+
+    folder = mkdtemp()
+    try:
+        store = MetricsStore(path.join(folder, "metrics.bin"))
+        now = int(time())
+        started = time()
+        samples = 0
+        for when in range(now - 3 * 86400, now, TIERS[0][1]): # Three days of 10 second samples
+            store.append({"cpu_temp": 120 + 10 * sin(when / 3600.0), "cpu_percent": when % 100}, when)
+            samples += 1
+        append_time = (time() - started) / samples
+        print("%d appends, %.0f us each, file is %d KB" % (samples, append_time * 1e6, path.getsize(store.metrics_file) // 1024))
+
+        for hours in (1, 24, 72, 24 * 365):
+            started = time()
+            tier, step, result = store.series(now - hours * 3600, now, 300)
+            print("%5d hours: %s tier, %d s per point, %d points, %.1f ms" % (hours, tier, step, len(result["cpu_temp"]), (time() - started) * 1000))
+        store.close()
+    finally:
+        rmtree(folder)
@@ -0,0 +1,271 @@
+########################################################
+##### Talk to the relay server (arduino_server.py) #####
+########################################################
+
+############################
+##### Import Libraries #####
+############################
+from threading import Event, Lock, Semaphore, Thread
+from time import time
+from os import path
+from hal import VIRTUAL, VIRTUAL_DIR
+import socket
+
+SOCKET_FILE = path.join(VIRTUAL_DIR, "relay.sock") if VIRTUAL else "/var/run/clock-pi-relay.sock"
+RELAY_PINS = (12, 11, 10, 9)
+RECONCILE_TIME = 10 # Seconds between RelayCache reading every relay from the Arduino
+
+class RelayError(Exception):
+    pass
+
+#####################################################
+##### Persistent connection to the relay server #####
+#####################################################
+class RelayClient(object):
+    """Sends line commands such as "on 12 11 10 9" over a persistent Unix socket connection
+    and waits for the server's "ok". Up to `connections` requests are sent at once, each on
+    its own connection. Connections are opened on first use, and opened again once if the
+    server restarted before the command could be sent."""
+
+    def __init__(self, socket_file=SOCKET_FILE, timeout=5, connections=1):
+        self.socket_file = socket_file
+        self.timeout = timeout
+        self._slots = Semaphore(connections) # One request per connection at a time
+        self._lock = Lock()
+        self._idle = [] # (socket, reader) of connections not in use
+        self.requests = 0
+        self.last_latency = 0 # Seconds the last request took, acknowledgement included
+
+    def _connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        connection.connect(self.socket_file)
+        return connection, connection.makefile("rb")
+
+    def request(self, *words):
+        """Send one command and return the words after "ok" in the reply"""
+        line = " ".join(str(word) for word in words) + "\n"
+        with self._slots:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            started = time()
+            for attempt in range(2):
+                sent = False
+                try:
+                    if connection is None:
+                        connection = self._connect()
+                    connection[0].sendall(line.encode("ascii"))
+                    sent = True
+                    reply = connection[1].readline().decode("ascii").split()
+                    if not reply:
+                        raise socket.error("relay server closed the connection")
+                    break
+                except (socket.error, socket.timeout) as e:
+                    self._close(connection)
+                    connection = None
+                    # Only try again if the server never got the command. Once it has, running
+                    # it twice could undo it (a toggle) and a slow reply means it is still going.
+                    if sent or attempt == 1:
+                        raise RelayError("Could not reach relay server: " + str(e))
+            with self._lock:
+                self._idle.append(connection)
+                self.requests += 1
+                self.last_latency = time() - started
+
+        if reply[0] != "ok":
+            raise RelayError(" ".join(reply[1:]))
+        return reply[1:]
+
+    ##########################
+    ##### Relay commands #####
+    ##########################
+    def state(self, *pins):
+        """Return {pin: True/False} for each pin (every relay if none are given)"""
+        pins = pins or RELAY_PINS
+        states = self.request("get", *pins)
+        return dict((int(pin), state == "1") for pin, state in zip(pins, states))
+
+    def set(self, states):
+        """Set several relays from {pin: True/False}. The Arduino changes them all at once."""
+        self.request("set", *[str(pin) + "=" + ("1" if on else "0") for pin, on in sorted(states.items())])
+
+    def button(self):
+        """True while the reboot button on pin 8 is held down"""
+        return self.request("button") == ["1"]
+
+    def stats(self):
+        """The server's counters: commands, queue depth, round trip latency, reconnects..."""
+        return dict((name, float(value)) for name, value in (word.split("=") for word in self.request("stats")))
+
+    def _close(self, connection):
+        if connection is not None:
+            try:
+                connection[1].close()
+                connection[0].close()
+            except socket.error:
+                pass
+
+    def close(self):
+        with self._lock:
+            for connection in self._idle:
+                self._close(connection)
+            self._idle = []
+
+########################################
+##### Relay states, kept in memory #####
+########################################
+class RelayCache(object):
+    """What every relay is set to, answered from memory. Changes made through switch()
+    update it as soon as the server acknowledges them, and a background thread reads
+    every relay every `interval` seconds to pick up changes made by clock.py or lost
+    by the Arduino resetting. Each pin that reading finds different counts as drift."""
+
+    def __init__(self, client, interval=RECONCILE_TIME):
+        self.client = client
+        self.interval = interval
+        self._states = {}
+        self._writes = 0 # Changes made through switch(), so a reading from before one is not kept
+        self._lock = Lock()
+        self._stop = Event()
+        self._callbacks = []
+        self.last_reconcile = 0
+
+        # Counters
+        self.hits = 0
+        self.misses = 0 # Reads that had to ask the Arduino, before the first reconcile
+        self.reconciles = 0
+        self.drift = 0
+        self.errors = 0
+
+        self._thread = Thread(target=self._run, name="relay-cache")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def state(self, *pins):
+        """Return {pin: True/False} for each pin (every relay if none are given)"""
+        pins = [int(pin) for pin in pins or RELAY_PINS]
+        with self._lock:
+            known = all(pin in self._states for pin in pins)
+            if known:
+                self.hits += 1
+                return dict((pin, self._states[pin]) for pin in pins)
+            self.misses += 1
+        self.reconcile() # RelayError if the server cannot be reached, as with an uncached read
+        with self._lock:
+            states = dict((pin, self._states[pin]) for pin in pins if pin in self._states)
+        missing = [pin for pin in pins if pin not in states]
+        if missing: # A switch raced the reading and it was thrown away, ask the Arduino directly
+            states.update(self.client.state(*missing))
+        return states
+
+    def switch(self, action, *pins):
+        """Send "on", "off" or "toggle" for the pins and remember what they are now"""
+        self.client.request(action, *pins)
+        with self._lock:
+            self._writes += 1
+            states = {}
+            for pin in pins:
+                pin = int(pin)
+                if action != "toggle":
+                    states[pin] = action == "on"
+                elif pin in self._states:
+                    states[pin] = not self._states[pin]
+            changed = self._update(states)
+        self._changed(changed)
+
+    def set(self, states):
+        """Set several relays from {pin: True/False} and remember them"""
+        self.client.set(states)
+        with self._lock:
+            self._writes += 1
+            changed = self._update(dict((int(pin), on) for pin, on in states.items()))
+        self._changed(changed)
+
+    def reconcile(self):
+        """Read every relay from the Arduino and correct the states in memory"""
+        with self._lock:
+            writes = self._writes
+        states = self.client.state()
+        with self._lock:
+            if self._writes != writes: # Something was switched while we were reading, the reading is old
+                return
+            changed = {}
+            for pin, state in states.items():
+                if pin in self._states and self._states[pin] != state:
+                    self.drift += 1
+                if self._states.get(pin) != state:
+                    changed[pin] = state
+                self._states[pin] = state
+            self.reconciles += 1
+            self.last_reconcile = time()
+        self._changed(changed)
+
+    def watch(self, callback):
+        """callback({pin: True/False}) is called with the relays that changed, after a switch
+        or when a reading finds something else (clock.py) changed them"""
+        self._callbacks.append(callback)
+
+    def _update(self, states):
+        """Remember states and return the ones that are different from before. Call with the lock held."""
+        changed = dict((pin, on) for pin, on in states.items() if self._states.get(pin) != on)
+        self._states.update(states)
+        return changed
+
+    def _changed(self, changed):
+        if changed:
+            for callback in self._callbacks:
+                callback(changed)
+
+    def stats(self):
+        reads = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / float(reads), 4) if reads else 0,
+            "reconciles": self.reconciles,
+            "drift": self.drift,
+            "errors": self.errors,
+            "age": round(time() - self.last_reconcile, 1) if self.last_reconcile else None,
+        }
+
+    def close(self):
+        self._stop.set()
+
+    def _run(self):
+        error = None
+        while True:
+            try:
+                self.reconcile()
+                error = None
+            except RelayError as e:
+                self.errors += 1
+                if str(e) != error: # Once, not every interval
+                    print("Could not read the relays: " + str(e))
+                error = str(e)
+            if self._stop.wait(self.interval):
+                return
+
+#######################################################
+##### Benchmark: several clients at the same time #####
+#######################################################
+if __name__ == "__main__":
+    import sys
+
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    latencies = []
+    def run():
+        client = RelayClient()
+        for request in range(count):
+            client.state()
+            latencies.append(client.last_latency)
+        client.close()
+    started = time()
+    threads = [Thread(target=run) for client in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    print("%d clients x %d reads of every relay in %.2f s, %.0f ms average, %.0f ms worst" % (clients, count, time() - started, sum(latencies) / len(latencies) * 1000, latencies[-1] * 1000))
+    print(" ".join("%s=%g" % item for item in sorted(RelayClient().stats().items())))
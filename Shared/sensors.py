@@ -0,0 +1,206 @@
+############################################################
+##### Temperatures and load, sampled in the background #####
+############################################################
+
+############################
+##### Import Libraries #####
+############################
+from collections import namedtuple
+from datetime import timedelta
+from heapq import heappop, heappush
+from os import popen
+import hal
+from threading import Event, Lock, Thread
+from time import time
+
+#################################################
+##### Define class to get Raspberry Pi temp #####
+#################################################
+def get_cpu_temp():
+    with open("/sys/class/thermal/thermal_zone0/temp", "r") as tempfile:
+        cpu_temp = int(tempfile.read()) / 1000
+    cpu_temp = (cpu_temp * (9.0/5.0)) + 32.0
+    return str(cpu_temp)
+
+def get_gpu_temp():
+    with popen("/opt/vc/bin/vcgencmd measure_temp") as tempfile:
+        gpu_temp = int(tempfile.read().replace("temp=", "").split(".")[0])
+    gpu_temp = (gpu_temp * (9.0/5.0)) + 32.0
+    return str(gpu_temp)
+
+#########################################
+##### Define class to get LM75 temp #####
+#########################################
+LM75_ADDRESS = 0x48
+LM75_TEMP_REGISTER = 0
+LM75_CONF_REGISTER = 1
+LM75_THYST_REGISTER = 2
+LM75_TOS_REGISTER = 3
+LM75_CONF_SHUTDOWN = 0
+LM75_CONF_OS_COMP_INT = 1
+LM75_CONF_OS_POL = 2
+LM75_CONF_OS_F_QUE = 3
+
+class LM75(object):
+	def __init__(self, mode=LM75_CONF_OS_COMP_INT, address=LM75_ADDRESS, busnum=1):
+		self._mode = mode
+		self._address = address
+		self._bus = hal.smbus(busnum)
+
+	def regdata2float (self, regdata):
+		return (regdata / 32.0) / 8.0
+	def toFah(self, temp):
+		return (temp * (9.0/5.0)) + 32.0
+
+	def getTemp(self):
+		raw = self._bus.read_word_data(self._address, LM75_TEMP_REGISTER) & 0xFFFF
+		raw = ((raw << 8) & 0xFF00) + (raw >> 8)
+		return self.toFah(self.regdata2float(raw))
+
+	def getTempC(self):
+		raw = self._bus.read_word_data(self._address, LM75_TEMP_REGISTER) & 0xFFFF
+		raw = ((raw << 8) & 0xFF00) + (raw >> 8)
+		return self.regdata2float(raw)
+
+######################################
+##### Define class to get uptime #####
+######################################
+def get_up_stats():
+    with open('/proc/uptime', 'r') as f:
+        uptime_seconds = float(f.readline().split()[0])
+        uptime_string = str(timedelta(seconds = uptime_seconds))
+        uptime_string = uptime_string.split(".")[0]
+    return uptime_string
+
+def get_boot_time():
+    """When the Pi started, as a Unix time"""
+    with open('/proc/uptime', 'r') as f:
+        return int(time() - float(f.readline().split()[0]))
+
+# The latest value from a source, when it was read (time()) and why the last read failed, if it did
+Reading = namedtuple("Reading", ["value", "time", "error"])
+
+################################################
+##### Poll each source on its own interval #####
+################################################
+class SensorSampler(object):
+    """Reads every source in a background thread, each on its own interval, and keeps the latest value.
+
+    sources maps a name to (function, interval in seconds). get() answers from memory,
+    only reading the source itself if nothing has been read yet or the value is older than max_age.
+    If given, run(function) is used to call a source, for example in a thread pool."""
+
+    def __init__(self, sources, run=None):
+        self.sources = dict(sources)
+        self._run = run
+        self._readings = {}
+        self._lock = Lock()
+        self._stop = Event()
+        self._callbacks = []
+
+        # Counters
+        self.reads = 0 # Times a source was actually read
+        self.hits = 0 # get() calls answered from memory
+        self.misses = 0
+        self.errors = 0
+
+        self._thread = Thread(target=self._sample, name="sensors")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get(self, name, max_age=None):
+        """The latest value for name. max_age defaults to twice the source's interval."""
+        reading = self._readings.get(name)
+        if max_age is None:
+            max_age = self.sources[name][1] * 2
+        if reading is not None and reading.value is not None and time() - reading.time <= max_age:
+            self.hits += 1
+            return reading.value
+        self.misses += 1
+        return self.read(name)
+
+    def reading(self, name):
+        """The latest Reading for name, or None, without ever touching the source"""
+        return self._readings.get(name)
+
+    def latest(self, max_age):
+        """Every value read in the last max_age seconds, without ever touching a source"""
+        now = time()
+        return dict((name, reading.value) for name, reading in self._readings.items()
+                    if reading.value is not None and now - reading.time <= max_age)
+
+    def read(self, name):
+        """Read the source now. Errors are raised, after being recorded."""
+        function = self.sources[name][0]
+        with self._lock: # One read of the bus or vcgencmd at a time
+            self.reads += 1
+            try:
+                value = function() if self._run is None else self._run(function)
+            except Exception as e:
+                self.errors += 1
+                old = self._readings.get(name)
+                self._readings[name] = Reading(old.value if old else None, old.time if old else 0, str(e))
+                raise
+            self._readings[name] = Reading(value, time(), None)
+        for callback in self._callbacks:
+            callback(name, value)
+        return value
+
+    def watch(self, callback):
+        """callback(name, value) is called after every successful read"""
+        self._callbacks.append(callback)
+
+    def stats(self):
+        return {
+            "reads": self.reads,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "ages": dict((name, round(time() - reading.time, 1)) for name, reading in self._readings.items() if reading.time),
+        }
+
+    def close(self):
+        self._stop.set()
+
+    def _sample(self):
+        due = []
+        for name in self.sources:
+            heappush(due, (time(), name))
+        while due and not self._stop.is_set():
+            when, name = heappop(due)
+            if self._stop.wait(max(0, when - time())):
+                return
+            old = self._readings.get(name)
+            try:
+                self.read(name)
+            except Exception as e:
+                if old is None or old.error != str(e): # Once, not every interval
+                    print("Could not read " + name + ": " + str(e)) # Keep sampling the other sources
+            heappush(due, (max(when + self.sources[name][1], time()), name))
+
+################################
+##### The Pi's own sensors #####
+################################
+def cpu_percent():
+    import psutil # Imported by the sampler thread, not while the program starts
+    return psutil.cpu_percent() # Usage since the last sample
+
+def memory_percent():
+    import psutil
+    return psutil.virtual_memory().percent
+
+def pi_sensors(run=None):
+    """A SensorSampler for everything the Info screens and the web page show"""
+    if hal.VIRTUAL: # No thermal zone or vcgencmd off the Pi
+        cpu_temp = lambda: str(hal.simulated_temp(45.0, 5.0) * (9.0/5.0) + 32.0)
+        gpu_temp = lambda: str(int(hal.simulated_temp(46.0, 5.0)) * (9.0/5.0) + 32.0)
+    else:
+        cpu_temp, gpu_temp = get_cpu_temp, get_gpu_temp
+    sources = {
+        "cpu_temp": (cpu_temp, 10),
+        "gpu_temp": (gpu_temp, 30), # vcgencmd is a fork, so not too often
+        "cpu_percent": (cpu_percent, 5),
+        "memory_percent": (memory_percent, 10),
+        "lm75_temp": (LM75().getTemp, 30), # Connect to LM75 Temperature sensor
+    }
+    return SensorSampler(sources, run)
@@ -0,0 +1,110 @@
+#####################################################
+##### Watch a directory for files being changed #####
+#####################################################
+
+############################
+##### Import Libraries #####
+############################
+from os import close, listdir, path, pipe, read, stat, write
+from threading import Thread
+from select import select
+from struct import unpack_from
+import ctypes
+
+# inotify event masks (see inotify(7))
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MOVED_FROM = 0x040
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVED_FROM
+EVENT_HEADER = 16 # struct inotify_event without the name: int wd, uint32 mask, cookie, len
+
+POLL_TIME = 2 # Seconds between checks when inotify is not available
+
+def _inotify():
+    try:
+        libc = ctypes.CDLL("libc.so.6", use_errno=True)
+        return libc.inotify_init, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+######################################################
+##### Call back when files in a directory change #####
+######################################################
+class FileWatcher(object):
+    """Calls callback(name) from a background thread whenever a file in
+    directory is written, replaced or removed. If names is given, only
+    those file names are reported."""
+
+    def __init__(self, directory, callback, names=None):
+        self.directory = directory
+        self.callback = callback
+        self.names = set(names) if names is not None else None
+        self._stop_read, self._stop_write = pipe()
+        self._fd = None
+
+        inotify = _inotify()
+        if inotify is not None:
+            inotify_init, inotify_add_watch = inotify
+            fd = inotify_init()
+            if fd >= 0 and inotify_add_watch(fd, directory.encode("utf-8"), WATCH_MASK) >= 0:
+                self._fd = fd
+            elif fd >= 0:
+                close(fd)
+
+        target = self._watch if self._fd is not None else self._poll
+        self._thread = Thread(target=target)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def _report(self, name):
+        if self.names is None or name in self.names:
+            self.callback(name)
+
+    def _watch(self):
+        while True:
+            readable = select([self._fd, self._stop_read], [], [])[0]
+            if self._stop_read in readable:
+                return
+            data = read(self._fd, 4096)
+            offset = 0
+            changed = []
+            while offset + EVENT_HEADER <= len(data):
+                wd, mask, cookie, length = unpack_from("iIII", data, offset)
+                name = data[offset + EVENT_HEADER:offset + EVENT_HEADER + length].rstrip(b"\0").decode("utf-8")
+                offset += EVENT_HEADER + length
+                if name not in changed:
+                    changed.append(name)
+            for name in changed:
+                self._report(name)
+
+    # Fallback for systems without inotify: compare modification times
+    def _poll(self):
+        seen = self._mtimes()
+        while not select([self._stop_read], [], [], POLL_TIME)[0]:
+            now = self._mtimes()
+            for name in set(seen) | set(now):
+                if seen.get(name) != now.get(name):
+                    self._report(name)
+            seen = now
+
+    def _mtimes(self):
+        mtimes = {}
+        for name in listdir(self.directory):
+            try:
+                mtimes[name] = stat(path.join(self.directory, name)).st_mtime
+            except OSError:
+                pass
+        return mtimes
+
+    def close(self):
+        write(self._stop_write, b"x")
+        self._thread.join(1)
+        if self._fd is not None:
+            close(self._fd)
+            self._fd = None
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+#############################################################
+##### Poll web.py the way Homebridge does, many at once #####
+#############################################################
+# python benchmark.py [clients] [seconds] [host:port]
+# python benchmark.py all [clients] [seconds] [host:port] asks /api/info/all/ for everything instead, with If-None-Match
+# python benchmark.py events [switches] [host:port] times a switch until its event arrives on /api/events/
+# Start web.py first, as "python web.py" (gevent) or "python web.py flask" (the development server).
+
+############################
+##### Import Libraries #####
+############################
+from httplib import HTTPConnection, HTTPException
+from socket import error as socket_error
+from threading import Thread
+from time import time
+import json
+import socket
+import sys
+
+# What Homebridge asks for: every relay, the temperature, and now and then a switch
+REQUESTS = [("GET", "/api/info/" + str(pin) + "/") for pin in (12, 11, 10, 9)] + [("GET", "/api/info/temperature/")]
+SWITCH_EVERY = 20 # One HEAD /api/on/9/ in this many requests
+
+def poll(address, seconds, latencies, errors, requests=REQUESTS, not_modified=None):
+    connection = HTTPConnection(address, timeout=10) # Kept alive when the server allows it
+    end = time() + seconds
+    number = 0
+    etag = None
+    while time() < end:
+        method, url = ("HEAD", "/api/on/9/") if number % SWITCH_EVERY == SWITCH_EVERY - 1 else requests[number % len(requests)]
+        number += 1
+        started = time()
+        try:
+            connection.request(method, url, headers={"If-None-Match": etag} if etag and method == "GET" else {})
+            response = connection.getresponse()
+            response.read()
+            if not_modified is not None and method == "GET":
+                not_modified.append(response.status == 304)
+            if response.status not in (200, 304):
+                errors.append(response.status)
+                continue
+            etag = response.getheader("ETag", etag)
+        except (HTTPException, socket_error) as e:
+            errors.append(str(e))
+            connection.close()
+            continue
+        latencies.append(time() - started)
+    connection.close()
+
+def events(address, switches):
+    """Toggle pin 9 and wait for the change to come back as an event, again and again"""
+    host, port = address.split(":")
+    stream = socket.create_connection((host, int(port)), timeout=10)
+    stream.sendall("GET /api/events/ HTTP/1.0\r\nHost: " + address + "\r\n\r\n") # HTTP/1.0, so the events are not chunked
+    lines = stream.makefile("rb")
+    connection = HTTPConnection(address, timeout=10)
+
+    def next_event():
+        name = data = None
+        for line in iter(lines.readline, ""):
+            line = line.rstrip("\r\n")
+            if line.startswith("event: "):
+                name = line[7:]
+            elif line.startswith("data: "):
+                data = json.loads(line[6:])
+            elif not line and name:
+                return name, data
+        raise socket.error("event stream closed")
+
+    while next_event()[0] != "alarm": # The snapshot sent on connecting ends with the alarm
+        pass
+    latencies = []
+    pushes = [] # Publish to arrival, the part spent in web.py's queues and the network
+    for number in range(switches):
+        started = time()
+        connection.request("HEAD", "/api/toggle/9/")
+        connection.getresponse().read()
+        while True:
+            name, data = next_event()
+            if name == "relays" and "9" in data:
+                break
+        latencies.append(time() - started)
+        pushes.append(time() - data["time"])
+    stream.close()
+    connection.close()
+
+    latencies.sort()
+    pushes.sort()
+    print "%d switches: switch to event p50 %.1f ms, p99 %.1f ms, worst %.1f ms; publish to event p50 %.1f ms" % (
+        switches, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000,
+        latencies[-1] * 1000, pushes[len(pushes) // 2] * 1000)
+
+def main():
+    if sys.argv[1:2] == ["events"]:
+        events(sys.argv[3] if len(sys.argv) > 3 else "localhost:80", int(sys.argv[2]) if len(sys.argv) > 2 else 100)
+        return
+    arguments = sys.argv[1:]
+    requests, not_modified = REQUESTS, None
+    if arguments[:1] == ["all"]: # Everything in one request, kept until it changes
+        arguments = arguments[1:]
+        requests, not_modified = [("GET", "/api/info/all/")], []
+    clients = int(arguments[0]) if len(arguments) > 0 else 20
+    seconds = float(arguments[1]) if len(arguments) > 1 else 10
+    address = arguments[2] if len(arguments) > 2 else "localhost:80"
+
+    latencies = []
+    errors = []
+    threads = [Thread(target=poll, args=(address, seconds, latencies, errors, requests, not_modified)) for client in range(clients)]
+    started = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    took = time() - started
+
+    if not latencies:
+        print "No replies, is web.py running on " + address + "?"
+        return
+    latencies.sort()
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+    print "%d clients for %.0f s: %.0f requests/s, p50 %.1f ms, p99 %.1f ms, worst %.1f ms, %d errors" % (
+        clients, took, len(latencies) / took, percentile(0.5), percentile(0.99), latencies[-1] * 1000, len(errors))
+    if not_modified is not None:
+        print "%.1f%% of the /api/info/all/ replies were 304 Not Modified" % (sum(not_modified) * 100.0 / max(len(not_modified), 1))
+
+if __name__ == "__main__":
+    main()
@@ -7,90 +7,106 @@
 ############################
 ##### Import libraries #####
 ############################
-from flask import abort, Flask, redirect, render_template, request, url_for
-from psutil import cpu_percent, virtual_memory
-from datetime import datetime, timedelta
-from os import getuid, popen, system
+try:
+    from gevent import monkey
+    monkey.patch_all() # Sockets, locks, threads and sleeps give way to other requests. Before anything else imports them.
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    import gevent
+except ImportError: # Fall back to Flask's development server
+    gevent = None
+from flask import abort, Flask, jsonify, redirect, render_template, request, Response, url_for
+from datetime import datetime
+from os import getuid, path, system
 from signal import signal, SIGTERM
-from serial import Serial
-from smbus import SMBus
-from time import sleep
-
-#################################################
-##### Define class to get Raspberry Pi temp #####
-#################################################
-def get_cpu_temp():
-    with open("/sys/class/thermal/thermal_zone0/temp", "r") as tempfile:
-        cpu_temp = int(tempfile.read()) / 1000
-    cpu_temp = (cpu_temp * (9.0/5.0)) + 32.0
-    return str(cpu_temp)
-
-def get_gpu_temp():
-    with popen("/opt/vc/bin/vcgencmd measure_temp") as tempfile:
-        gpu_temp = int(tempfile.read().replace("temp=", "").split(".")[0])
-    gpu_temp = (gpu_temp * (9.0/5.0)) + 32.0
-    return str(gpu_temp)
-
-#########################################
-##### Define class to get LM75 temp #####
-#########################################
-LM75_ADDRESS = 0x48
-LM75_TEMP_REGISTER = 0
-LM75_CONF_REGISTER = 1
-LM75_THYST_REGISTER = 2
-LM75_TOS_REGISTER = 3
-LM75_CONF_SHUTDOWN = 0
-LM75_CONF_OS_COMP_INT = 1
-LM75_CONF_OS_POL = 2
-LM75_CONF_OS_F_QUE = 3
-
-class LM75(object):
-	def __init__(self, mode=LM75_CONF_OS_COMP_INT, address=LM75_ADDRESS, busnum=1):
-		self._mode = mode
-		self._address = address
-		self._bus = SMBus(busnum)
-
-	def regdata2float (self, regdata):
-		return (regdata / 32.0) / 8.0
-	def toFah(self, temp):
-		return (temp * (9.0/5.0)) + 32.0
-
-	def getTemp(self):
-		raw = self._bus.read_word_data(self._address, LM75_TEMP_REGISTER) & 0xFFFF
-		raw = ((raw << 8) & 0xFF00) + (raw >> 8)
-		return self.toFah(self.regdata2float(raw))
-
-	def getTempC(self):
-		raw = self._bus.read_word_data(self._address, LM75_TEMP_REGISTER) & 0xFFFF
-		raw = ((raw << 8) & 0xFF00) + (raw >> 8)
-		return self.regdata2float(raw)
-
-######################################
-##### Define class to get uptime #####
-######################################
-def get_up_stats():
-    with open('/proc/uptime', 'r') as f:
-        uptime_seconds = float(f.readline().split()[0])
-        uptime_string = str(timedelta(seconds = uptime_seconds))
-        uptime_string = uptime_string.split(".")[0]
-    return uptime_string
+from time import time
+import json
+import socket
+import sys
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "..", "Shared")) # Modules shared with clock.py
+from alarm_store import AlarmStore
+from events import EventBroker
+from relay_client import RelayCache, RelayClient, RelayError, RELAY_PINS
+from sensors import get_boot_time, get_up_stats, pi_sensors
+from metrics import MetricsStore
+import hal # The Pi's hardware, or stand-ins with CLOCK_PI_HAL=virtual
+
+MAX_CONNECTIONS = 100 # Open connections served at once, more wait to be accepted
+RELAY_CONNECTIONS = 4 # Switch requests sent to arduino_server.py at once, as many as it keeps in flight
+# How far a reading has to move before it is pushed to the web pages
+EVENT_THRESHOLDS = {"lm75_temp": 0.5, "cpu_temp": 2.0, "gpu_temp": 2.0, "cpu_percent": 10.0, "memory_percent": 5.0}
 
 ###############################################
 ##### Exit cleanly if SIGTERM is received #####
 ###############################################
 def sigterm_handler(signal, frame):
-    func = request.environ.get("werkzeug.server.shutdown")
-    if func is None:
-        raise RuntimeError("Not running with the Werkzeug Server")
-    func()
     raise SystemExit
 
+#########################################
+##### Push changes to the web pages #####
+#########################################
+pushed = {} # The sensor values the pages were last sent
+pushed_times = {} # When each of them was read
+
+def sensor_changed(name, value):
+    try:
+        value = round(float(value), 1)
+    except (TypeError, ValueError):
+        return
+    old = pushed.get(name)
+    if old is None or abs(value - old) >= EVENT_THRESHOLDS.get(name, 0):
+        pushed[name] = value
+        pushed_times[name] = round(time(), 3)
+        events.publish("sensors", {name: value})
+
+def alarm_state():
+    alarm = alarm_store.first()
+    return {"hour": alarm.hour, "minute": alarm.minute, "enabled": alarm.enabled}
+
+def alarm_text(alarm):
+    return ("set for " if alarm.enabled else "not set for ") + "%d:%02d" % (alarm.hour, alarm.minute)
+
+def snapshot():
+    """Everything the pages show, for a page that connects or missed too many events"""
+    return [("relays", relay_states.state()), ("sensors", dict(pushed)), ("alarm", alarm_state())]
+
+##################################################
+##### Everything at once, for /api/info/all/ #####
+##################################################
+# The snapshot only changes when an event is published, so the last event's id is its generation.
+# The ETag adds when web.py started, as the ids start again from 0 after a restart.
+# Sensor values are the ones last pushed, so each can be up to its EVENT_THRESHOLDS behind
+# the latest reading; sensor_times says when each was read.
+STARTED = int(time())
+info_cache = {"generation": None, "body": None, "requests": 0, "not_modified": 0, "builds": 0}
+
+def info_body():
+    """The JSON for the current generation, built once per generation"""
+    while True:
+        generation = events.last_id
+        if info_cache["generation"] == generation:
+            return generation, info_cache["body"]
+        info = dict(snapshot(), sensor_times=dict(pushed_times), generation=generation, boot_time=BOOT_TIME)
+        body = json.dumps(info, sort_keys=True)
+        if events.last_id == generation: # Nothing changed while it was built, so it is all one moment
+            info_cache.update(generation=generation, body=body, builds=info_cache["builds"] + 1)
+            return generation, body
+
+###############################
+##### Run a power command #####
+###############################
+def power(command):
+    if hal.VIRTUAL:
+        print "Not running \"" + command + "\" on virtual hardware"
+    else:
+        system(command)
+
 ########################
 ##### Main program #####
 ########################
 
 # Check if we are run as root
-if getuid() != 0:
+if getuid() != 0 and not hal.VIRTUAL:
     raise Exception("Please run script as root")
 
 ##### Initialize Flask #####
@@ -104,16 +120,14 @@ def index():
     now = datetime.now()
     timeString = now.strftime("%m/%d/%Y, %I:%M:%S %p") # Get the current time
 
-    memory = virtual_memory() # Get virtual memory usage
-
     templateData = {
         "time": timeString,
         "uptime": get_up_stats(), # Get uptime stats
-        "sensor_temp": sensor.getTemp(), # Get LM75 temp
-        "gpu_temp": get_gpu_temp(),
-        "cpu_temp": get_cpu_temp(),
-        "cpu_percent": str(cpu_percent()) + "%", # Get CPU percent
-        "virtual_memory": str(memory.percent) + "%",
+        "sensor_temp": sensors.get("lm75_temp"), # Get LM75 temp, sampled in the background
+        "gpu_temp": sensors.get("gpu_temp"),
+        "cpu_temp": sensors.get("cpu_temp"),
+        "cpu_percent": str(sensors.get("cpu_percent")) + "%", # Get CPU percent
+        "virtual_memory": str(sensors.get("memory_percent")) + "%",
     }
     return render_template("index.html", **templateData)
 
@@ -125,49 +139,26 @@ def control():
     now = datetime.now()
     timeString = now.strftime("%m/%d/%Y, %I:%M:%S %p") # Get the current time
 
-    memory = virtual_memory() # Get virtual memory usage
-
-    board.write("s")
-    rx_bytes = board.readline()
-    if "True" in rx_bytes:
-        pin_twelve = "true"
-    elif "False" in rx_bytes:
-        pin_twelve = ""
-
-    board.write("d")
-    rx_bytes = board.readline()
-    if "True" in rx_bytes:
-        pin_eleven = "true"
-    elif "False" in rx_bytes:
-        pin_eleven = ""
-
-    board.write("f")
-    rx_bytes = board.readline()
-    if "True" in rx_bytes:
-        pin_ten = "true"
-    elif "False" in rx_bytes:
-        pin_ten = ""
-
-    board.write("g")
-    rx_bytes = board.readline()
-    if "True" in rx_bytes:
-        pin_nine = "true"
-    elif "False" in rx_bytes:
-        pin_nine = ""
+    states = relay_states.state(12, 11, 10, 9) # From memory, kept in step with the Arduino in the background
+    pin_twelve = "true" if states[12] else ""
+    pin_eleven = "true" if states[11] else ""
+    pin_ten = "true" if states[10] else ""
+    pin_nine = "true" if states[9] else ""
 
     templateData = {
         "title": "Control Panel",
         "time": timeString,
         "uptime": get_up_stats(), # Get uptime stats
-        "sensor_temp": sensor.getTemp(), # Get LM75 temp
-        "gpu_temp": get_gpu_temp(),
-        "cpu_temp": get_cpu_temp(),
-        "cpu_percent": str(cpu_percent()) + "%", # Get CPU percent
-        "virtual_memory": str(memory.percent) + "%",
+        "sensor_temp": sensors.get("lm75_temp"), # Get LM75 temp, sampled in the background
+        "gpu_temp": sensors.get("gpu_temp"),
+        "cpu_temp": sensors.get("cpu_temp"),
+        "cpu_percent": str(sensors.get("cpu_percent")) + "%", # Get CPU percent
+        "virtual_memory": str(sensors.get("memory_percent")) + "%",
         "pin_twelve": pin_twelve,
         "pin_eleven": pin_eleven,
         "pin_ten": pin_ten,
         "pin_nine": pin_nine,
+        "alarm": alarm_text(alarm_store.first()),
     }
     return render_template("control.html", **templateData)
 
@@ -186,14 +177,8 @@ def alarm_control():
             alarm_hour = request.form["hour"]
             alarm_min = request.form["minute"]
 
-        # Write alarm data to file
-        with open("/home/pi/Clock-Pi/Clock/alarm_data.csv", "w") as f:
-            f.seek(0)
-            if alarm_set == True:
-                new_text = str(alarm_hour) + "," + str(alarm_min) + "," + "1"
-            elif alarm_set == False:
-                new_text = str(alarm_hour) + "," + str(alarm_min) + "," + "0"
-            f.write(new_text)
+        # Write alarm data to file, the first line is the alarm the web page controls
+        alarm_store.set_first(int(alarm_hour), int(alarm_min), alarm_set) # clock.py picks the change up straight away
 
         return redirect(url_for("alarm_control"))
 
@@ -201,12 +186,10 @@ def alarm_control():
         now = datetime.now()
         timeString = now.strftime("%m/%d/%Y, %I:%M:%S %p") # Get the current time
 
-        with open("/home/pi/Clock-Pi/Clock/alarm_data.csv", "r") as f: # Read alarm file
-            text = f.read()
-            words = text.split(",")
-            alarm_hour = int(words[0])
-            alarm_min = int(words[1])
-            alarm_set = bool(int(words[2]))
+        alarm = alarm_store.first() # Kept up to date in memory, the file is only read when it changes
+        alarm_hour = alarm.hour
+        alarm_min = alarm.minute
+        alarm_set = alarm.enabled
 
         # Make sure wording is correct
         if alarm_set == True:
@@ -226,106 +209,103 @@ def alarm_control():
 ###########################
 @app.route("/api/info/temperature/")
 def temperature():
-    return "{ " + '"value": ' + str(sensor.getTemp()) + " }"
+    return "{ " + '"value": ' + str(sensors.get("lm75_temp")) + " }"
+
+##########################
+##### Sensor history #####
+##########################
+# /api/history/?hours=24&points=300&metrics=cpu_temp,lm75_temp, or start= and end= as Unix times
+@app.route("/api/history/")
+def history():
+    try:
+        end = float(request.args.get("end", time()))
+        start = float(request.args.get("start", end - float(request.args.get("hours", 24)) * 3600))
+        points = int(request.args.get("points", 300))
+    except ValueError:
+        abort(400)
+    if not start <= end or float("inf") in (abs(start), abs(end)): # Also catches nan
+        abort(400)
+    names = request.args.get("metrics")
+    tier, step, series = metrics.series(start, end, points, names.split(",") if names else None)
+    return jsonify(start=start, end=end, tier=tier, step=step, series=series)
+
+###############################################
+##### Every reading and pin state at once #####
+###############################################
+# Answered from the cached snapshot. Send the ETag back in If-None-Match and an unchanged poll gets a 304.
+@app.route("/api/info/all/")
+def info_all():
+    info_cache["requests"] += 1
+    generation, body = info_body()
+    etag = "%x-%d" % (STARTED, generation)
+    if request.if_none_match.contains(etag): # Nothing changed since the client's copy
+        info_cache["not_modified"] += 1
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache" # Keep it, but ask every time
+    return response
+
+################################
+##### Counters, for tuning #####
+################################
+@app.route("/api/stats/")
+def stats():
+    return jsonify(relays=relay_states.stats(), sensors=sensors.stats(), events=events.stats(),
+                   info=dict((name, info_cache[name]) for name in ("requests", "not_modified", "builds", "generation")))
+
+########################
+##### Live changes #####
+########################
+# Server-Sent Events: "relays" {pin: on}, "sensors" {name: value} and "alarm" {hour, minute, enabled},
+# each with the time it was published. A page that reconnects gets what it missed, or everything.
+@app.route("/api/events/")
+def event_stream():
+    return Response(events.stream(request.headers.get("Last-Event-ID"), snapshot), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 ################################
 ##### HomeBridge pin state #####
 ################################
 @app.route("/api/info/<pin>/")
 def homekit_pins(pin):
-
-    if pin == "12":
-        board.write("s")
-        rx_bytes = board.readline()
-        if "True" in rx_bytes:
-            return "1"
-        elif "False" in rx_bytes:
-            return "0"
-
-    elif pin == "11":
-        board.write("d")
-        rx_bytes = board.readline()
-        if "True" in rx_bytes:
-            return "1"
-        elif "False" in rx_bytes:
-            return "0"
-
-    elif pin == "10":
-        board.write("f")
-        rx_bytes = board.readline()
-        if "True" in rx_bytes:
-            return "1"
-        elif "False" in rx_bytes:
-            return "0"
-
-    elif pin == "9":
-        board.write("g")
-        rx_bytes = board.readline()
-        if "True" in rx_bytes:
-            return "1"
-        elif "False" in rx_bytes:
-            return "0"
-
-    else:
+    if not pin.isdigit() or int(pin) not in RELAY_PINS:
         abort(404)
+    if relay_states.state(int(pin))[int(pin)]:
+        return "1"
+    else:
+        return "0"
 
 #######################
 ##### Pin control #####
 #######################
 @app.route("/api/<action>/<pin>/", methods=["GET", "HEAD"])
 def pin_control(action, pin):
-    if str(action) == "on":
-        if pin == "12":
-            board.write("W")
-
-        elif pin == "11":
-            board.write("E")
-
-        elif pin == "10":
-            board.write("R")
-
-        elif pin == "9":
-            board.write("T")
-
-        else:
-            abort(404)
-
-    elif str(action) == "off":
-        if pin == "12":
-            board.write("w")
-
-        elif pin == "11":
-            board.write("e")
-
-        elif pin == "10":
-            board.write("r")
-
-        elif pin == "9":
-            board.write("t")
-
-        else:
-            abort(404)
-
-
-    elif str(action) == "toggle":
-        if pin == "12":
-            board.write("S")
-
-        elif pin == "11":
-            board.write("D")
-
-        elif pin == "10":
-            board.write("F")
-
-        elif pin == "9":
-            board.write("G")
+    if str(action) not in ("on", "off", "toggle"):
+        abort(404)
+    if not pin.isdigit() or int(pin) not in RELAY_PINS:
+        abort(404)
+    relay_states.switch(action, pin) # Returns once arduino_server.py has sent the command
 
-        else:
-            abort(404)
+    if request.method == "GET":
+        return redirect(url_for("control"))
+    elif request.method == "HEAD":
+        return "", 200
 
-    else:
+####################################
+##### Set several pins at once #####
+####################################
+# /api/set/?12=1&9=0 turns 12 on and 9 off with one command to the Arduino
+@app.route("/api/set/", methods=["GET", "HEAD"])
+def pin_set():
+    try:
+        states = dict((int(pin), bool(int(state))) for pin, state in request.args.items())
+    except ValueError:
+        abort(400)
+    if not states or any(pin not in RELAY_PINS for pin in states):
         abort(404)
-
+    relay_states.set(states) # One command, the relays switch together
 
     if request.method == "GET":
         return redirect(url_for("control"))
@@ -349,7 +329,7 @@ def rebootask():
 ##################
 @app.route("/reboot/")
 def reboot():
-    system("shutdown -r 1") # Reboot
+    power("shutdown -r 1") # Reboot
     templateData = {
        "title" : "Rebooting...",
        "text" : "The system is going down for reboot"
@@ -373,7 +353,7 @@ def shutdownask():
 ####################
 @app.route("/shutdown/")
 def shutdown():
-    system("shutdown -h 1") # Shutdown
+    power("shutdown -h 1") # Shutdown
     templateData = {
         "title" : "Shutting down...",
         "text" : "The system is going down for system halt"
@@ -397,6 +377,7 @@ def page_not_found(error):
 ##### 500 Page #####
 ####################
 @app.errorhandler(500)
+@app.errorhandler(RelayError) # arduino_server.py is down or the Arduino did not answer
 def internal_server_error(error):
     templateData = {
        "title" : "500 Internal Server Error",
@@ -408,18 +389,40 @@ def internal_server_error(error):
 ##########################
 ##### Start Web Page #####
 ##########################
+relays = relay_states = None # Not there yet if starting up fails
 try:
 
     #######################################
     ##### Start and connect to things #####
     #######################################
-    board = Serial("/dev/ttyACM0") # Connect to Arduino
-    board.timeout = 2
-    sensor = LM75() # Connect to LM75 Temperature sensor
+    events = EventBroker() # Changes pushed to /api/events/
+    BOOT_TIME = get_boot_time()
+    relays = RelayClient(connections=RELAY_CONNECTIONS) # Connect to arduino_server.py, which owns the Arduino's serial port
+    relay_states = RelayCache(relays) # What the relays are set to, so pages do not wait for the Arduino
+    # Read the LM75 Temperature sensor, CPU and GPU in the background. Under gevent each read runs
+    # in a real thread, so an I2C read or vcgencmd fork never holds up a request.
+    sensors = pi_sensors(gevent.get_hub().threadpool.apply if gevent is not None else None)
+    metrics = MetricsStore() # History written by clock.py
+    alarm_store = AlarmStore() # Read alarm file
+    alarm_store.watch(lambda: events.publish("alarm", alarm_state())) # Follow changes made by clock.py
+    relay_states.watch(lambda changed: events.publish("relays", changed))
+    sensors.watch(sensor_changed)
 
     if __name__ == "__main__":
         signal(SIGTERM, sigterm_handler)
-        app.run(host="0.0.0.0", port=80, debug=False)
+        port = 8080 if hal.VIRTUAL else 80
+        if gevent is None or sys.argv[1:] == ["flask"]: # "web.py flask" for comparing the two
+            app.run(host="0.0.0.0", port=port, debug=False, threaded=True) # A page streaming events must not hold up the rest
+        else:
+            # One greenlet per connection, kept alive between requests, at most MAX_CONNECTIONS at once.
+            # Replies are sent without waiting on Nagle, which otherwise holds every kept-alive reply back 40 ms.
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Passed on to every accepted socket
+            listener.bind(("0.0.0.0", port))
+            listener.listen(MAX_CONNECTIONS)
+            server = WSGIServer(listener, app, spawn=Pool(MAX_CONNECTIONS), log=None)
+            server.serve_forever()
 
 except KeyboardInterrupt:
     print "You pressed CTRL+C"
@@ -431,4 +434,7 @@ except Exception as e:
     print "An error occurred: " + str(e)
 
 finally:
-    board.close()
+    if relay_states is not None:
+        relay_states.close()
+    if relays is not None:
+        relays.close()
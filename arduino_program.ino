@@ -11,6 +11,27 @@ bool pin_ten_state = false;
 bool pin_nine_state = false;
 
 char rx_char = 0; // rx_char holds the received command.
+char mask_chars[4]; // The hex digits after 'Y', which can arrive over several loops.
+int mask_count = -1; // How many of them have arrived, -1 when not reading a mask.
+
+/*
+  Bulk commands use one bit per pin:
+  bit 0 = pin 9, bit 1 = pin 10, bit 2 = pin 11, bit 3 = pin 12, bit 4 = pin 13, bit 5 = pin 8 (read only).
+  'x' replies with every pin as "M" and two hex digits, for example "M29".
+  'Y' is followed by two hex digits choosing the pins to set and two hex digits with their new
+  states, so "Y0F05" turns pins 9 and 11 on and pins 10 and 12 off at the same time.
+
+  A 0x7E byte starts a frame instead: length, sequence number, payload, CRC-8. Shared/frames.py
+  lists the framed commands. Every frame gets a framed reply with the same sequence number.
+*/
+const byte FRAME_START = 0x7E;
+const int MAX_PAYLOAD = 8;
+const byte PROTOCOL_VERSION = 1;
+const long BAUD_RATES[] = {9600, 57600, 115200};
+byte frame[MAX_PAYLOAD + 3]; // Length, sequence number, payload, CRC.
+int frame_count = -1; // Bytes of the frame received, -1 when not reading a frame.
+unsigned long baud_check_at = 0; // Go back to 9600 at this time unless a good frame arrives at the new rate.
+bool framed = false; // Once a good frame has arrived, bytes outside frames are line noise, not commands.
 
 void setup() {
   Serial.begin(9600); // Open serial port (9600 bauds).
@@ -23,11 +44,172 @@ void setup() {
   pinMode(pin_eight, INPUT);
 }
 
+int hex_value(char hex_char) { // The value of one hex digit, or -1.
+  if (hex_char >= '0' && hex_char <= '9') {
+    return hex_char - '0';
+  } else if (hex_char >= 'A' && hex_char <= 'F') {
+    return hex_char - 'A' + 10;
+  } else if (hex_char >= 'a' && hex_char <= 'f') {
+    return hex_char - 'a' + 10;
+  }
+  return -1;
+}
+
+void set_pin(int pin, bool &pin_state, bool on) {
+  digitalWrite(pin, on ? HIGH : LOW);
+  pin_state = on;
+}
+
+int pin_mask() { // Every pin, one bit each.
+  int mask = 0;
+  if (pin_nine_state) mask |= 1;
+  if (pin_ten_state) mask |= 2;
+  if (pin_eleven_state) mask |= 4;
+  if (pin_twelve_state) mask |= 8;
+  if (pin_thirteen_state) mask |= 16;
+  if (digitalRead(pin_eight) == HIGH) mask |= 32;
+  return mask;
+}
+
+void send_mask() { // Reply with every pin in one line.
+  int mask = pin_mask();
+  Serial.print('M');
+  if (mask < 16) {
+    Serial.print('0');
+  }
+  Serial.println(mask, HEX);
+}
+
+void set_pins(int chosen, int states) {
+  if (chosen & 1) set_pin(pin_nine, pin_nine_state, states & 1);
+  if (chosen & 2) set_pin(pin_ten, pin_ten_state, states & 2);
+  if (chosen & 4) set_pin(pin_eleven, pin_eleven_state, states & 4);
+  if (chosen & 8) set_pin(pin_twelve, pin_twelve_state, states & 8);
+  if (chosen & 16) set_pin(pin_thirteen, pin_thirteen_state, states & 16);
+}
+
+void set_mask() { // Set the pins chosen by the first byte of mask_chars to the second byte.
+  int digits[4];
+  for (int i = 0; i < 4; i++) {
+    digits[i] = hex_value(mask_chars[i]);
+    if (digits[i] < 0) {
+      Serial.println("Bad mask");
+      return;
+    }
+  }
+  set_pins(digits[0] * 16 + digits[1], digits[2] * 16 + digits[3]);
+}
+
+byte crc8(byte *data, int count) { // Polynomial 0x07, the same as Shared/frames.py.
+  byte crc = 0;
+  for (int i = 0; i < count; i++) {
+    crc ^= data[i];
+    for (int bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+void send_frame(byte sequence, byte command, byte value) { // Every reply is a command byte and one value.
+  byte reply[5] = {2, sequence, command, value, 0};
+  reply[4] = crc8(reply, 4);
+  Serial.write(FRAME_START);
+  Serial.write(reply, 5);
+}
+
+void handle_frame() {
+  int length = frame[0];
+  byte sequence = frame[1];
+  byte *payload = frame + 2;
+  if (crc8(frame, length + 2) != frame[length + 2]) {
+    send_frame(sequence, 'E', 1);
+    return;
+  }
+  baud_check_at = 0; // A good frame, so the baud rate works.
+  framed = true;
+
+  switch (payload[0]) {
+    case 'V': // Ping.
+      send_frame(sequence, 'V', PROTOCOL_VERSION);
+      break;
+
+    case 'x': // Get every pin.
+      send_frame(sequence, 'M', pin_mask());
+      break;
+
+    case 'Y': // Set pins from a mask.
+      if (length < 3) {
+        send_frame(sequence, 'E', 2);
+        break;
+      }
+      set_pins(payload[1], payload[2]);
+      send_frame(sequence, 'K', 0);
+      break;
+
+    case 'T': // Toggle pins from a mask.
+      if (length < 2) {
+        send_frame(sequence, 'E', 2);
+        break;
+      }
+      set_pins(payload[1], pin_mask() ^ payload[1]);
+      send_frame(sequence, 'K', 0);
+      break;
+
+    case 'B': // Change baud rate.
+      if (length < 2 || payload[1] > 2) {
+        send_frame(sequence, 'E', 2);
+        break;
+      }
+      send_frame(sequence, 'K', 0);
+      Serial.flush(); // Wait for the reply to go out at the old rate.
+      Serial.end();
+      Serial.begin(BAUD_RATES[payload[1]]);
+      baud_check_at = payload[1] == 0 ? 0 : millis() + 2000;
+      break;
+
+    default:
+      send_frame(sequence, 'E', 3);
+  }
+}
+
 void loop() {
-  delay(100);
-  if (Serial.available() > 0) { // Check receive buffer.
+  if (baud_check_at != 0 && (long)(millis() - baud_check_at) > 0) { // The Pi never talked at the new rate.
+    Serial.end();
+    Serial.begin(9600);
+    baud_check_at = 0;
+  }
+
+  while (Serial.available() > 0) { // Handle everything received as soon as it arrives.
     rx_char = Serial.read(); // Save character received.
-    Serial.flush(); // Clear receive buffer.
+
+    if (frame_count >= 0) { // Part of a frame.
+      frame[frame_count++] = rx_char;
+      if (frame_count == 1 && (frame[0] == 0 || frame[0] > MAX_PAYLOAD)) {
+        frame_count = -1; // Not a length, so that was not the start of a frame.
+      } else if (frame_count > 1 && frame_count == frame[0] + 3) {
+        handle_frame();
+        frame_count = -1;
+      }
+      continue;
+    }
+
+    if ((byte)rx_char == FRAME_START) {
+      frame_count = 0;
+      continue;
+    }
+    if (framed) { // A damaged start byte, skip to the next frame.
+      continue;
+    }
+
+    if (mask_count >= 0) { // Part of a 'Y' command.
+      mask_chars[mask_count++] = rx_char;
+      if (mask_count == 4) {
+        set_mask();
+        mask_count = -1;
+      }
+      continue;
+    }
 
     switch (rx_char) {
 
@@ -215,6 +397,20 @@ void loop() {
         }
         break;
 
+      /*
+        ###############################
+        ##### EVERY PIN, ONE MASK #####
+        ###############################
+      */
+
+      case 'x': // Get every pin.
+        send_mask();
+        break;
+
+      case 'Y': // Set pins from a mask, the hex digits follow.
+        mask_count = 0;
+        break;
+
       default:
         Serial.print("'");
         Serial.print((char)rx_char);
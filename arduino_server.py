@@ -0,0 +1,603 @@
+#!/usr/bin/env python
+
+#########################################################
+##### Own the Arduino serial port and switch relays #####
+#########################################################
+
+############################
+##### Import Libraries #####
+############################
+from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+from signal import signal, SIGTERM
+from os import chmod, getuid, path, remove
+from collections import deque
+from Queue import Queue, Empty
+from threading import Condition, Event, Lock, Thread
+from time import sleep, time
+import sys
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "Shared")) # Modules shared with clock.py and web.py
+from relay_client import SOCKET_FILE, RELAY_PINS
+from frames import BAUD_RATES, ERRORS, FrameReader, encode
+import hal # The Arduino, or a fake one with CLOCK_PI_HAL=virtual
+
+# Arduino command characters for each pin: (on, off, toggle, status)
+PIN_COMMANDS = {
+    13: ("Q", "q", "A", "a"),
+    12: ("W", "w", "S", "s"),
+    11: ("E", "e", "D", "d"),
+    10: ("R", "r", "F", "f"),
+    9: ("T", "t", "G", "g"),
+}
+ACTIONS = ("on", "off", "toggle")
+BUTTON_PIN = 8 # The reboot button
+BUTTON_COMMAND = "h"
+MASK_PINS = (9, 10, 11, 12, 13, BUTTON_PIN) # Bit 0 first, for the 'x' (read every pin) and 'Y' (set from a mask) commands
+
+ARDUINO_BOOT_TIME = 0 if hal.VIRTUAL else 2 # The Uno resets when its port is opened
+RECONNECT_TIME = (0.5, 30) # Seconds to wait after the first failed attempt to open the port, and at most
+REQUEST_TIMEOUT = 4 # Seconds a request can wait for the port and the reply, less than RelayClient's timeout
+LATENCY_SAMPLES = 500 # Round trips kept for the stats
+FAST_BAUD = 115200 # Asked for once the sketch answers frames, one of frames.BAUD_RATES
+BAUD_CHECK_TIME = 2.1 # Seconds the sketch waits at a new baud rate before going back to 9600
+FRAME_WINDOW = 4 # Frames in flight at once, well inside the Uno's 64 byte receive buffer
+FRAME_TIMEOUT = 0.25 # Seconds to wait for a framed reply before sending the frame again
+FRAME_RETRIES = 2 # For reads and sets, a toggle is never sent twice
+FRAME_POLL_TIME = 0.05 # How often the reader thread looks for lost replies
+
+def pin_mask(pins):
+    """The bits for these pins in the 'x', 'Y' and 'T' masks"""
+    return sum(1 << MASK_PINS.index(pin) for pin in pins)
+
+###############################################
+##### Exit cleanly if SIGTERM is received #####
+###############################################
+def sigterm_handler(signal, frame):
+    raise SystemExit
+
+class NoReply(IOError):
+    """The Arduino is there but did not answer, as opposed to the port going away"""
+
+class Request(object):
+    """One command waiting for the serial port, and its reply once the worker has it"""
+
+    def __init__(self, kind, pins):
+        self.kind = kind
+        self.pins = pins
+        self.queued = time()
+        self.reply = None
+        self.error = None
+        self.abandoned = False # The client gave up waiting, do not send it late
+        self.done = Event()
+
+        # Framed requests, while they wait for their reply
+        self.frame = None
+        self.sent = 0
+        self.attempts = 0
+        self.retry = False # Safe to send twice (not a toggle)
+
+###########################################
+##### Arduino connection and counters #####
+###########################################
+class Arduino(object):
+    """Owns the serial port. Requests from every client go through one queue to a single
+    writer thread, so no client can read a reply meant for another. When the USB device
+    goes away the port is closed and opened again, waiting twice as long after each
+    failed attempt.
+
+    If the sketch answers frames (see Shared/frames.py), the baud rate is raised to
+    `baud` and up to FRAME_WINDOW frames are in flight at once. A reader thread matches
+    replies to requests by sequence number and sends a frame again if its reply is lost.
+    An older sketch gets the single character commands, one request at a time.
+    protocol="text" uses those even on a new sketch, for comparing the two."""
+
+    def __init__(self, port="/dev/ttyACM0", protocol=None, baud=FAST_BAUD):
+        self.port = port
+        self.protocol = protocol
+        self.fast_baud = baud
+        self._board = None
+        self._queue = Queue()
+        self._backoff = RECONNECT_TIME[0]
+        self.retry_at = 0
+        self.mode = None # "framed", "bulk" (the 'x' and 'Y' text commands) or "single", found out each time the port is opened
+        self.baud = None
+        self._seq = 0
+        self._pending = {} # Sequence number: framed Request waiting for its reply
+        self._window = Condition() # Guards _pending and _board, and wakes the writer when a frame is answered
+        self._wire = Lock() # One write at a time, the reader thread sends frames again
+        self._frames = FrameReader()
+        self._reader_thread = None
+
+        # Counters
+        self.commands = 0
+        self.serial_time = 0.0 # Seconds spent waiting for the Arduino
+        self.errors = 0
+        self.connects = 0
+        self.stray_lines = 0 # Replies nobody asked for, dropped before they could be taken as someone else's
+        self.retries = 0 # Frames sent again
+        self.max_queue = 0
+        self.max_in_flight = 0
+        self.latency = deque(maxlen=LATENCY_SAMPLES) # Seconds from a request being queued to its reply
+
+        self._connect()
+        self._thread = Thread(target=self._worker, name="arduino")
+        self._thread.daemon = True
+        self._thread.start()
+
+    ####################
+    ##### Requests #####
+    ####################
+    def request(self, kind, pins=(), timeout=REQUEST_TIMEOUT):
+        """Queue a command and wait for its reply: [] for on/off/toggle/set, "1"/"0" for each pin read"""
+        request = Request(kind, pins)
+        self._queue.put(request)
+        self.max_queue = max(self.max_queue, self._queue.qsize())
+        if not request.done.wait(timeout):
+            request.abandoned = True
+            raise IOError("Arduino did not answer in " + str(timeout) + " seconds")
+        if request.error is not None:
+            raise IOError(request.error)
+        return request.reply
+
+    def switch(self, action, pins):
+        self.request(action, pins)
+
+    def state(self, pins):
+        return self.request("get", pins)
+
+    def button(self):
+        return self.state([BUTTON_PIN])[0]
+
+    def set(self, changes):
+        """Set several relays at once from (pin, on) pairs"""
+        self.request("set", changes)
+
+    @property
+    def connected(self):
+        return self._board is not None
+
+    def stats(self):
+        latency = sorted(self.latency)
+        return {
+            "commands": self.commands,
+            "serial_time": round(self.serial_time, 3),
+            "queue": self._queue.qsize(),
+            "max_queue": self.max_queue,
+            "in_flight": len(self._pending),
+            "max_in_flight": self.max_in_flight,
+            "latency_ms": round(sum(latency) / len(latency) * 1000, 1) if latency else 0,
+            "latency_p99_ms": round(latency[int(len(latency) * 0.99)] * 1000, 1) if latency else 0,
+            "errors": self.errors,
+            "retries": self.retries,
+            "bad_crc": self._frames.bad_crc,
+            "connects": self.connects,
+            "stray_lines": self.stray_lines,
+            "connected": int(self.connected),
+            "framed": int(self.mode == "framed"),
+            "bulk": int(self.mode in ("framed", "bulk")),
+            "baud": self.baud or 0,
+        }
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(1)
+        with self._window:
+            board, self._board = self._board, None
+        if self._reader_thread is not None:
+            self._reader_thread.join(1) # It stops once the board is gone
+        if board is not None:
+            board.close()
+
+    ############################
+    ##### Opening the port #####
+    ############################
+    def _connect(self):
+        try:
+            board = hal.serial_port(self.port) # Connect to Arduino
+            sleep(ARDUINO_BOOT_TIME)
+            board.reset_input_buffer() # Anything sent while it was starting
+            self._negotiate(board)
+        except (IOError, OSError) as e:
+            if self._backoff == RECONNECT_TIME[0]: # Once per outage, not every attempt
+                print "Could not open " + self.port + ": " + str(e)
+            self.retry_at = time() + self._backoff
+            self._backoff = min(self._backoff * 2, RECONNECT_TIME[1])
+            return
+        with self._window:
+            self._board = board
+        if self.mode == "framed":
+            self._reader_thread = Thread(target=self._reader, args=(board,), name="arduino-reader")
+            self._reader_thread.daemon = True
+            self._reader_thread.start()
+        self._backoff = RECONNECT_TIME[0]
+        self.connects += 1
+        print "Connected to the Arduino on " + self.port + " at " + str(self.baud) + " baud, " + self.mode + " commands"
+
+    def _negotiate(self, board):
+        """Find out which commands the sketch knows, and raise the baud rate if it answers frames"""
+        self._seq = 0 # So the first frame cannot hold a command letter an old sketch would act on
+        text_timeout = board.timeout
+        if self.protocol != "text":
+            board.timeout = FRAME_POLL_TIME
+            reply = self._call(board, b"V")
+            if reply is not None and reply[0] == ord("V"):
+                self.mode = "framed"
+                if self.fast_baud != board.baudrate:
+                    self._change_baud(board)
+                self.baud = board.baudrate
+                return
+            sleep(0.6) # An old sketch answers every byte of the frame, 100 ms apart
+            board.reset_input_buffer()
+            board.timeout = text_timeout
+        self._probe(board)
+        self.baud = board.baudrate
+
+    def _change_baud(self, board):
+        reply = self._call(board, bytearray([ord("B"), BAUD_RATES.index(self.fast_baud)]))
+        if reply is None or reply[0] != ord("K"):
+            return # Stay at 9600
+        slow = board.baudrate
+        board.baudrate = self.fast_baud
+        if self._call(board, b"V") is not None:
+            return
+        print "No reply at " + str(self.fast_baud) + " baud, staying at " + str(slow)
+        board.baudrate = slow
+        sleep(BAUD_CHECK_TIME) # The sketch goes back by itself when it hears nothing at the new rate
+        board.reset_input_buffer()
+        if self._call(board, b"V") is None:
+            raise NoReply("Arduino stopped answering after changing baud rate")
+
+    def _call(self, board, payload):
+        """Send one frame and return its reply payload, or None. Only before the reader thread starts."""
+        self._seq = (self._seq + 1) % 256
+        board.write(encode(self._seq, payload))
+        frames = FrameReader()
+        deadline = time() + FRAME_TIMEOUT * 2
+        while time() < deadline:
+            for seq, reply in frames.feed(board.read(max(1, board.in_waiting))):
+                if seq == self._seq:
+                    return bytearray(reply)
+        return None
+
+    def _probe(self, board):
+        """Find out whether the sketch has the bulk text commands. An older one answers "'x' is not a command!"."""
+        board.write("x")
+        rx_bytes = board.readline()
+        self.mode = "bulk" if rx_bytes.startswith("M") else "single"
+        if self.mode == "single":
+            print "The Arduino does not know the bulk commands, load arduino_program.ino again to use them"
+
+    def _disconnect(self, error, board=None):
+        """Close the port and fail everything waiting for it. board is the port the error came from."""
+        with self._window:
+            if self._board is None or (board is not None and board is not self._board):
+                return # Someone else already did
+            board, self._board = self._board, None
+            waiting = list(self._pending.values())
+            self._pending.clear()
+            self._window.notify_all()
+        print "Lost the Arduino: " + str(error)
+        try:
+            board.close()
+        except (IOError, OSError):
+            pass
+        self.retry_at = time()
+        for request in waiting:
+            request.error = "Arduino disconnected: " + str(error)
+            self._finish(request)
+
+    #########################
+    ##### Writer thread #####
+    #########################
+    def _worker(self):
+        while True:
+            try:
+                # While the port is gone, wake up to try it again even if nobody asks for anything
+                timeout = max(0, self.retry_at - time()) if self._board is None else None
+                request = self._queue.get(timeout=timeout)
+            except Empty:
+                self._connect()
+                continue
+            if request is None:
+                return
+            if request.abandoned:
+                continue
+            if self._board is None and time() >= self.retry_at:
+                self._connect()
+            if self._board is None:
+                request.error = "Arduino not connected, trying again in " + str(round(max(0, self.retry_at - time()), 1)) + " seconds"
+            elif self.mode == "framed":
+                self._send_frame(request)
+                continue # The reader thread finishes it
+            else:
+                started = time()
+                try:
+                    request.reply = self._send(request)
+                except NoReply as e:
+                    request.error = str(e)
+                except (IOError, OSError) as e: # The USB device went away
+                    request.error = "Arduino disconnected: " + str(e)
+                    self._disconnect(e)
+                self.commands += 1
+                self.serial_time += time() - started
+            self._finish(request)
+
+    def _finish(self, request):
+        if request.error is not None:
+            self.errors += 1
+        else:
+            self.latency.append(time() - request.queued)
+        request.done.set()
+
+    ###########################
+    ##### Framed requests #####
+    ###########################
+    def _send_frame(self, request):
+        if request.kind == "get":
+            payload = b"x"
+        elif request.kind == "toggle":
+            payload = bytearray([ord("T"), pin_mask(request.pins)])
+        else:
+            changes = request.pins if request.kind == "set" else [(pin, request.kind == "on") for pin in request.pins]
+            payload = bytearray([ord("Y"), pin_mask(pin for pin, on in changes), pin_mask(pin for pin, on in changes if on)])
+        request.retry = request.kind != "toggle"
+
+        with self._window:
+            board = self._board
+            while len(self._pending) >= FRAME_WINDOW and self._board is board:
+                self._window.wait(FRAME_TIMEOUT) # Until a reply makes room in the Arduino's receive buffer
+            if self._board is None or self._board is not board:
+                request.error = "Arduino disconnected"
+            else:
+                self._seq = (self._seq + 1) % 256
+                request.frame = encode(self._seq, payload)
+                request.sent = time()
+                request.attempts = 1
+                self._pending[self._seq] = request
+                self.max_in_flight = max(self.max_in_flight, len(self._pending))
+        if request.error is not None:
+            self._finish(request)
+            return
+        self.commands += 1
+        self._write(board, request.frame)
+
+    def _write(self, board, data):
+        try:
+            with self._wire:
+                board.write(data)
+        except (IOError, OSError) as e: # The USB device went away
+            self._disconnect(e, board)
+
+    def _reader(self, board):
+        """Match framed replies to their requests, and send frames again when replies are lost"""
+        while self._board is board:
+            try:
+                data = board.read(max(1, board.in_waiting))
+            except (IOError, OSError, TypeError, ValueError) as e: # Closed or unplugged
+                self._disconnect(e, board)
+                return
+            for seq, payload in self._frames.feed(data):
+                self._reply(board, seq, bytearray(payload))
+            self._expire(board)
+
+    def _reply(self, board, seq, payload):
+        with self._window:
+            request = self._pending.get(seq)
+            if request is None or len(payload) < 2:
+                self.stray_lines += 1 # A reply to a frame that was given up on or sent twice, or too short to be one
+                return
+            command, value = chr(payload[0]), payload[1]
+            if command == "E" and value == 1 and request.retry and request.attempts <= FRAME_RETRIES:
+                request.attempts += 1 # The frame was damaged on the way, send it again
+                request.sent = time()
+                self.retries += 1
+                resend = True
+            else:
+                del self._pending[seq]
+                self._window.notify_all()
+                resend = False
+        if resend:
+            self._write(board, request.frame)
+            return
+
+        if command == "M":
+            request.reply = [("1" if value & pin_mask([pin]) else "0") for pin in request.pins]
+        elif command == "E":
+            request.error = "Arduino refused the command: " + ERRORS.get(value, str(value))
+        else:
+            request.reply = []
+        self.serial_time += time() - request.sent
+        self._finish(request)
+
+    def _expire(self, board):
+        now = time()
+        resend = []
+        lost = []
+        with self._window:
+            for seq, request in list(self._pending.items()):
+                if now - request.sent < FRAME_TIMEOUT:
+                    continue
+                if request.retry and request.attempts <= FRAME_RETRIES:
+                    request.attempts += 1
+                    request.sent = now
+                    resend.append(request)
+                else:
+                    lost.append(self._pending.pop(seq))
+            if lost:
+                self._window.notify_all()
+        for request in resend:
+            self.retries += 1
+            self._write(board, request.frame)
+        for request in lost:
+            request.error = "no reply from Arduino after " + str(request.attempts) + " tries"
+            self._finish(request)
+
+    #########################
+    ##### Text requests #####
+    #########################
+    def _send(self, request):
+        if request.kind in ACTIONS or request.kind == "set":
+            self._switch(request.kind, request.pins)
+            return []
+        if self._board.in_waiting:
+            self._board.reset_input_buffer() # Left over from a request that timed out
+            self.stray_lines += 1
+        if self.mode == "bulk":
+            states = self._read_mask() # Every pin in one reply
+            return [states[pin] for pin in request.pins]
+        return [self._read(PIN_COMMANDS[pin][3] if pin in PIN_COMMANDS else BUTTON_COMMAND) for pin in request.pins]
+
+    def _switch(self, action, pins):
+        if action == "set": # pins holds (pin, on) pairs
+            changes = pins
+        elif action != "toggle":
+            changes = [(pin, action == "on") for pin in pins]
+        else:
+            changes = None
+        if changes is not None and len(changes) > 1 and self.mode == "bulk":
+            command = "Y%02X%02X" % (pin_mask(pin for pin, on in changes), pin_mask(pin for pin, on in changes if on)) # Every pin changes at the same moment
+        elif changes is not None:
+            command = "".join(PIN_COMMANDS[pin][0 if on else 1] for pin, on in changes)
+        else:
+            command = "".join(PIN_COMMANDS[pin][2] for pin in pins)
+        self._board.write(command) # One write for every pin
+        self._board.flush() # Wait until the bytes are out before acknowledging
+
+    def _readline(self, query, answers):
+        """Send query and return the first reply line starting with one of answers"""
+        self._board.write(query)
+        while True:
+            rx_bytes = self._board.readline()
+            if not rx_bytes:
+                raise NoReply("no reply from Arduino for '" + query + "'")
+            if rx_bytes.startswith(answers):
+                return rx_bytes.strip()
+            self.stray_lines += 1 # "'x' is not a command!" or line noise, keep reading
+
+    def _read(self, query):
+        """One pin, as "1" or "0" """
+        return "1" if self._readline(query, ("True", "False")) == "True" else "0"
+
+    def _read_mask(self):
+        """Every pin from one 'x' command, as {pin: "1" or "0"}"""
+        mask = int(self._readline("x", ("M",))[1:], 16)
+        return dict((pin, "1" if mask & pin_mask([pin]) else "0") for pin in MASK_PINS)
+
+##############################################
+##### One connected client, line by line #####
+##############################################
+class RelayHandler(StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile: # Clients keep the connection open between commands
+            try:
+                reply = ["ok"] + self.command(line.split())
+            except (ValueError, KeyError, IndexError):
+                reply = ["error", "bad command: " + line.strip()]
+            except IOError as e:
+                reply = ["error", str(e)]
+            self.wfile.write(" ".join(reply) + "\n")
+            self.wfile.flush()
+
+    def command(self, words):
+        action = words[0]
+        if action == "set": # "set 12=1 11=0"
+            changes = [(int(pin), state == "1") for pin, state in (word.split("=") for word in words[1:])]
+            for pin, on in changes:
+                if pin not in PIN_COMMANDS:
+                    raise KeyError(pin)
+            arduino.set(changes)
+            return []
+        pins = [int(pin) for pin in words[1:]]
+        for pin in pins:
+            if pin not in PIN_COMMANDS:
+                raise KeyError(pin)
+
+        if action in ACTIONS and pins:
+            arduino.switch(action, pins)
+            return []
+        elif action == "get":
+            return arduino.state(pins or RELAY_PINS)
+        elif action == "button":
+            return [arduino.button()]
+        elif action == "status": # Every relay then the button, from one read of the Arduino
+            return arduino.state(RELAY_PINS + (BUTTON_PIN,))
+        elif action == "ping":
+            return []
+        elif action == "stats":
+            return [name + "=" + str(value) for name, value in sorted(arduino.stats().items())]
+        raise ValueError(action)
+
+class RelayServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+#####################
+##### Main Loop #####
+#####################
+def main():
+    global arduino
+
+    ######################################
+    #### Check if we are run as root #####
+    ######################################
+    if getuid() != 0 and not hal.VIRTUAL:
+        raise Exception("Please run script as root")
+
+    arduino = Arduino()
+
+    if path.exists(SOCKET_FILE):
+        remove(SOCKET_FILE) # Left over from the last run
+    server = RelayServer(SOCKET_FILE, RelayHandler)
+    chmod(SOCKET_FILE, 0o660)
+    server.serve_forever()
+
+#####################################
+##### Benchmark: text vs frames #####
+#####################################
+def benchmark(clients=4, count=100):
+    """Commands per second and p99 latency for each protocol. Run it with the service stopped,
+    or with CLOCK_PI_HAL=virtual to use the fake Arduino."""
+    for name, protocol, baud in (("text, 9600 baud", "text", 9600), ("framed, 9600 baud", None, 9600), ("framed, " + str(FAST_BAUD) + " baud", None, FAST_BAUD)):
+        board = Arduino(protocol=protocol, baud=baud)
+        latencies = []
+        def run(client):
+            for number in range(count):
+                started = time()
+                if number % 2:
+                    board.set([(9, number % 4 == 1)])
+                else:
+                    board.state(RELAY_PINS)
+                latencies.append(time() - started)
+        threads = [Thread(target=run, args=(client,)) for client in range(clients)]
+        started = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        took = time() - started
+        latencies.sort()
+        stats = board.stats()
+        print "%-21s %5.0f commands/s, p99 %6.1f ms, %d errors, %d in flight at most" % (name + ":", len(latencies) / took, latencies[int(len(latencies) * 0.99)] * 1000, stats["errors"], stats["max_in_flight"])
+        board.close()
+
+arduino = None
+
+try:
+    if __name__ == "__main__" and sys.argv[1:2] == ["benchmark"]:
+        benchmark(*[int(arg) for arg in sys.argv[2:]])
+    elif __name__ == "__main__":
+        signal(SIGTERM, sigterm_handler)
+        main()
+
+except KeyboardInterrupt:
+    print ""
+    print "You pressed CTRL+C"
+
+except SystemExit:
+    print "SystemExit raised"
+
+except Exception as e:
+    print "An error occurred: " + str(e)
+    raise SystemExit(1) # Let systemd restart us
+
+finally:
+    if arduino is not None:
+        arduino.close()
@@ -8,9 +8,12 @@
 ##### Import Libraries #####
 ############################
 from signal import signal, SIGTERM
-from os import getuid, system
-from serial import Serial
+from os import getuid, path, system
 from time import sleep
+import sys
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "Shared")) # Modules shared with clock.py and web.py
+from relay_client import RelayClient, RelayError
+import hal # Does not reboot with CLOCK_PI_HAL=virtual
 
 ###############################################
 ##### Exit cleanly if SIGTERM is received #####
@@ -26,38 +29,44 @@ def main():
     ######################################
     #### Check if we are run as root #####
     ######################################
-    if getuid() != 0:
+    if getuid() != 0 and not hal.VIRTUAL:
         raise Exception("Please run script as root")
 
-    ##############################
-    ##### Connect to Arduino #####
-    ##############################
-    board = Serial("/dev/ttyACM0") # Connect to Arduino
-    board.timeout = 2
-    sleep(5)
-    board.write("Q")
+    ########################################
+    ##### Connect to arduino_server.py #####
+    ########################################
+    global relays
+    relays = RelayClient() # arduino_server.py owns the Arduino's serial port
+    led(relays, "on")
 
     while True:
         sleep(10) # Sleep for ten seconds
-        board.write("h")
-        sleep(1)  # Wait a second
-        rx_bytes = board.readline()
-        if "True" in rx_bytes:
-            board.write("h")
-            sleep(1) # Wait a second
-            rx_bytes = board.readline()
-            if "True" in rx_bytes:
-                board.write("q") # Flash Leds
+        try:
+            pressed = relays.button()
+            if pressed:
+                sleep(1) # Wait a second
+                pressed = relays.button() # Still held down
+        except RelayError as e:
+            print e # arduino_server.py is restarting or lost the Arduino, try again next time
+            continue
+        if pressed:
+            for change in ("off", "on", "off", "on"): # Flash Leds
+                led(relays, change)
                 sleep(1)
-                board.write("Q")
-                sleep(1)
-                board.write("q")
-                sleep(1)
-                board.write("Q")
-                sleep(1)
-                board.write("q")
+            led(relays, "off")
+            if hal.VIRTUAL:
+                print "Not rebooting on virtual hardware"
+            else:
                 system("shutdown -r 1")
-            	raise SystemExit
+            raise SystemExit
+
+def led(relays, change):
+    try:
+        relays.request(change, 13)
+    except RelayError as e:
+        print e # Only the LED, keep watching the button
+
+relays = None
 
 try:
     if __name__ == "__main__":
@@ -75,4 +84,5 @@ except Exception as e:
     print "An error occurred: " + str(e)
 
 finally:
-    board.close()
+    if relays is not None:
+        relays.close()
@@ -144,10 +144,10 @@ apt-get clean
 stop_spinner $?
 
 start_spinner "Installing apt-get Packages..."
-apt-get install git i2c-tools libavformat-dev libfreetype6-dev libfuse-dev libjpeg-dev libportmidi-dev libsdl-dev libsdl-image1.2-dev libsdl-mixer1.2-dev libsdl-ttf2.0-dev libsmpeg-dev libswscale-dev python-dev python-imaging python-numpy python-pip python-pygame python-smbus -y > /dev/null 2>&1
+apt-get install git i2c-tools libavformat-dev libfreetype6-dev libfuse-dev libjpeg-dev libportmidi-dev libsdl-dev libsdl-image1.2-dev libsdl-mixer1.2-dev libsdl-ttf2.0-dev libsmpeg-dev libswscale-dev python-dev python-imaging python-numpy python-pip python-pygame python-alsaaudio python-smbus -y > /dev/null 2>&1
 stop_spinner $?
 start_spinner "Installing python-pip packages..."
-pip install flask psutil pyserial requests > /dev/null 2>&1
+pip install flask gevent psutil pyserial > /dev/null 2>&1
 stop_spinner $?
 
 start_spinner "Installing Main Script and Web Backend..."
@@ -156,7 +156,8 @@ git clone https://github.com/MattElek/Clock-Pi.git -q
 cat > /lib/systemd/system/arduino_shutdown.service <<EOL
 [Unit]
 Description=Arduino Shutdown Button
-After=multi-user.target
+After=multi-user.target arduino_server.service
+Wants=arduino_server.service
 
 [Service]
 Type=idle
@@ -166,10 +167,26 @@ ExecStart=/usr/bin/env python /home/pi/Clock-Pi/arduino_shutdown.py
 WantedBy=multi-user.target
 EOL
 chmod 644 /lib/systemd/system/arduino_shutdown.service
+cat > /lib/systemd/system/arduino_server.service <<EOL
+[Unit]
+Description=More-Than-An-Alarm-Clock Relay Server
+After=multi-user.target
+
+[Service]
+Type=simple
+ExecStart=/usr/bin/env python /home/pi/Clock-Pi/arduino_server.py
+Restart=on-failure
+RestartSec=2
+
+[Install]
+WantedBy=multi-user.target
+EOL
+chmod 644 /lib/systemd/system/arduino_server.service
 cat > /lib/systemd/system/clock.service <<EOL
 [Unit]
 Description=More-Than-An-Alarm-Clock Front End Script
-After=multi-user.target
+After=multi-user.target arduino_server.service
+Wants=arduino_server.service
 
 [Service]
 Type=idle
@@ -182,7 +199,8 @@ chmod 644 /lib/systemd/system/clock.service
 cat > /lib/systemd/system/web.service <<EOL
 [Unit]
 Description=More-Than-An-Alarm-Clock Web Script
-After=multi-user.target
+After=multi-user.target arduino_server.service
+Wants=arduino_server.service
 
 [Service]
 Type=idle
@@ -194,6 +212,7 @@ EOL
 chmod 644 /lib/systemd/system/web.service
 systemctl daemon-reload
 systemctl enable arduino_shutdown.service -q
+systemctl enable arduino_server.service -q
 systemctl enable clock.service -q
 systemctl enable web.service -q
 rm /home/pi/Clock-Pi/Music/README.md